@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Latency and throughput of /authorize over HTTP, Flask (werkzeug server with
+HTTP/1.1 keep-alive) compared to the asyncio server in radguestauth.aioserver.
+
+Both serve the same GuestAuthCore with an allowed guest. The client sends the
+complete PEAP exchange of the guest over one persistent connection, so it
+covers both skipped outer requests and evaluated inner requests.
+
+    python3 benchmarks/bench_aioserver.py [rounds]
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import threading
+import http.client
+
+from common import peap_exchange, allow_user
+
+import radguestauth.server as server
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+from radguestauth.aioserver import AsyncRestServer
+
+FLASK_PORT = 5081
+ASYNC_PORT = 5082
+
+
+def _start_flask(app):
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    httpd = make_server('127.0.0.1', FLASK_PORT, app, threaded=False)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def _start_async(core):
+    loop = asyncio.new_event_loop()
+    rest_server = AsyncRestServer(core, {})
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(rest_server.start('127.0.0.1:%d'
+                                                  % ASYNC_PORT))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return loop
+
+
+def measure(port, bodies, rounds):
+    """
+    :returns: tuple of sorted latencies (seconds) and requests per second
+    """
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for body in bodies:
+            t0 = time.perf_counter()
+            conn.request('POST', '/authorize', body, headers)
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.perf_counter() - t0)
+            assert resp.status in (200, 204)
+    total = time.perf_counter() - start
+    conn.close()
+
+    latencies.sort()
+    return latencies, len(latencies) / total
+
+
+def report(label, latencies, rate):
+    def pct(p):
+        return latencies[int(len(latencies) * p) - 1] * 1e6
+
+    print('%-16s p50 %8.1f us  p99 %8.1f us  %10.0f req/s'
+          % (label, pct(0.5), pct(0.99), rate))
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+
+    app = server.create_app()
+    core = server.guestauthcore
+    allow_user(core._user_manager)
+    bodies = peap_exchange()
+
+    httpd = _start_flask(app)
+    loop = _start_async(core)
+
+    # warm up both, then measure
+    for port in (FLASK_PORT, ASYNC_PORT):
+        measure(port, bodies, rounds // 10 or 1)
+    report('flask', *measure(FLASK_PORT, bodies, rounds))
+    report('asyncio', *measure(ASYNC_PORT, bodies, rounds))
+
+    httpd.shutdown()
+    loop.call_soon_threadsafe(loop.stop)
+    core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
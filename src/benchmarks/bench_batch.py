@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Replay of captured authorize requests, one /authorize call per record
+compared to a single /authorize/batch call.
+
+The records are repetitions of the PEAP exchange of an allowed guest, sent
+through the Flask app (test client, so no HTTP server is needed).
+
+    python3 benchmarks/bench_batch.py [records]
+"""
+
+import sys
+import json
+import time
+import logging
+
+from common import peap_exchange, allow_user
+
+import radguestauth.server as server
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+
+    app = server.create_app()
+    allow_user(server.guestauthcore._user_manager)
+    client = app.test_client()
+    exchange = peap_exchange()
+    bodies = (exchange * (records // len(exchange) + 1))[:records]
+
+    start = time.perf_counter()
+    for body in bodies:
+        client.post('/authorize', data=body, content_type='application/json')
+    single = time.perf_counter() - start
+
+    batch_body = b'[' + b','.join(bodies) + b']'
+    start = time.perf_counter()
+    resp = client.post('/authorize/batch', data=batch_body,
+                       content_type='application/json')
+    batch = time.perf_counter() - start
+    assert len(json.loads(resp.data)) == records
+
+    print('%-28s %8.3f s %12.0f records/s'
+          % ('%d x /authorize' % records, single, records / single))
+    print('%-28s %8.3f s %12.0f records/s'
+          % ('1 x /authorize/batch', batch, records / batch))
+
+    server.guestauthcore.shutdown()
+
+
+if __name__ == '__main__':
+    main()
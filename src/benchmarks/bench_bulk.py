@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Throughput of importing and exporting a guest list, per user storage: the
+batched import of radguestauth.users.bulk compared to admitting each guest
+like a join request.
+
+    python3 benchmarks/bench_bulk.py
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+from common import report
+
+import radguestauth.users.bulk as bulk
+
+from radguestauth.loader import ImplLoader
+from radguestauth.userstorage import UserStorage
+from radguestauth.users.storage import UserIdentifier, UserData
+
+STORAGES = ['memory', 'sqlite', 'journal']
+ROWS = 20000
+
+
+def _guest_list(count):
+    yield 'name,device,valid_until\n'
+    for i in range(count):
+        yield 'guest%d,%s,2030-01-01T00:00:00+00:00\n' % (
+            i, bulk.radius_device_id(0x020000000000 + i)
+        )
+
+
+def _admit_each(mgr, count):
+    for i in range(count):
+        user = UserIdentifier('guest%d' % i,
+                              bulk.radius_device_id(0x020000000000 + i))
+        mgr.add_request(user)
+        user.user_data = UserData()
+        mgr.update(user)
+        mgr.finish_request()
+
+
+def main():
+    logging.disable(logging.WARNING)
+    for name in STORAGES:
+        for method in ['import', 'one by one']:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                config = {
+                    'state_db': os.path.join(tmpdir, 'users.db'),
+                    'state_dir': os.path.join(tmpdir, 'state'),
+                }
+                storage = ImplLoader(UserStorage, None).load(name)()
+                mgr = storage.open(config, 1)
+
+                start = time.perf_counter()
+                if method == 'import':
+                    result = bulk.import_users(mgr, _guest_list(ROWS))
+                    assert result.imported == ROWS
+                else:
+                    _admit_each(mgr, ROWS)
+                report('%s: %s, per row' % (name, method),
+                       (time.perf_counter() - start) / ROWS)
+
+                if method == 'import':
+                    for fmt in bulk.FORMATS:
+                        start = time.perf_counter()
+                        for _ in bulk.export_users(mgr, fmt):
+                            pass
+                        report('%s: export %s, per row' % (name, fmt),
+                               (time.perf_counter() - start) / ROWS)
+                storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Round trip of the UDP chat: from send_message (e.g. notify_join) to the host
+message arriving at the receive hook, with a host answering each message at
+once. Before the chat waited in a selector, messages were only sent when
+the socket thread's 1 second receive timeout ran out. Also reports the CPU
+time the chat uses while idle.
+
+    python3 benchmarks/bench_chat_latency.py
+"""
+
+import time
+import queue
+import socket
+import threading
+
+import common  # noqa: F401 (sets up the module path)
+
+from radguestauth.chats.udp import UdpChat
+
+ROUNDS = 1000
+IDLE_SECONDS = 2
+
+
+def _host(sock):
+    while True:
+        try:
+            data, address = sock.recvfrom(1024)
+        except OSError:
+            return
+        sock.sendto(b'OK', address)
+
+
+def main():
+    host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    host.bind(('127.0.0.1', 0))
+    threading.Thread(target=_host, args=(host,), daemon=True).start()
+
+    chat = UdpChat()
+    chat.NET_HOST_PORT = host.getsockname()[1]
+    replies = queue.Queue()
+    chat.register_receive(replies.put)
+    chat.startup({})
+
+    samples = []
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        chat.send_message('user%d wants to join' % i)
+        replies.get(timeout=5)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print('notify -> host reply: median %.1f us, p99 %.1f us, max %.1f us'
+          % (samples[len(samples) // 2] * 1e6,
+             samples[len(samples) * 99 // 100] * 1e6, samples[-1] * 1e6))
+
+    cpu = time.process_time()
+    time.sleep(IDLE_SECONDS)
+    print('idle CPU time: %.2f ms in %d s'
+          % ((time.process_time() - cpu) * 1e3, IDLE_SECONDS))
+
+    chat.shutdown()
+    host.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Chat command handling with an AuthHandler whose on_host_accept needs
+HOOK_DELAY seconds (e.g. a script run with sudo): the host accepts GUESTS
+pending requests in a row. Compares running the commands inline in the chat
+thread, as before the CommandPool, with the pool.
+
+    python3 benchmarks/bench_commands.py
+"""
+
+import time
+import logging
+
+import common  # noqa: F401 (sets up the module path)
+
+from radguestauth.core import GuestAuthCore
+
+HOOK_DELAY = 0.05
+GUESTS = 20
+
+
+def _slow_accept(user):
+    time.sleep(HOOK_DELAY)
+    return None
+
+
+def _run(inline):
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp', 'expiry_scheduler': 'no',
+                  'max_pending_requests': str(GUESTS)})
+    controller = core._chat_controller
+    controller._auth_handler.on_host_accept = _slow_accept
+    for i in range(GUESTS):
+        core.authorize({'User-Name': 'guest%d' % i,
+                        'Calling-Station-Id': '02-00-00-00-00-%02X' % i})
+    controller.flush(5)
+
+    samples = []
+    start = time.perf_counter()
+    for request_id, _ in core._user_manager.list_requests():
+        message = 'OK %d for 1 h' % request_id
+        received = time.perf_counter()
+        if inline:
+            cmd, _, args = message.partition(' ')
+            controller._execute(controller._commands[cmd.lower()],
+                                args.split(' '), None)
+        else:
+            controller.receive_callback(message)
+        samples.append(time.perf_counter() - received)
+    controller.flush()
+    done = time.perf_counter() - start
+
+    assert not core._user_manager.is_request_pending()
+    core.shutdown()
+    return sorted(samples), done
+
+
+def main():
+    logging.disable(logging.WARNING)
+    for label, inline in [('inline', True), ('pool', False)]:
+        samples, done = _run(inline)
+        print('%-6s chat thread busy per command median %8.1f us, '
+              'max %8.1f us; all %d accepted after %.2f s'
+              % (label, samples[len(samples) // 2] * 1e6, samples[-1] * 1e6,
+                 GUESTS, done))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Cost of finding expired users: a linear scan over all devices (as
+UserManager.get_expired_users used to do) compared to the deadline and join
+index of UserManager and the heap of the ExpiryScheduler, for growing user
+counts with 1% of the users expired. All users have a join limit, which
+only a few used up.
+
+    python3 benchmarks/bench_expiry.py
+"""
+
+import time
+
+import common  # noqa: F401 (sets up the module path)
+
+from radguestauth.expiry import ExpiryScheduler
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+def _fill(mgr, count):
+    now = time.time()
+    expired = count // 100
+    for i in range(count):
+        user = UserIdentifier('user%d' % i, '02-00-%08x' % i)
+        mgr.add_request(user)
+        user.user_data = UserData()
+        # the first 1% expired, of the others one per second expires
+        user.user_data.valid_until = now + i - expired
+        user.user_data.max_num_joins = 10
+        mgr.update(user)
+        mgr.finish_request()
+        # some of the others joined until their limit
+        if i % 1000 == 999 and i >= expired:
+            for _ in range(10):
+                mgr.may_join(user)
+
+
+def _scan(mgr):
+    return [d for devices in mgr._user_devices.values()
+            for d in devices.values() if d.check_expired()]
+
+
+def _measure(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func()
+    return (time.perf_counter() - start) / rounds, result
+
+
+def main():
+    for count in [1000, 10000, 100000]:
+        mgr = UserManager()
+        scheduler = ExpiryScheduler(lambda key, deadline: None)
+        mgr.add_listener(scheduler.on_user_change)
+        _fill(mgr, count)
+
+        # /drop-expired: the scan looks at all users...
+        scan, scanned = _measure(lambda: _scan(mgr), 10)
+        # ...the index only at the expired ones
+        index, expired = _measure(mgr.get_expired_users, 100)
+        # users keep expiring while the scan runs
+        assert len(scanned) <= len(expired)
+        # LIST expiring: users of the next hour
+        soon, expiring = _measure(lambda: mgr.get_expiring_within(3600), 100)
+
+        # the scheduler pops the earliest heap entry
+        rounds = min(count, 1000)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            scheduler._deadlines.pop()
+        pop = (time.perf_counter() - start) / rounds
+
+        print('%7d users, %4d expired: scan %9.1f us   index %8.1f us   '
+              'expiring (%d) %8.1f us   heap pop %5.2f us'
+              % (count, len(expired), scan * 1e6, index * 1e6,
+                 len(expiring), soon * 1e6, pop * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Join throughput for a burst of new guests, depending on the size of the
+pending request queue (max_pending_requests).
+
+This is a simulation on a virtual clock using the real core and chat
+commands: all guests arrive at once and their devices retry authorize every
+RETRY seconds until they are allowed. The host needs HOST_TIME seconds per
+answer and answers the oldest pending request with OK <id>.
+
+    python3 benchmarks/bench_join_burst.py [guests]
+"""
+
+import sys
+import heapq
+import random
+import logging
+
+import common  # noqa: F401 (sets up the module path)
+
+import radguestauth.auth as auth
+
+from radguestauth.core import GuestAuthCore
+
+RETRY = 3.0
+HOST_TIME = 5.0
+
+# event kinds
+AUTHORIZE = 0
+HOST_ANSWER = 1
+
+
+def simulate(guests, max_pending):
+    """
+    :returns: tuple (virtual seconds until all guests joined, number of
+        rejected authorize calls)
+    """
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp', 'max_pending_requests': str(max_pending)})
+    mgr = core._user_manager
+    rand = random.Random(1)
+    # (time, kind, guest number)
+    events = [(rand.random(), AUTHORIZE, i) for i in range(guests)]
+    heapq.heapify(events)
+    host_busy = False
+    rejects = 0
+    joined = 0
+    now = 0.0
+
+    while joined < guests:
+        now, kind, guest = heapq.heappop(events)
+
+        if kind == HOST_ANSWER:
+            request_id = mgr.list_requests()[0][0]
+            core._chat_controller.receive_callback('OK %d for 1 h'
+                                                   % request_id)
+            core._chat_controller.flush()
+            host_busy = mgr.is_request_pending()
+            if host_busy:
+                heapq.heappush(events, (now + HOST_TIME, HOST_ANSWER, None))
+            continue
+
+        state, _ = core.authorize({
+            'User-Name': 'guest%d' % guest,
+            'Calling-Station-Id':
+                '02-00-00-00-%02x-%02x' % divmod(guest, 256),
+        })
+        if state == auth.ALLOW:
+            joined += 1
+            continue
+
+        rejects += 1
+        heapq.heappush(events, (now + RETRY, AUTHORIZE, guest))
+        if not host_busy and mgr.is_request_pending():
+            # the host starts working on the new request
+            host_busy = True
+            heapq.heappush(events, (now + HOST_TIME, HOST_ANSWER, None))
+
+    core.shutdown()
+    return now, rejects
+
+
+def main():
+    guests = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+
+    for max_pending in [1, 4, guests]:
+        seconds, rejects = simulate(guests, max_pending)
+        print('%-24s %8.1f s until all joined  %6.2f joins/min  '
+              '%6d rejected calls'
+              % ('queue size %d' % max_pending, seconds,
+                 guests / seconds * 60, rejects))
+
+
+if __name__ == '__main__':
+    main()
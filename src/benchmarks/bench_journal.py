@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Journal state backend: cost of a user change on the request path compared
+to the in-memory and the SQLite backend, and the startup time with a
+snapshot of 100k users plus journal tails of growing length.
+
+    python3 benchmarks/bench_journal.py
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+from common import report
+
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.journal import (JournalUserManager, _encode,
+                                        _user_record)
+from radguestauth.users.sqlite import SqliteUserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+CHANGES = 5000
+USERS = 100000
+
+
+def _add_users(mgr, count, offset=0):
+    now = time.time()
+    for i in range(offset, offset + count):
+        user = UserIdentifier('user%d' % i, '02-00-%08x' % i)
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.valid_until = now + 24 * 3600
+        mgr.update(user)
+        mgr.finish_request()
+
+
+def _change_cost(mgr):
+    """
+    Seconds per change (add_request, update and finish_request each count).
+    """
+    start = time.perf_counter()
+    _add_users(mgr, CHANGES)
+    return (time.perf_counter() - start) / (3 * CHANGES)
+
+
+def main():
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        report('change, in-memory', _change_cost(UserManager(CHANGES)))
+        mgr = JournalUserManager(os.path.join(tmp, 'journal'), CHANGES)
+        report('change, journal', _change_cost(mgr))
+        mgr.close()
+        mgr = SqliteUserManager(os.path.join(tmp, 'users.db'), CHANGES)
+        report('change, sqlite', _change_cost(mgr))
+        mgr.close()
+
+        state_dir = os.path.join(tmp, 'startup')
+        mgr = JournalUserManager(state_dir, USERS)
+        _add_users(mgr, USERS)
+        # writes the snapshot
+        mgr.close()
+
+        # the changes since the last snapshot, as left by a crash
+        journal = mgr._journal_path(mgr._generation)
+        tail = []
+        for i in range(10000):
+            user = UserIdentifier('tail%d' % i, '04-00-%08x' % i)
+            user.user_data = UserData()
+            tail.append(_encode(_user_record(user)))
+
+        for count in [0, 1000, 10000]:
+            with open(journal, 'wb') as f:
+                f.write(b''.join(tail[:count]))
+
+            start = time.perf_counter()
+            mgr = JournalUserManager(state_dir, USERS)
+            elapsed = time.perf_counter() - start
+            print('startup, %d users + %5d tail records: %6.0f ms'
+                  % (USERS, mgr._records, elapsed * 1e3))
+            # no close(), it would write a new snapshot
+            mgr._journal.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+LIST with many guests: one page from the maintained name index compared to
+sorting all users, and the size of the reply messages.
+
+    python3 benchmarks/bench_list.py
+"""
+
+from operator import attrgetter
+
+from common import timeit, report
+
+from radguestauth.commands.user import ListUsersCommand
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+USERS = 10000
+ROUNDS = 1000
+
+
+def main():
+    mgr = UserManager()
+    # insert in random-ish order, so the index is not just appended
+    for i in range(USERS):
+        n = (i * 7919) % USERS
+        user = UserIdentifier('guest%05d' % n, '02-00-%08X' % n)
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.join_state = UserData.JOIN_STATE_ALLOWED
+        mgr.update(user)
+        mgr.finish_request()
+
+    cmd = ListUsersCommand(mgr)
+
+    report('sorted() of %d users' % USERS,
+           timeit(lambda: sorted(mgr._users.values(), key=attrgetter('name')),
+                  ROUNDS // 10))
+    report('list_users(limit=%d)' % cmd.PAGE_SIZE,
+           timeit(lambda: mgr.list_users(None, 0, cmd.PAGE_SIZE), ROUNDS))
+    report('list_users(prefix)',
+           timeit(lambda: mgr.list_users('guest050', 0, cmd.PAGE_SIZE),
+                  ROUNDS))
+    report('LIST', timeit(lambda: cmd.execute([]), ROUNDS))
+    report('LIST 400', timeit(lambda: cmd.execute(['400']), ROUNDS))
+    report('LIST blocked (full walk)',
+           timeit(lambda: cmd.execute(['blocked']), 10))
+
+    messages = cmd.execute([])
+    print('LIST reply: %d messages, largest %d bytes'
+          % (len(messages), max(len(m.encode()) for m in messages)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+MAC address handling: normalizing a device ID to a string or an integer,
+and finding the user of a device by the UserManager index compared to a
+scan over all users.
+
+    python3 benchmarks/bench_mac.py
+"""
+
+from common import DUMP_DEVICE, timeit, report
+
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+ROUNDS = 100000
+USERS = 10000
+
+
+def main():
+    report('format_mac', timeit(lambda: UserIdentifier.format_mac(DUMP_DEVICE),
+                                ROUNDS))
+    report('parse_mac', timeit(lambda: UserIdentifier.parse_mac(DUMP_DEVICE),
+                               ROUNDS))
+    report('UserIdentifier()',
+           timeit(lambda: UserIdentifier('name', DUMP_DEVICE), ROUNDS))
+
+    mgr = UserManager(USERS)
+    for i in range(USERS):
+        user = UserIdentifier('user%d' % i, '02-00-%08X' % i)
+        mgr.add_request(user)
+        user.user_data = UserData()
+        mgr.update(user)
+        mgr.finish_request()
+
+    # the user in the middle, given as the AP reports it
+    device = '02:00:00:00:%02x:%02x' % divmod(USERS // 2, 256)
+    mac = UserIdentifier.parse_mac(device)
+    assert mgr.find_by_mac(mac).name == 'user%d' % (USERS // 2)
+
+    def scan():
+        formatted = UserIdentifier.format_mac(device)
+        for user in mgr.list_users():
+            if user.device_id_as_mac() == formatted:
+                return user
+
+    report('find_by_mac(int)', timeit(lambda: mgr.find_by_mac(mac), ROUNDS))
+    report('find_by_mac(str)', timeit(lambda: mgr.find_by_mac(device),
+                                      ROUNDS))
+    report('scan of %d users' % USERS, timeit(scan, 100))
+
+    new_user = UserIdentifier('new', '02-00-ff-ff-ff-ff')
+    report('may_join, new user', timeit(lambda: mgr.may_join(new_user),
+                                        ROUNDS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Memory of stored users with the __slots__ classes of radguestauth.users.storage
+compared to classes with an instance dict, for 10k to 1M users, the memory of
+the UserIdentifier created per request, and the memory allocated during one
+authorize call.
+
+    python3 benchmarks/bench_memory.py
+"""
+
+import gc
+import time
+import logging
+import tracemalloc
+
+from common import DUMP_USER, DUMP_DEVICE, allow_user
+
+from radguestauth.core import GuestAuthCore
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class DictUserIdentifier(object):
+    """
+    UserIdentifier without __slots__.
+    """
+    __eq__ = UserIdentifier.__eq__
+    device_id_as_mac = UserIdentifier.device_id_as_mac
+    check_expired = UserIdentifier.check_expired
+    format_mac = UserIdentifier.format_mac
+
+    def __init__(self, name, device_id, password=None):
+        self.name = name
+        self.device_id = device_id
+        self.password = password
+        self.user_data = None
+
+
+class DictUserData(object):
+    """
+    UserData without __slots__.
+    """
+    JOIN_STATE_ALLOWED = UserData.JOIN_STATE_ALLOWED
+    check_expired = UserData.check_expired
+
+    def __init__(self):
+        self.valid_until = None
+        self.num_joins = 0
+        self.max_num_joins = 0
+        self.join_state = self.JOIN_STATE_ALLOWED
+
+
+def _users_memory(count, id_cls, data_cls):
+    """
+    Bytes per user held by a users dict like UserManager._users. The names
+    and device IDs are created beforehand, as they are the same for both
+    variants.
+    """
+    names = ['user%d' % i for i in range(count)]
+    devices = ['02-00-%08x' % i for i in range(count)]
+    valid_until = time.time() + 3600
+
+    gc.collect()
+    tracemalloc.start()
+    users = dict()
+    for name, device in zip(names, devices):
+        user = id_cls(name, device)
+        user.user_data = data_cls()
+        user.user_data.valid_until = valid_until
+        users[name] = user
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return used / count
+
+
+def _create_memory(id_cls, rounds=1000):
+    """
+    Bytes allocated for the UserIdentifier of a request.
+    """
+    id_cls(DUMP_USER, DUMP_DEVICE)
+    tracemalloc.start()
+    total = 0
+    for _ in range(rounds):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        id_cls(DUMP_USER, DUMP_DEVICE)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return total / rounds
+
+
+def _authorize_memory(core, items, rounds=1000):
+    """
+    Average peak of the memory allocated by one authorize call.
+    """
+    core.authorize(items)
+    tracemalloc.start()
+    total = 0
+    for _ in range(rounds):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        core.authorize(items)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return total / rounds
+
+
+def main():
+    logging.disable(logging.INFO)
+    for count in [10000, 100000, 1000000]:
+        slots = _users_memory(count, UserIdentifier, UserData)
+        dicts = _users_memory(count, DictUserIdentifier, DictUserData)
+        print('%7d users: __slots__ %5.0f B/user (%6.1f MB), '
+              'instance dict %5.0f B/user (%6.1f MB)'
+              % (count, slots, slots * count / 1e6, dicts,
+                 dicts * count / 1e6))
+
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp', 'expiry_scheduler': 'no'})
+    allow_user(core._user_manager)
+    # measure the user lookup, not the reply cache
+    core._reply_cache = None
+    items = {'User-Name': DUMP_USER, 'Calling-Station-Id': DUMP_DEVICE,
+             'FreeRADIUS-Proxied-To': '127.0.0.1'}
+
+    print('request UserIdentifier: __slots__ %4.0f B, instance dict %4.0f B'
+          % (_create_memory(UserIdentifier),
+             _create_memory(DictUserIdentifier)))
+    print('authorize of an allowed user: %4.0f B allocated at peak'
+          % _authorize_memory(core, items))
+
+    core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
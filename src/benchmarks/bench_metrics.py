@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Overhead of the metrics recorded for /authorize.
+
+The PEAP exchange of an allowed guest is handled by a RestHandler, once with
+the regular Metrics and once with a Metrics object whose recording methods do
+nothing. The cost of rendering /metrics is printed as well.
+
+    python3 benchmarks/bench_metrics.py
+"""
+
+import logging
+
+from common import peap_exchange, allow_user, timeit, report
+
+import radguestauth.metrics as metrics
+
+from radguestauth.core import GuestAuthCore
+from radguestauth.rest import RestHandler
+
+ROUNDS = 20000
+
+
+class NullMetrics(metrics.Metrics):
+    def count_request(self, endpoint, decision, seconds):
+        pass
+
+    def observe_stage(self, stage, seconds):
+        pass
+
+    def stage_done(self, stage, start):
+        return start
+
+
+def main():
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp'})
+    allow_user(core._user_manager)
+    handler = RestHandler(core, {})
+    bodies = peap_exchange()
+
+    def exchange():
+        for body in bodies:
+            if not handler.is_skipped(body):
+                handler.authorize(body)
+
+    enabled = core._metrics
+    report('PEAP exchange, metrics enabled', timeit(exchange, ROUNDS))
+    core._metrics = handler._metrics = NullMetrics()
+    report('PEAP exchange, metrics disabled', timeit(exchange, ROUNDS))
+    core._metrics = handler._metrics = enabled
+
+    report('render /metrics', timeit(handler.metrics, ROUNDS // 10))
+
+    core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
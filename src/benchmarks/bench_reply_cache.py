@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Cost of answering an allowed guest's /authorize request (core decision plus
+response serialization) with and without the reply cache.
+
+    python3 benchmarks/bench_reply_cache.py
+"""
+
+import logging
+
+from common import DUMP_USER, DUMP_DEVICE, allow_user, timeit, report
+
+from radguestauth.core import GuestAuthCore
+from radguestauth.rest import reply_body
+
+ROUNDS = 100000
+
+
+def main():
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp'})
+    allow_user(core._user_manager)
+    items = {'User-Name': DUMP_USER, 'Calling-Station-Id': DUMP_DEVICE,
+             'FreeRADIUS-Proxied-To': '127.0.0.1'}
+
+    def answer():
+        state, attrs = core.authorize(items)
+        return reply_body(attrs)
+
+    report('authorize + serialize, reply cache', timeit(answer, ROUNDS))
+    cache = core._reply_cache
+    core._reply_cache = None
+    report('authorize + serialize, no cache', timeit(answer, ROUNDS))
+    core._reply_cache = cache
+
+    core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Compares the complete mod_rest body decoding (json.loads + json_rest_unpack)
+with the fast extraction of the attributes needed by the core, using the
+PEAP-MSCHAPv2 exchange from integration_test.sh.
+
+    python3 benchmarks/bench_rest_parser.py
+"""
+
+import json
+
+from common import peap_exchange, timeit, report
+
+from radguestauth.core import REQUEST_ATTRIBUTES
+from radguestauth.rest import json_rest_unpack, unpack_request
+
+ROUNDS = 5000
+
+
+def main():
+    bodies = peap_exchange()
+    # a large TLS message as sent during the PEAP handshake
+    largest = max(bodies, key=len)
+
+    def full_exchange():
+        for body in bodies:
+            json_rest_unpack(json.loads(body))
+
+    def fast_exchange():
+        for body in bodies:
+            unpack_request(body, REQUEST_ATTRIBUTES)
+
+    report('full parser, one exchange (%d requests)' % len(bodies),
+           timeit(full_exchange, ROUNDS))
+    report('fast parser, one exchange (%d requests)' % len(bodies),
+           timeit(fast_exchange, ROUNDS))
+    report('full parser, largest request (%d bytes)' % len(largest),
+           timeit(lambda: json_rest_unpack(json.loads(largest)), ROUNDS))
+    report('fast parser, largest request (%d bytes)' % len(largest),
+           timeit(lambda: unpack_request(largest, REQUEST_ATTRIBUTES),
+                  ROUNDS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+authorize latency for new guests (which triggers a join notification) with
+a chat backend needing CHAT_DELAY seconds per message, like a stalled XMPP
+connection: sending the notification inline, as before the ChatOutbox, and
+through the outbox.
+
+    python3 benchmarks/bench_slow_chat.py
+"""
+
+import time
+import logging
+
+import common  # noqa: F401 (sets up the module path)
+
+from radguestauth.core import GuestAuthCore
+
+CHAT_DELAY = 0.05
+GUESTS = 20
+
+
+class SlowChat(object):
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, message):
+        time.sleep(CHAT_DELAY)
+        self.sent += 1
+
+
+class InlineOutbox(object):
+    """
+    Calls the chat directly in send.
+    """
+
+    def __init__(self, chat):
+        self._chat = chat
+
+    def send(self, message):
+        self._chat.send_message(message)
+
+
+def _run(inline):
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp', 'expiry_scheduler': 'no',
+                  'max_pending_requests': str(GUESTS)})
+    controller = core._chat_controller
+    controller.flush(5)
+    chat = SlowChat()
+    if inline:
+        outbox = controller._outbox
+        controller._outbox = InlineOutbox(chat)
+    else:
+        controller._outbox._chat = chat
+
+    samples = []
+    for i in range(GUESTS):
+        start = time.perf_counter()
+        core.authorize({'User-Name': 'guest%d' % i,
+                        'Calling-Station-Id': '02-00-00-00-00-%02X' % i})
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if inline:
+        controller._outbox = outbox
+    else:
+        controller.flush()
+    delivered = time.perf_counter() - start
+    assert chat.sent == GUESTS
+    core.shutdown()
+    return sorted(samples), delivered
+
+
+def main():
+    logging.disable(logging.WARNING)
+    for label, inline in [('inline', True), ('outbox', False)]:
+        samples, delivered = _run(inline)
+        print('%-7s authorize median %8.1f us, max %8.1f us; '
+              'all notifications sent %.2f s after the last request'
+              % (label, samples[len(samples) // 2] * 1e6, samples[-1] * 1e6,
+                 delivered))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+SQLite state backend: time to load a database of 100k users at startup,
+and the authorize latency compared to the in-memory UserManager.
+
+    python3 benchmarks/bench_sqlite.py
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+from common import DUMP_USER, DUMP_DEVICE, allow_user, timeit, report
+
+from radguestauth.core import GuestAuthCore
+from radguestauth.users.sqlite import SqliteUserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+USERS = 100000
+ROUNDS = 100000
+
+
+def _fill(path, count):
+    mgr = SqliteUserManager(path, count)
+    # one transaction instead of one per user
+    mgr._db.execute('BEGIN')
+    now = time.time()
+    for i in range(count):
+        user = UserIdentifier('user%d' % i, '02-00-%08x' % i)
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.valid_until = now + 24 * 3600
+        user.user_data.join_state = UserData.JOIN_STATE_ALLOWED
+        mgr.update(user)
+    mgr._db.execute('DELETE FROM requests')
+    mgr._db.commit()
+    mgr.close()
+
+
+def _core(backend, path):
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp', 'expiry_scheduler': 'no',
+                  'user_storage': backend, 'state_db': path})
+    allow_user(core._user_manager)
+    # measure the user lookup, not the reply cache
+    core._reply_cache = None
+    return core
+
+
+def main():
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'users.db')
+        _fill(path, USERS)
+        print('database size: %.1f MB' % (os.path.getsize(path) / 1e6))
+
+        start = time.perf_counter()
+        mgr = SqliteUserManager(path)
+        elapsed = time.perf_counter() - start
+        print('cold start with %d users: %.0f ms'
+              % (len(mgr.list_users()), elapsed * 1e3))
+        mgr.close()
+
+        items = {'User-Name': DUMP_USER, 'Calling-Station-Id': DUMP_DEVICE,
+                 'FreeRADIUS-Proxied-To': '127.0.0.1'}
+        for backend in ['memory', 'sqlite']:
+            core = _core(backend, path)
+            report('authorize, %s backend' % backend,
+                   timeit(lambda: core.authorize(items), ROUNDS))
+            core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
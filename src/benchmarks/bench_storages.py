@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Runs every UserStorage through the same workload: admitting users, may_join
+of an allowed user (the authorize path), and finding expired users.
+
+    python3 benchmarks/bench_storages.py
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+from common import timeit, report
+
+from radguestauth.loader import ImplLoader
+from radguestauth.userstorage import UserStorage
+from radguestauth.users.storage import UserIdentifier, UserData
+
+STORAGES = ['memory', 'sqlite', 'journal', 'shared']
+USERS = 2000
+ROUNDS = 2000
+
+
+def _admit(mgr, count):
+    now = time.time()
+    for i in range(count):
+        user = UserIdentifier('user%d' % i, '02-00-%08x' % i)
+        mgr.add_request(user)
+        user.user_data = UserData()
+        # 1% expired
+        user.user_data.valid_until = now + (-60 if i % 100 == 0 else 3600)
+        mgr.update(user)
+        mgr.finish_request()
+
+
+def main():
+    logging.disable(logging.WARNING)
+    for name in STORAGES:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {
+                'state_db': os.path.join(tmpdir, 'users.db'),
+                'state_dir': os.path.join(tmpdir, 'state'),
+                'state_socket': os.path.join(tmpdir, 'state.sock'),
+            }
+            storage = ImplLoader(UserStorage, None).load(name)()
+            mgr = storage.open(config, 1)
+
+            start = time.perf_counter()
+            _admit(mgr, USERS)
+            report('%s: admit user' % name,
+                   (time.perf_counter() - start) / USERS)
+
+            user = UserIdentifier('user1', '02-00-00000001')
+            assert mgr.may_join(user) == UserData.JOIN_STATE_ALLOWED
+            report('%s: may_join' % name,
+                   timeit(lambda: mgr.may_join(user), ROUNDS))
+            report('%s: get_expired_users' % name,
+                   timeit(mgr.get_expired_users, 100))
+
+            storage.close()
+            state = storage.shared_state()
+            if state is not None:
+                # started by open, as no server was running
+                state.shutdown()
+
+
+if __name__ == '__main__':
+    main()
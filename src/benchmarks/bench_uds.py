@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Latency of /authorize over loopback TCP compared to a unix domain socket.
+
+The asyncio server of radguestauth.aioserver listens on both, and the client
+sends the PEAP exchange of an allowed guest over one persistent connection,
+like the connection pool of mod_rest does. Run it on the target hardware
+(e.g. the Raspberry Pi) to see the difference there.
+
+    python3 benchmarks/bench_uds.py [rounds]
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
+import http.client
+
+from common import peap_exchange, allow_user
+
+from radguestauth.core import GuestAuthCore
+from radguestauth.aioserver import AsyncRestServer
+
+TCP_BIND = '127.0.0.1:5083'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection over a unix domain socket.
+    """
+
+    def __init__(self, path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def _start_server(core, binds):
+    loop = asyncio.new_event_loop()
+    rest_server = AsyncRestServer(core, {})
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        for bind in binds:
+            loop.run_until_complete(rest_server.start(bind))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return loop
+
+
+def measure(conn, bodies, rounds):
+    """
+    :returns: sorted latencies in seconds
+    """
+    headers = {'Content-Type': 'application/json'}
+    latencies = []
+    for _ in range(rounds):
+        for body in bodies:
+            t0 = time.perf_counter()
+            conn.request('POST', '/authorize', body, headers)
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.perf_counter() - t0)
+            assert resp.status in (200, 204)
+    conn.close()
+
+    latencies.sort()
+    return latencies
+
+
+def report(label, latencies):
+    def pct(p):
+        return latencies[int(len(latencies) * p) - 1] * 1e6
+
+    print('%-8s p50 %8.1f us  p90 %8.1f us  p99 %8.1f us'
+          % (label, pct(0.5), pct(0.9), pct(0.99)))
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # avoid measuring debug log output
+    logging.disable(logging.INFO)
+
+    core = GuestAuthCore()
+    core.startup({'chat': 'udp'})
+    allow_user(core._user_manager)
+    bodies = peap_exchange()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sock_path = os.path.join(tmpdir, 'radguestauth.sock')
+        loop = _start_server(core, [TCP_BIND, 'unix:' + sock_path])
+        host, _, port = TCP_BIND.rpartition(':')
+
+        def tcp():
+            return http.client.HTTPConnection(host, int(port))
+
+        def uds():
+            return UnixHTTPConnection(sock_path)
+
+        # warm up, then alternate to even out background noise
+        measure(tcp(), bodies, rounds // 10 or 1)
+        measure(uds(), bodies, rounds // 10 or 1)
+        tcp_lat = measure(tcp(), bodies, rounds)
+        uds_lat = measure(uds(), bodies, rounds)
+        report('tcp', tcp_lat)
+        report('unix', uds_lat)
+
+        loop.call_soon_threadsafe(loop.stop)
+
+    core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Throughput of /authorize with 1..N worker processes sharing the user state.
+
+Each worker runs the Flask app (via its test client, so no HTTP server is
+needed) and sends the inner PEAP request of an allowed guest in a loop, like
+FreeRADIUS would for returning guests. The local backend with one worker is
+printed as baseline.
+
+    python3 benchmarks/bench_workers.py [duration_seconds [max_workers]]
+
+Scaling is only visible with at least as many CPU cores as workers; by
+default, up to os.cpu_count() workers are used.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+
+from common import join_request, allow_user
+
+import radguestauth.server as server
+import radguestauth.users.shared as shared
+
+
+def _write_config(tmpdir, backend):
+    path = os.path.join(tmpdir, 'bench_%s.ini' % backend)
+    with open(path, 'w') as f:
+        f.write('[radguestauth]\nchat = udp\n')
+        f.write('user_storage = %s\n' % backend)
+        f.write('state_socket = %s\n' % os.path.join(tmpdir, 'state.sock'))
+        f.write('chat_lock = %s\n' % os.path.join(tmpdir, 'chat.lock'))
+    return path
+
+
+def _worker(config_path, barrier, duration, results):
+    os.environ['RADGUESTAUTH_CONFIG'] = config_path
+    app = server.create_app()
+    client = app.test_client()
+    body = join_request()
+    if server.guestauthcore._state is None:
+        # local backend: the worker has its own users
+        allow_user(server.guestauthcore._user_manager)
+
+    barrier.wait()
+    count = 0
+    stop_at = time.perf_counter() + duration
+    while time.perf_counter() < stop_at:
+        resp = client.post('/authorize', data=body,
+                           content_type='application/json')
+        assert resp.status_code == 200
+        count += 1
+
+    results.put(count)
+    server.guestauthcore.shutdown()
+
+
+def run(config_path, num_workers, duration):
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(num_workers)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_worker,
+                         args=(config_path, barrier, duration, results))
+             for _ in range(num_workers)]
+    for p in procs:
+        p.start()
+    total = sum(results.get() for _ in procs)
+    for p in procs:
+        p.join()
+
+    return total / duration
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    max_workers = (int(sys.argv[2]) if len(sys.argv) > 2
+                   else os.cpu_count() or 1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_cfg = _write_config(tmpdir, 'memory')
+        print('%-28s %12.0f req/s' % ('local backend, 1 worker',
+                                      run(local_cfg, 1, duration)))
+
+        shared_cfg = _write_config(tmpdir, 'shared')
+        state = shared.start_state_server(os.path.join(tmpdir, 'state.sock'))
+        allow_user(state.user_manager())
+
+        workers = 1
+        single = None
+        while workers <= max_workers:
+            rate = run(shared_cfg, workers, duration)
+            single = single or rate
+            print('%-28s %12.0f req/s  (x%.2f)'
+                  % ('shared backend, %d worker(s)' % workers, rate,
+                     rate / single))
+            workers *= 2
+
+        state.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Helpers shared by the benchmark scripts in this directory.
+
+The request bodies are the FreeRADIUS mod_rest dumps of a PEAP-MSCHAPv2
+exchange which are also used in integration_test.sh.
+"""
+
+import os
+import re
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# allow running the scripts from any directory without installing the module
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from radguestauth.users.storage import UserIdentifier, UserData  # noqa: E402
+
+# name and device of the guest in the dumps
+DUMP_USER = 'someone1'
+DUMP_DEVICE = '02-00-00-00-00-01'
+
+
+def _read_integration_test():
+    with open(os.path.join(SRC_DIR, 'integration_test.sh')) as f:
+        return f.read()
+
+
+def peap_exchange():
+    """
+    Returns the request bodies (as bytes) of one PEAP-MSCHAPv2 exchange in
+    the order FreeRADIUS sends them to /authorize. The last one is the inner
+    request which is actually evaluated.
+    """
+    text = _read_integration_test()
+    bodies = re.findall(r"authorize_req '(\{.*\})'", text)
+    bodies.append(re.search(r"JOIN_REQ='(\{.*\})'", text).group(1))
+    return [b.encode() for b in bodies]
+
+
+def join_request():
+    """
+    The inner request of the exchange (the one reaching the AuthHandler).
+    """
+    return peap_exchange()[-1]
+
+
+def allow_user(user_mgr, name=DUMP_USER, device=DUMP_DEVICE, hours=24):
+    """
+    Adds an allowed user the way AllowCommand does.
+    """
+    user_mgr.add_request(UserIdentifier(name, device))
+    req = user_mgr.get_request()
+    req.user_data = UserData()
+    req.user_data.valid_until = time.time() + hours * 3600
+    user_mgr.update(req)
+    user_mgr.finish_request()
+
+
+def timeit(func, number):
+    """
+    Calls func number times and returns the seconds per call.
+    """
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def report(label, seconds_per_op):
+    print('%-44s %10.2f us/op %12.0f op/s'
+          % (label, seconds_per_op * 1e6, 1 / seconds_per_op))
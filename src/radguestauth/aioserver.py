@@ -0,0 +1,339 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+asyncio-based REST server, an alternative to the Flask app in
+radguestauth.server.
+
+It implements the small subset of HTTP/1.1 used by FreeRADIUS mod_rest
+(requests with Content-Length, persistent connections) directly on asyncio
+streams, so there is no per-request framework overhead and no worker
+process model. The endpoints run in the default executor, as AuthHandler
+hooks may block (e.g. the Firewall handler calling sudo); only skipped
+requests are answered on the event loop. Run it with
+
+$ RADGUESTAUTH_CONFIG=config.ini python3 -m radguestauth.aioserver
+"""
+
+import os
+import grp
+import signal
+import asyncio
+import logging
+import radguestauth.metrics as metrics
+import radguestauth.users.bulk as bulk
+import radguestauth.users.shared as shared
+
+from radguestauth.config import load_config
+from radguestauth.core import GuestAuthCore
+from radguestauth.rest import RestHandler, NO_CONTENT_BODY, JSON_CONTENT_TYPE
+
+
+DEFAULT_BIND = '127.0.0.1:5000'
+# prefix of bind addresses which denote a unix domain socket, like in gunicorn
+UNIX_PREFIX = 'unix:'
+# FreeRADIUS runs as a different user, so it needs write access via the
+# group of the socket (see socket_group)
+UNIX_SOCKET_MODE = 0o660
+# upper limit for request headers and bodies
+MAX_HEADER_SIZE = 16384
+MAX_BODY_SIZE = 1048576
+
+_REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_response(status, body, content_type=JSON_CONTENT_TYPE,
+                   keep_alive=True):
+    """
+    Serializes a complete HTTP/1.1 response.
+
+    :returns: the response as bytes
+    """
+    head = 'HTTP/1.1 %d %s\r\n' % (status, _REASONS.get(status, ''))
+    if status != 204:
+        head += ('Content-Type: %s\r\nContent-Length: %d\r\n'
+                 % (content_type, len(body)))
+    if not keep_alive:
+        head += 'Connection: close\r\n'
+
+    return head.encode() + b'\r\n' + body
+
+
+# prebuilt responses for requests skipped by RestHandler.is_skipped
+_NO_CONTENT = build_response(204, NO_CONTENT_BODY)
+_NO_CONTENT_CLOSE = build_response(204, NO_CONTENT_BODY, keep_alive=False)
+
+
+class HttpError(Exception):
+    """
+    Raised for requests which can't be handled. The connection is closed
+    after the error response.
+    """
+    def __init__(self, status):
+        self.status = status
+
+
+class AsyncRestServer(object):
+    """
+    Serves /authorize, /authorize/batch, /post-auth, /drop-expired,
+    /users.csv, /users.jsonl and /metrics of a GuestAuthCore.
+    """
+
+    def __init__(self, core, config):
+        """
+        :param core: a started GuestAuthCore
+        :param config: config dict, see RestHandler
+        """
+        self._handler = RestHandler(core, config)
+        self._routes = {
+            ('GET', '/'): self._info,
+            ('POST', '/authorize'): self._handler.authorize,
+            ('POST', '/authorize/batch'): self._handler.authorize_batch,
+            ('POST', '/post-auth'): self._handler.post_auth,
+            ('GET', '/drop-expired'): self._drop_expired,
+            ('GET', '/metrics'): self._metrics,
+        }
+        # responses which are not JSON
+        self._content_types = {
+            '/': 'text/plain',
+            '/drop-expired': 'text/plain',
+            '/metrics': metrics.CONTENT_TYPE,
+        }
+        for fmt in bulk.FORMATS:
+            path = '/users.%s' % fmt
+            self._routes[('POST', path)] = self._import_func(fmt)
+            self._routes[('GET', path)] = self._export_func(fmt)
+            self._content_types[path] = bulk.CONTENT_TYPES[fmt]
+
+    @property
+    def rest_handler(self):
+        return self._handler
+
+    @staticmethod
+    def _info(body):
+        return (200, b'radguestauth REST server running')
+
+    def _drop_expired(self, body):
+        return self._handler.drop_expired()
+
+    def _metrics(self, body):
+        return self._handler.metrics()
+
+    def _import_func(self, fmt):
+        def import_users(body):
+            # bodies are limited to MAX_BODY_SIZE, larger lists have to be
+            # split up
+            return self._handler.import_users(
+                fmt, body.splitlines(keepends=True)
+            )
+        return import_users
+
+    def _export_func(self, fmt):
+        def export_users(body):
+            status, lines = self._handler.export_users(fmt)
+            return (status, b''.join(lines))
+        return export_users
+
+    def dispatch(self, method, path, body):
+        """
+        Calls the endpoint for method and path.
+
+        :returns: tuple of HTTP status and body
+        """
+        endpoint = self._routes.get((method, path))
+        if endpoint is None:
+            if any(p == path for (_, p) in self._routes):
+                return (405, b'')
+            return (404, b'')
+
+        return endpoint(body)
+
+    @staticmethod
+    async def _read_request(reader):
+        """
+        Reads one request from the stream.
+
+        :returns: tuple (method, path, body, keep_alive), or None if the
+            client closed the connection.
+        :raises HttpError: for malformed or unsupported requests
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(400)
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HttpError(400)
+
+        headers = dict()
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        if 'transfer-encoding' in headers:
+            # mod_rest always sends a Content-Length
+            raise HttpError(411)
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400)
+        if length > MAX_BODY_SIZE:
+            raise HttpError(413)
+
+        body = b''
+        if length:
+            try:
+                body = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return None
+
+        # ignore query strings
+        path = target.partition('?')[0]
+        return (method, path, body, keep_alive)
+
+    async def handle_request(self, method, path, body, keep_alive):
+        """
+        Computes the serialized response for one request.
+        """
+        if (method == 'POST' and path == '/authorize'
+                and self._handler.is_skipped(body)):
+            return _NO_CONTENT if keep_alive else _NO_CONTENT_CLOSE
+
+        try:
+            status, resp_body = await asyncio.get_event_loop(
+            ).run_in_executor(None, self.dispatch, method, path, body)
+        except Exception:
+            logger.error('Failed to handle %s %s' % (method, path),
+                         exc_info=1)
+            status, resp_body = (500, b'')
+
+        content_type = self._content_types.get(path, JSON_CONTENT_TYPE)
+        return build_response(status, resp_body, content_type, keep_alive)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves requests of one (persistent) connection.
+        """
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HttpError as err:
+                    writer.write(build_response(err.status, b'',
+                                                keep_alive=False))
+                    break
+
+                if request is None:
+                    break
+
+                writer.write(await self.handle_request(*request))
+                await writer.drain()
+
+                if not request[3]:
+                    break
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.error('Failed to serve connection', exc_info=1)
+            writer.write(build_response(500, b'', keep_alive=False))
+        finally:
+            writer.close()
+
+    async def start(self, bind=DEFAULT_BIND, group=None):
+        """
+        Starts listening.
+
+        :param bind: host:port to listen on, or unix:/path/to/socket for a
+            unix domain socket
+        :param group: name of the group which may connect to the unix
+            socket, e.g. the one FreeRADIUS runs as
+        :returns: the asyncio Server
+        """
+        if bind.startswith(UNIX_PREFIX):
+            path = bind[len(UNIX_PREFIX):]
+            # remove the socket of a previous run, other files are kept and
+            # make start_unix_server fail
+            shared.remove_stale_socket(path)
+            server = await asyncio.start_unix_server(
+                self.handle_connection, path, limit=MAX_HEADER_SIZE
+            )
+            if group:
+                os.chown(path, -1, grp.getgrnam(group).gr_gid)
+            os.chmod(path, UNIX_SOCKET_MODE)
+            return server
+
+        host, _, port = bind.rpartition(':')
+        return await asyncio.start_server(self.handle_connection, host,
+                                          int(port), limit=MAX_HEADER_SIZE)
+
+
+async def serve(core, config):
+    """
+    Runs the server until SIGINT or SIGTERM is received.
+    """
+    rest_server = AsyncRestServer(core, config)
+    bind = config.get('bind', DEFAULT_BIND)
+    server = await rest_server.start(bind, config.get('socket_group'))
+    logger.info('Listening on %s' % bind)
+
+    loop = asyncio.get_event_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(
+            sig, lambda: stop.done() or stop.set_result(None)
+        )
+
+    try:
+        await stop
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(process)d - %(name)s] [%(levelname)s] '
+               '%(message)s'
+    )
+    config = load_config()
+    core = GuestAuthCore()
+    core.startup(config)
+    # asyncio.run needs Python 3.7
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(core, config))
+    finally:
+        loop.close()
+        core.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -55,6 +55,30 @@ class AuthHandler(object):
         """
         return NotImplemented
 
+    def reply_cacheable(self, state):
+        """
+        Indicates whether handle_user_state results for the given state may be
+        cached. This is only possible if the result depends on nothing but
+        the stored user (e.g. its password) and the state, and if the call
+        has no side effects. Cached results are reused until the user
+        changes.
+
+        :param state: an UserData.JOIN_STATE
+        :returns: True to enable caching, False by default
+        """
+        return False
+
+    def required_attributes(self):
+        """
+        Names of FreeRADIUS request attributes the handler relies on in
+        addition to the ones evaluated by GuestAuthCore. When the fast request
+        parser is enabled, attributes not declared here or by the core are
+        not extracted.
+
+        :returns: A set of attribute names
+        """
+        return set()
+
     @abstractmethod
     def on_post_auth(self, user, acct_session):
         """
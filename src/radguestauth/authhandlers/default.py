@@ -28,6 +28,10 @@ class DefaultAuthHandler(auth.AuthHandler):
 
         return (auth.REJECT, None)
 
+    def reply_cacheable(self, state):
+        # the result only depends on password and state
+        return True
+
     def on_post_auth(self, user, acct_session):  # pragma: no cover
         return None
 
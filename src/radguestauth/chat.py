@@ -49,6 +49,21 @@ class Chat(object):
         """
         return NotImplemented
 
+    def queued_messages(self):
+        """
+        Returns the number of messages which were passed to send_message but
+        are not transmitted yet. Chats without an own send queue return 0.
+        """
+        return 0
+
+    def counters(self):
+        """
+        Returns counters of the send path as dict, e.g. {'dropped': 2} for
+        messages which were dropped as the outbox was full. Used for the
+        metrics; chats without such counters return an empty dict.
+        """
+        return {}
+
 
 class ChatException(Exception):
     """
@@ -2,36 +2,105 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import logging
+import functools
+
+from threading import Lock, RLock
+
+import radguestauth.metrics as metrics
+
+from radguestauth.command import Failure
 from radguestauth.chats.udp import UdpChat
 from radguestauth.chat import Chat
 from radguestauth.loader import ImplLoader
+from radguestauth.outbox import ChatOutbox
+from radguestauth.commandpool import CommandPool
 from radguestauth.users.storage import UserIdentifier
 from radguestauth.commands.user import (AllowCommand, DenyCommand,
-                                        ListUsersCommand, ManageUserCommand)
+                                        ListUsersCommand, ManageUserCommand,
+                                        parse_request_id)
 from radguestauth.commands.help import HelpCommand
 from radguestauth.commands.password import GeneratePasswordCommand
 
 
+logger = logging.getLogger(__name__)
+
+
+class LockedCalls(object):
+    """
+    Proxy which runs all method calls of an object under a lock. Commands
+    access the UserManager through it with the lock of GuestAuthCore, such
+    that each call is serialized with requests and the ExpiryScheduler, but
+    AuthHandler hooks (e.g. sudo calls) run without holding it.
+    """
+
+    def __init__(self, target, lock):
+        self._target = target
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        lock = self._lock
+
+        @functools.wraps(attr)
+        def locked(*args, **kwargs):
+            with lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
 class ChatController(object):
     """
     Manages command execution on incoming messages, user notification et cetera
+
+    Commands run in a CommandPool. Commands concerning the same guest (OK and
+    NO for the guest's request, MANAGE with the guest's name) run in the
+    order they arrived, other commands (LIST, PASS, HELP) after all earlier
+    ones.
+
+    A message with several lines is a script: the commands run in order and
+    one reply with the results of all lines is sent. If the first line is
+    STRICT, a failing command stops the script.
+
+    Commands use the UserManager under the lock given to the constructor,
+    which is the lock of GuestAuthCore. It is held per UserManager call
+    only, so a slow AuthHandler hook does not delay requests.
     """
 
-    def __init__(self, user_mgr, auth_handler):
+    # first line of a script which stops at the first failing command
+    STRICT_KEYWORD = 'STRICT'
+    QUEUE_FULL_MESSAGE = 'Too many commands waiting, please try again later.'
+
+    def __init__(self, user_mgr, auth_handler, metrics=None, lock=None):
+        """
+        :param lock: re-entrant lock held while the UserManager is used
+        """
         self._chat = None
+        # all messages are sent through the outbox
+        self._outbox = None
+        self._pool = None
         self._user_manager = user_mgr
         self._auth_handler = auth_handler
+        self._metrics = metrics
+        self._lock = lock if lock is not None else RLock()
+        # request IDs which are answered by a queued OK or NO. Taken after
+        # _lock if both are needed.
+        self._claimed = set()
+        self._claim_lock = Lock()
         # keep instance of password command to enable password generation
         # on startup
-        self._pw_command = GeneratePasswordCommand(self._user_manager)
+        commands_user_mgr = LockedCalls(self._user_manager, self._lock)
+        self._pw_command = GeneratePasswordCommand(commands_user_mgr)
         self._commands = dict()
 
         # -- Create an instance of each command here to enable it. --
         known_commands = [
-            AllowCommand(self._user_manager, self._auth_handler),
-            DenyCommand(self._user_manager, self._auth_handler),
-            ListUsersCommand(self._user_manager),
-            ManageUserCommand(self._user_manager, self._auth_handler),
+            AllowCommand(commands_user_mgr, self._auth_handler),
+            DenyCommand(commands_user_mgr, self._auth_handler),
+            ListUsersCommand(commands_user_mgr),
+            ManageUserCommand(commands_user_mgr, self._auth_handler),
             self._pw_command,
             HelpCommand(self._commands),
         ]
@@ -49,38 +118,258 @@ class ChatController(object):
         chat_impl = loader.load(config.get('chat', 'udp'))
         self._chat = chat_impl()
 
+        self._outbox = ChatOutbox(
+            self._chat,
+            int(config.get('chat_outbox_size', ChatOutbox.DEFAULT_MAX_SIZE)),
+            config.get('chat_spool')
+        )
+
+        self._pool = CommandPool(
+            int(config.get('command_workers', CommandPool.DEFAULT_WORKERS)),
+            int(config.get('command_queue_size',
+                           CommandPool.DEFAULT_MAX_QUEUE))
+        )
+        self._pool.start()
+
         self._chat.register_receive(self.receive_callback)
         self._chat.startup(config)
-        self._chat.send_message('Guest Auth module started.')
+        self._outbox.start()
+        self._outbox.send('Guest Auth module started.')
 
         if config.get('generate_password_on_startup') == 'yes':
-            self._chat.send_message(self._pw_command.execute([]))
+            self._outbox.send(self._pw_command.execute([]))
 
     def receive_callback(self, text):
         """
-        Callback method which handles incoming messages.
+        Callback method which handles incoming messages. The command is
+        queued for the CommandPool, its reply is sent when it is done.
 
         :param text: the chat message as string
         """
-        lst = text.replace('\n', '').split(' ')
-        cmd = lst[0]
-        args = lst[1:]
+        lines = [line.strip() for line in text.split('\n')]
+        lines = [line for line in lines if line]
+        if len(lines) > 1:
+            self._receive_script(lines)
+            return
+
+        command_instance, key, args, request_id = self._parse(
+            text.replace('\n', '')
+        )
+        if not command_instance:
+            self._outbox.send('Unknown command: %s' % text)
+            return
+
+        task = functools.partial(self._execute, command_instance, args,
+                                 request_id)
+        if not self._pool.submit(key, task):
+            self._release(request_id)
+            self._outbox.send(self.QUEUE_FULL_MESSAGE)
+
+    def _receive_script(self, lines):
+        """
+        Queues the commands of a message with several lines as one task,
+        which runs after all earlier commands.
+        """
+        strict = lines[0].upper() == self.STRICT_KEYWORD
+        if strict:
+            lines = lines[1:]
+
+        # requests are claimed now, as for single commands, such that
+        # commands sent later do not answer the same ones
+        steps = [(line,) + self._parse(line) for line in lines]
+        task = functools.partial(self._execute_script, steps, strict)
+        if not self._pool.submit(None, task):
+            for step in steps:
+                self._release(step[4])
+            self._outbox.send(self.QUEUE_FULL_MESSAGE)
+
+    def _parse(self, line):
+        """
+        Splits a command line.
+
+        :returns: tuple (command or None if unknown, key, arguments, claimed
+            request ID), see _route
+        """
+        lst = line.split(' ')
+        cmd = lst[0].lower()
+        command_instance = self._commands.get(cmd)
+        if not command_instance:
+            return (None, None, lst[1:], None)
+
+        return (command_instance,) + self._route(cmd, lst[1:])
+
+    def _route(self, cmd, args):
+        """
+        Finds the guest a command concerns, which is the key for the
+        CommandPool.
 
-        command_instance = self._commands.get(cmd.lower())
-        if command_instance:
-            result = command_instance.execute(args)
+        OK and NO without request ID answer the oldest request which is not
+        answered by a queued command yet. Its ID is added to the arguments,
+        such that the command does not depend on when it runs.
+
+        :returns: tuple (key or None, arguments, claimed request ID or None)
+        """
+        if cmd == 'manage' and len(args) >= 2:
+            # see ManageUserCommand for the position of the name
+            user_pos = 1
+            if args[0].lower() == 'allow':
+                user_pos = 4 if args[1] == 'for' else 3
+            return (' '.join(args[user_pos:]), args, None)
+
+        if cmd not in ('ok', 'no'):
+            return (None, args, None)
+
+        if cmd == 'ok':
+            # same rules as AllowCommand
+            has_id = (len(args) >= 3 and args[1] != 'times'
+                      and parse_request_id(args[0]) is not None)
+            can_add_id = len(args) in [2, 3]
         else:
-            result = 'Unknown command: %s' % text
+            has_id = bool(args) and parse_request_id(args[0]) is not None
+            can_add_id = True
+
+        with self._lock, self._claim_lock:
+            for request_id, req in self._user_manager.list_requests():
+                if has_id:
+                    if request_id != parse_request_id(args[0]):
+                        continue
+                elif request_id in self._claimed or not can_add_id:
+                    continue
+                else:
+                    args = [str(request_id)] + args
+                self._claimed.add(request_id)
+                return (req.name, args, request_id)
+
+        # no such request, the command replies with an error
+        return (None, args, None)
+
+    def _release(self, request_id):
+        if request_id is not None:
+            with self._claim_lock:
+                self._claimed.discard(request_id)
+
+    def _run_command(self, command_instance, args, request_id):
+        """
+        Runs a command in a worker of the CommandPool.
+
+        :returns: the result of the command
+        """
+        start = metrics.clock()
+        try:
+            return command_instance.execute(args)
+        except Exception:
+            logger.error('Command %s failed' % command_instance.name(),
+                         exc_info=1)
+            return Failure('Command %s failed.' % command_instance.name())
+        finally:
+            self._release(request_id)
+            if self._metrics is not None:
+                self._metrics.observe_command(command_instance.name().lower(),
+                                              metrics.clock() - start)
+
+    def _execute(self, command_instance, args, request_id):
+        """
+        Runs a command and sends the reply.
+        """
+        result = self._run_command(command_instance, args, request_id)
+        if isinstance(result, list):
+            # long replies, see ListUsersCommand
+            for message in result:
+                self._outbox.send(message)
+        else:
+            self._outbox.send(result)
+
+    def _execute_script(self, steps, strict):
+        """
+        Runs the commands of a script and sends one reply, which repeats
+        each command line followed by its result.
 
-        self._chat.send_message(result)
+        :param steps: tuples (line, command, key, arguments, request ID)
+        :param strict: whether to stop at the first Failure
+        """
+        replies = []
+        for i, step in enumerate(steps):
+            line, command_instance, _, args, request_id = step
+            if command_instance is None:
+                result = Failure('Unknown command.')
+            else:
+                result = self._run_command(command_instance, args, request_id)
+            if isinstance(result, list):
+                result = '\n'.join(result)
+            replies.append('> %s\n%s' % (line, result))
+
+            if strict and isinstance(result, Failure):
+                for step in steps[i + 1:]:
+                    self._release(step[4])
+                replies.append('Stopped, %d commands were not run.'
+                               % (len(steps) - i - 1))
+                break
+
+        self._outbox.send('\n\n'.join(replies))
 
     def notify_join(self, user_id):
         if not isinstance(user_id, UserIdentifier):
             return
 
-        self._chat.send_message('%s wants to join with device %s'
-                                % (user_id.name, user_id.device_id))
+        # already held when called by authorize, but not by the
+        # NotificationRelay
+        with self._lock:
+            known = self._user_manager.find(user_id.name) is not None
+            requests = self._user_manager.list_requests()
+        if not known:
+            message = ('%s wants to join with device %s'
+                       % (user_id.name, user_id.device_id))
+        else:
+            message = ('%s wants to join with another device %s'
+                       % (user_id.name, user_id.device_id))
+        for request_id, req in requests:
+            if req == user_id:
+                message += ' (request %s)' % request_id
+                break
+
+        # returns at once, the chat may be slow
+        self._outbox.send(message)
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued commands are done and all messages were
+        passed to the chat, see ChatOutbox.flush.
+        """
+        if self._outbox is None:
+            return True
+        return self._pool.join(timeout) and self._outbox.flush(timeout)
+
+    def queued_commands(self):
+        """
+        Returns the number of commands waiting for a worker.
+        """
+        if self._pool is None:
+            return 0
+        return self._pool.queued()
+
+    def queued_messages(self):
+        """
+        Returns the number of messages waiting in the outbox or in the chat.
+        """
+        if self._chat is None:
+            return 0
+        return self._outbox.queued_messages() + self._chat.queued_messages()
+
+    def chat_counters(self):
+        """
+        Returns the counters of the chat, see Chat.counters. Messages
+        dropped by the outbox are included.
+        """
+        if self._chat is None:
+            return {}
+        counters = dict(self._chat.counters())
+        if self._outbox.dropped:
+            counters['dropped'] = (counters.get('dropped', 0)
+                                   + self._outbox.dropped)
+        return counters
 
     def stop(self):
-        self._chat.send_message('Guest Auth module is shutting down.')
+        self._pool.stop()
+        self._outbox.send('Guest Auth module is shutting down.')
+        self._outbox.stop()
         self._chat.shutdown()
@@ -2,73 +2,258 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import re
 import socket
+import logging
+import selectors
+from collections import deque
 from threading import Thread, Lock
 
 from radguestauth.chat import Chat
 
 
+logger = logging.getLogger(__name__)
+
+# prefix of a message fragment, e.g. [2/3]
+FRAGMENT_PREFIX = re.compile(rb'\[(\d+)/(\d+)\] ')
+
+
+def split_message(data, mtu):
+    """
+    Splits an encoded message into fragments of at most mtu bytes, each
+    starting with a [i/n] prefix. Fragments end at UTF-8 character
+    boundaries, so each one can be displayed on its own.
+
+    :param data: the message as bytes
+    :param mtu: maximum datagram size, at least UdpChat.MIN_MTU
+    :returns: list of tuples (prefix, part), where part is a memoryview of
+        data
+    """
+    view = memoryview(data)
+    count = 1
+    while True:
+        # the prefix of the last fragment is the longest one
+        payload = mtu - len(b'[%d/%d] ' % (count, count))
+        bounds = []
+        start = 0
+        while start < len(data):
+            end = min(start + payload, len(data))
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                # continuation byte of a UTF-8 sequence
+                end -= 1
+            bounds.append((start, end))
+            start = end
+        if len(bounds) <= count:
+            break
+        count = len(bounds)
+
+    return [(b'[%d/%d] ' % (i, len(bounds)), view[start:end])
+            for i, (start, end) in enumerate(bounds, 1)]
+
+
 class UdpChat(Chat):
     """
     Simple UDP-based chat adapter.
+
+    Each message is sent as one datagram, messages larger than the MTU as
+    several fragments with a [i/n] prefix. Fragmented host messages are
+    reassembled. Messages wait in a bounded outbox: when it is full, the
+    oldest message (or with udp_overflow = drop_new, the new one) is
+    dropped.
+
+    The socket thread sleeps in a selector until a host message arrives or
+    send_message writes to a wake-up socket, so messages leave immediately
+    and an idle chat uses no CPU time.
     """
 
     NET_HOST_IP = '127.0.0.1'
     NET_HOST_PORT = 9999
-    RECV_TIMEOUT = 1
+    # largest UDP datagram
+    RECV_SIZE = 65535
+    DEFAULT_MTU = 1200
+    MIN_MTU = 64
+    DEFAULT_MAX_QUEUE = 100
+    # number of fragments of a host message which are reassembled at most
+    MAX_FRAGMENTS = 64
+
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_DROP_NEW = 'drop_new'
 
     def __init__(self):
         super(UdpChat, self).__init__()
         self._receive = lambda m: None
         self._quit = False
-        self._sendbuf = None
-        self._sendbuf_lock = Lock()
+        self._mtu = self.DEFAULT_MTU
+        self._max_queue = self.DEFAULT_MAX_QUEUE
+        self._drop_new = False
+        # encoded messages, swapped for an empty deque when sending
+        self._outbox = deque()
+        self._outbox_lock = Lock()
+        self._dropped = 0
+        self._fragmented = 0
+        # address -> list of the host message fragments received so far
+        self._partial = dict()
+        # socket pair waking up the thread, created in startup
+        self._wakeup_r = None
+        self._wakeup_w = None
         self._thread = Thread(target=self._socket_thread)
 
     def startup(self, config):
+        self._mtu = max(int(config.get('udp_mtu', self.DEFAULT_MTU)),
+                        self.MIN_MTU)
+        self._max_queue = max(
+            int(config.get('udp_max_queue', self.DEFAULT_MAX_QUEUE)), 1
+        )
+        self._drop_new = (config.get('udp_overflow', self.OVERFLOW_DROP_OLDEST)
+                          == self.OVERFLOW_DROP_NEW)
         if not self._thread.is_alive():
+            self._wakeup_r, self._wakeup_w = socket.socketpair()
+            self._wakeup_r.setblocking(False)
+            self._wakeup_w.setblocking(False)
             self._thread.start()
 
     def send_message(self, message):
-        self._sendbuf_lock.acquire()
-        if not self._sendbuf:
-            self._sendbuf = str(message) + '\n'
-        else:
-            self._sendbuf += '\n' + str(message) + '\n'
-        self._sendbuf_lock.release()
+        data = (str(message) + '\n').encode()
+        with self._outbox_lock:
+            if len(self._outbox) >= self._max_queue:
+                # e.g. no host listening, the socket thread is stuck
+                self._dropped += 1
+                if self._drop_new:
+                    return
+                self._outbox.popleft()
+            self._outbox.append(data)
+            # only the first message of a batch needs to wake the thread
+            if len(self._outbox) == 1:
+                self._wakeup()
+
+    def queued_messages(self):
+        return len(self._outbox)
+
+    def counters(self):
+        return {'dropped': self._dropped, 'fragmented': self._fragmented}
 
     def register_receive(self, receive_hook):
         self._receive = receive_hook
 
     def shutdown(self):
         self._quit = True
-        self._thread.join()
+        if self._thread.is_alive():
+            self._wakeup()
+            self._thread.join()
+
+    def _wakeup(self):
+        if self._wakeup_w is None:
+            # not started yet, the thread sends the outbox on startup
+            return
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            # the pipe is full, which wakes the thread anyway, or closed on
+            # shutdown
+            pass
+
+    def _flush(self, udpsocket):
+        """
+        Sends the messages of the outbox, one datagram (or several fragments)
+        per message.
+        """
+        with self._outbox_lock:
+            messages = self._outbox
+            self._outbox = deque()
+
+        address = (self.NET_HOST_IP, self.NET_HOST_PORT)
+        for data in messages:
+            try:
+                self._send(udpsocket, data, address)
+            except OSError:
+                # e.g. ICMP port unreachable while the host is down
+                self._dropped += 1
+                logger.warning('Failed to send UDP chat message', exc_info=1)
+
+    def _send(self, udpsocket, data, address):
+        if len(data) <= self._mtu:
+            udpsocket.sendto(data, address)
+            return
+
+        self._fragmented += 1
+        for prefix, part in split_message(data, self._mtu):
+            # scatter/gather, the part is not copied
+            udpsocket.sendmsg([prefix, part], [], 0, address)
+
+    def _reassemble(self, data, address):
+        """
+        Collects the fragments of a host message.
+
+        :returns: the complete message, or None if fragments are missing
+        """
+        match = FRAGMENT_PREFIX.match(data)
+        if match is None:
+            return data
+        index, count = int(match.group(1)), int(match.group(2))
+        if not 1 <= index <= count <= self.MAX_FRAGMENTS:
+            # no fragment, just looks like one
+            return data
+
+        parts = self._partial.get(address)
+        if index == 1:
+            parts = self._partial[address] = []
+        elif parts is None or len(parts) != index - 1:
+            # a fragment was lost or reordered
+            self._partial.pop(address, None)
+            logger.warning('Dropped incomplete message from %s' % (address,))
+            return None
+
+        parts.append(data[match.end():])
+        if index < count:
+            return None
+        del self._partial[address]
+        return b''.join(parts)
 
     def _socket_thread(self):
         """
         Worker method running in a separate thread.
 
-        It regularly checks if there is something to send and calls the receive
-        hook when data arrives.
+        It waits for host messages, which are passed to the receive hook, and
+        for wake-ups by send_message or shutdown.
         """
         udpsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udpsocket.settimeout(self.RECV_TIMEOUT)
+        selector = selectors.DefaultSelector()
+        selector.register(udpsocket, selectors.EVENT_READ)
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
 
+        # messages sent before startup
+        ready = [(selector.get_key(self._wakeup_r), selectors.EVENT_READ)]
         while not self._quit:
-            try:
-                # Send data and clear send buffer afterwards.
-                self._sendbuf_lock.acquire()
-                if self._sendbuf:
-                    udpsocket.sendto(self._sendbuf.encode(),
-                                     (self.NET_HOST_IP, self.NET_HOST_PORT))
-                    self._sendbuf = None
-                self._sendbuf_lock.release()
-
-                host_reply = udpsocket.recv(1024)
-                # if nothing was received in the current timeframe, the
-                # exception was thrown.
-                # Otherwise, call the receive hook.
-                if host_reply:
-                    self._receive(host_reply.decode())
-            except socket.timeout:
+            for key, _ in ready:
+                try:
+                    if key.fileobj is self._wakeup_r:
+                        self._drain_wakeup()
+                        self._flush(udpsocket)
+                    else:
+                        self._handle_reply(udpsocket)
+                except OSError:
+                    # e.g. a pending ICMP port unreachable error
+                    logger.warning('UDP chat socket error', exc_info=1)
+            ready = selector.select()
+
+        selector.close()
+        udpsocket.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
                 pass
+        except BlockingIOError:
+            pass
+
+    def _handle_reply(self, udpsocket):
+        data, address = udpsocket.recvfrom(self.RECV_SIZE)
+        message = self._reassemble(data, address)
+        if not message:
+            return
+        try:
+            self._receive(message.decode('utf-8', 'replace'))
+        except Exception:
+            logger.error('Failed to handle host message', exc_info=1)
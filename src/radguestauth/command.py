@@ -5,6 +5,15 @@
 from abc import ABCMeta, abstractmethod
 
 
+class Failure(str):
+    """
+    Reply of a command which did not change anything, e.g. because of invalid
+    arguments. It is sent like any other message; in a script in strict mode,
+    the ChatController does not run the following commands.
+    """
+    __slots__ = ()
+
+
 class Command(object):
     """
     Defines a command which can be called by the ChatController
@@ -30,7 +39,9 @@ class Command(object):
         Execute the command.
 
         :param argv: List of argument strings
-        :returns: Result as String to be sent to the user
+        :returns: Result as String to be sent to the user, or a list of
+            Strings which are sent as separate messages. Errors are returned
+            as Failure.
         """
         return NotImplemented
 
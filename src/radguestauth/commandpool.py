@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+
+from threading import Thread, Condition
+
+
+logger = logging.getLogger(__name__)
+
+
+class CommandPool(object):
+    """
+    Runs chat commands in worker threads, such that a slow command (e.g. an
+    AuthHandler hook calling sudo) does not hold up the chat.
+
+    Each task has a key, usually the name of the guest it concerns. Tasks
+    with the same key run one after another in the order they were
+    submitted, tasks with different keys in parallel. Tasks with the key
+    None (e.g. LIST) wait for all earlier tasks and run alone, so they see
+    the effect of all commands sent before.
+    """
+
+    DEFAULT_WORKERS = 4
+    DEFAULT_MAX_QUEUE = 100
+    # seconds stop() waits for queued tasks
+    STOP_TIMEOUT = 5
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_queue=DEFAULT_MAX_QUEUE):
+        self._max_queue = max_queue
+        # (key, function) tuples in the order of submit calls
+        self._pending = []
+        # keys of the running tasks
+        self._running_keys = set()
+        self._running = 0
+        # a task with key None is running
+        self._exclusive = False
+        self._quit = False
+        self._cond = Condition()
+        self._threads = [Thread(target=self._run, daemon=True)
+                         for _ in range(max(workers, 1))]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Waits up to timeout seconds for the queued tasks, drops the remaining
+        ones and stops the workers.
+        """
+        if not self.join(timeout):
+            logger.warning('%d chat commands were not run'
+                           % len(self._pending))
+        with self._cond:
+            self._pending = []
+            self._quit = True
+            self._cond.notify_all()
+
+    def submit(self, key, func):
+        """
+        Queues a function without arguments.
+
+        :returns: False if the queue is full
+        """
+        with self._cond:
+            if self._quit or len(self._pending) >= self._max_queue:
+                return False
+            self._pending.append((key, func))
+            self._cond.notify_all()
+            return True
+
+    def join(self, timeout=None):
+        """
+        Waits until all queued tasks are done.
+
+        :returns: False if the timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._running, timeout
+            )
+
+    def queued(self):
+        """
+        Returns the number of tasks waiting for a worker.
+        """
+        return len(self._pending)
+
+    def _take(self):
+        """
+        Removes the first task which may run now from the queue. Called with
+        the lock held.
+
+        :returns: the (key, function) tuple, or None
+        """
+        if self._exclusive:
+            return None
+        for i, (key, func) in enumerate(self._pending):
+            if key is None:
+                # later tasks must not overtake it
+                if i > 0 or self._running:
+                    return None
+                self._exclusive = True
+            elif key in self._running_keys:
+                # so are all later tasks with this key
+                continue
+            else:
+                self._running_keys.add(key)
+            del self._pending[i]
+            return (key, func)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                task = self._take()
+                while task is None:
+                    if self._quit:
+                        return
+                    self._cond.wait()
+                    task = self._take()
+                self._running += 1
+
+            key, func = task
+            try:
+                func()
+            except Exception:
+                logger.error('Chat command failed', exc_info=1)
+
+            with self._cond:
+                self._running -= 1
+                if key is None:
+                    self._exclusive = False
+                else:
+                    self._running_keys.discard(key)
+                self._cond.notify_all()
@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from radguestauth.command import Command
+from radguestauth.command import Command, Failure
 
 
 class HelpCommand(Command):
@@ -21,7 +21,7 @@ class HelpCommand(Command):
         return 'HELP'
 
     def execute(self, argv):
-        output = self.usage()
+        output = Failure(self.usage())
         arglen = len(argv)
 
         if arglen == 0:
@@ -36,7 +36,7 @@ class HelpCommand(Command):
             if cmd:
                 output = HelpCommand._fmt(cmd) + cmd.usage()
             else:
-                output = 'Unknown command.'
+                output = Failure('Unknown command.')
 
         return output
 
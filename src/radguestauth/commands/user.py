@@ -7,7 +7,7 @@ import functools
 
 from abc import ABCMeta
 
-from radguestauth.command import Command
+from radguestauth.command import Command, Failure
 from radguestauth.users.storage import UserData, UserIdentifier
 
 
@@ -22,6 +22,38 @@ def build_answer(base, optional):
     return '%s' % base
 
 
+def parse_request_id(arg):
+    """
+    Converts a request ID argument (as shown by LIST) to an integer.
+
+    :returns: the ID, or None if arg is not numeric
+    """
+    if arg.isnumeric():
+        return int(arg)
+
+    return None
+
+
+def get_request_or_message(user_mgr, request_id):
+    """
+    Looks up a pending request for the OK and NO commands.
+
+    :param request_id: ID of the request, or None for the oldest one
+    :returns: the UserIdentifier of the request, or a message string if no
+        valid request was found
+    """
+    if not user_mgr.is_request_pending():
+        return Failure('No request pending.')
+
+    req = user_mgr.get_request(request_id)
+    if req is None and request_id is not None:
+        return Failure('No request with ID %s.' % request_id)
+    if not isinstance(req, UserIdentifier):
+        return Failure('Invalid request in UserManager')
+
+    return req
+
+
 class UserModifyingCommand(Command):
     """
     Common base class for commands which modify user data (allow and modify).
@@ -43,7 +75,7 @@ class UserModifyingCommand(Command):
         :returns: In case the command was correct: a tuple (int, boolean) with
             the int being either the join count (boolean is true) or the hours
             (boolean is false). If the command was incorrect, a help message
-            as string is returned.
+            is returned as Failure.
         """
         n = None
         count_mode = False
@@ -55,9 +87,10 @@ class UserModifyingCommand(Command):
             n = int(argv[1])
 
             if n > self.MAX_HOURS:
-                return 'No more than %s hours are possible' % self.MAX_HOURS
+                return Failure('No more than %s hours are possible'
+                               % self.MAX_HOURS)
         else:
-            return self.usage()
+            return Failure(self.usage())
 
         return (n, count_mode)
 
@@ -71,7 +104,7 @@ class UserModifyingCommand(Command):
         :return: String to be sent to the host
         """
         if not isinstance(parse_tuple, tuple):
-            return 'No update, parsing problem'
+            return Failure('No update, parsing problem')
 
         n = parse_tuple[0]
         count_mode = parse_tuple[1]
@@ -103,36 +136,43 @@ class AllowCommand(UserModifyingCommand):
         return 'OK'
 
     def execute(self, argv):
+        # The request ID is optional, e.g. OK 3 times vs. OK 2 3 times
+        request_id = None
+        if len(argv) >= 3 and argv[1] != 'times':
+            request_id = parse_request_id(argv[0])
+            if request_id is not None:
+                argv = argv[1:]
+
         if len(argv) not in [2, 3]:
-            return self.usage()
+            return Failure(self.usage())
 
         parsed = self._parse_modify(argv)
 
         if not isinstance(parsed, tuple):
             return parsed
 
-        if not self._user_manager.is_request_pending():
-            return 'No request pending.'
-
-        req = self._user_manager.get_request()
+        req = get_request_or_message(self._user_manager, request_id)
         if not isinstance(req, UserIdentifier):
-            return 'Invalid request in UserManager'
+            return req
 
         req.user_data = UserData()
         message = self._update_with_parse_tuple(req, parsed)
 
-        self._user_manager.finish_request()
+        self._user_manager.finish_request(request_id)
 
         return message
 
     def usage(self):
         base = super(AllowCommand, self).usage()
-        return (base + ' [count | time]\n\n'
+        return (base + ' [id] [count | time]\n\n'
                 + 'where count ::= <n> times\n'
                 + 'time ::= for <t> h\n\n'
                 + 'Examples:\n'
                 + 'OK 10 times\n'
-                + 'OK for 3 h')
+                + 'OK for 3 h\n'
+                + 'OK 2 for 3 h\n\n'
+                + 'Without id, the oldest pending request is answered. '
+                + 'LIST shows the ids of all pending requests.')
 
 
 class DenyCommand(Command):
@@ -148,27 +188,39 @@ class DenyCommand(Command):
         return 'NO'
 
     def execute(self, argv):
-        if not self._user_manager.is_request_pending():
-            return 'No request pending.'
-
-        req = self._user_manager.get_request()
+        # other arguments than a request ID are ignored
+        request_id = parse_request_id(argv[0]) if argv else None
+        req = get_request_or_message(self._user_manager, request_id)
         if not isinstance(req, UserIdentifier):
-            return 'Invalid request in UserManager'
+            return req
 
         req.user_data = UserData()
         req.user_data.join_state = UserData.JOIN_STATE_BLOCKED
         self._user_manager.update(req)
-        self._user_manager.finish_request()
+        self._user_manager.finish_request(request_id)
 
         message = self._auth_handler.on_host_deny(req)
         return build_answer('User denied.', message)
 
+    def usage(self):
+        base = super(DenyCommand, self).usage()
+        return (base + ' [id]\n\n'
+                + 'Without id, the oldest pending request is denied.')
+
 
 class ListUsersCommand(Command):
     """
-    List known users.
+    List known users, one page at a time.
     """
 
+    # users per page
+    PAGE_SIZE = 20
+    # users whose validity time ends within this many seconds are expiring
+    EXPIRING_SECONDS = 3600
+    # upper bound for the size of each reply message in bytes, below the
+    # 1024 bytes read by the UDP chat
+    MAX_MESSAGE_SIZE = 1000
+
     def __init__(self, user_mgr):
         self._user_manager = user_mgr
 
@@ -178,25 +230,139 @@ class ListUsersCommand(Command):
                 and user.user_data.join_state == UserData.JOIN_STATE_BLOCKED):
             blockstr = ' [blocked]'
 
-        return '%s (device %s)%s\n' % (user.name, user.device_id, blockstr)
+        return '%s (device %s)%s' % (user.name, user.device_id, blockstr)
+
+    @staticmethod
+    def _has_state(device, join_state):
+        return (isinstance(device.user_data, UserData)
+                and device.user_data.join_state == join_state)
+
+    def _expiring_page(self, page):
+        """
+        Returns the devices of one page whose time ends soon, ordered by
+        the end of their validity time.
+
+        :returns: tuple (devices, number of devices)
+        """
+        devices = [
+            d for d in self._user_manager.get_expiring_within(
+                self.EXPIRING_SECONDS
+            )
+            if not self._has_state(d, UserData.JOIN_STATE_BLOCKED)
+        ]
+        first = (page - 1) * self.PAGE_SIZE
+        return (devices[first:first + self.PAGE_SIZE], len(devices))
+
+    def _filtered_page(self, join_state, page):
+        """
+        Returns the devices of one page having a join state, which needs a
+        walk over all users.
+
+        :returns: tuple (devices, number of users)
+        """
+        first = (page - 1) * self.PAGE_SIZE
+        devices = []
+        count = 0
+        for user in self._user_manager.list_users():
+            matching = [d for d in self._user_manager.list_devices(user.name)
+                        if self._has_state(d, join_state)]
+            if matching:
+                if first <= count < first + self.PAGE_SIZE:
+                    devices.extend(matching)
+                count += 1
+
+        return (devices, count)
+
+    def _prefix_page(self, prefix, page):
+        """
+        Returns the devices of one page of users with the name prefix.
+
+        :returns: tuple (devices, number of users)
+        """
+        users = self._user_manager.list_users(
+            prefix, (page - 1) * self.PAGE_SIZE, self.PAGE_SIZE
+        )
+        devices = []
+        for user in users:
+            devices.extend(self._user_manager.list_devices(user.name))
+
+        return (devices, self._user_manager.count_users(prefix))
+
+    def _split(self, lines):
+        """
+        Joins lines to messages of at most MAX_MESSAGE_SIZE bytes. Longer
+        lines are sent as separate message.
+        """
+        message = []
+        size = 0
+        for line in lines:
+            line_size = len(line.encode()) + 1
+            if message and size + line_size > self.MAX_MESSAGE_SIZE:
+                yield '\n'.join(message)
+                message = []
+                size = 0
+            message.append(line)
+            size += line_size
+
+        if message:
+            yield '\n'.join(message)
 
     def name(self):
         return 'LIST'
 
     def execute(self, argv):
-        result = ''
-        if self._user_manager.is_request_pending():
-            req_user = self._user_manager.get_request()
-            result += ('There is an ongoing request for %s.\n'
-                       % self._get_user_line(req_user))
-            result += 'Use OK or NO to decide about this user.\n'
-            result += 'Until then, only allowed users may join.\n\n'
+        page = 1
+        if argv and argv[0].isnumeric():
+            page = max(int(argv[0]), 1)
+            argv = argv[1:]
+        # the filter is a keyword or a name prefix, which may contain spaces
+        name_filter = ' '.join(argv)
+
+        lines = []
+        requests = self._user_manager.list_requests()
+        if requests and page == 1 and not name_filter:
+            lines.append('Pending requests:')
+            for request_id, req_user in requests:
+                lines.append('* [%s] %s' % (request_id,
+                                            self._get_user_line(req_user)))
+            lines.append('Use OK <id> or NO <id> to decide about these users, '
+                         'without id the first one is answered.')
+            lines.append('')
+
+        keyword = name_filter.lower()
+        if keyword == 'expiring':
+            devices, count = self._expiring_page(page)
+        elif keyword == 'blocked':
+            devices, count = self._filtered_page(UserData.JOIN_STATE_BLOCKED,
+                                                 page)
+        elif keyword == 'allowed':
+            devices, count = self._filtered_page(UserData.JOIN_STATE_ALLOWED,
+                                                 page)
+        else:
+            devices, count = self._prefix_page(name_filter, page)
 
-        result += 'Known users:\n'
-        for u in self._user_manager.list_users():
-            result += '* %s\n' % self._get_user_line(u)
+        pages = max((count + self.PAGE_SIZE - 1) // self.PAGE_SIZE, 1)
+        lines.append('Known users (page %d of %d):' % (page, pages))
+        lines.extend('* %s' % self._get_user_line(d) for d in devices)
+        if page < pages:
+            lines.append('LIST %s shows the next page.'
+                         % ' '.join([str(page + 1)] + argv))
 
-        return result
+        return list(self._split(lines))
+
+    def usage(self):
+        base = super(ListUsersCommand, self).usage()
+        return (base + ' [page] [filter]\n\n'
+                + 'where filter ::= blocked | allowed | expiring '
+                + '| <prefix>\n\n'
+                + 'Examples:\n'
+                + 'LIST 2\n'
+                + 'LIST expiring\n'
+                + 'LIST bo\n\n'
+                + 'Lists %d users per page in name order. expiring shows the '
+                % self.PAGE_SIZE
+                + 'users whose time ends within the next hour, a prefix '
+                + 'the users whose name starts with it.')
 
 
 class ManageUserCommand(UserModifyingCommand):
@@ -277,11 +443,16 @@ class ManageUserCommand(UserModifyingCommand):
             if action:
                 # get username as one string again
                 username = ' '.join(argv[user_pos:])
-                user_id = self._user_manager.find(username)
-                if not user_id:
-                    return 'Unknown user'
-
-                result = action(user_id)
+                if not self._user_manager.find(username):
+                    return Failure('Unknown user')
+
+                # the action applies to all devices of the user
+                results = []
+                for user_id in self._user_manager.list_devices(username):
+                    answer = action(user_id)
+                    if answer not in results:
+                        results.append(answer)
+                result = '\n\n'.join(results)
                 if return_text:
                     return return_text
                 # use value returned by action if no text was set for the
@@ -289,7 +460,7 @@ class ManageUserCommand(UserModifyingCommand):
                 return result
 
         # default fall-through
-        return self.usage()
+        return Failure(self.usage())
 
     def usage(self):
         base = super(ManageUserCommand, self).usage()
@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import configparser
+
+
+def load_config(path=None):
+    """
+    Reads the radguestauth INI config. The format is independent from the
+    server framework, such that all entry points (gunicorn hooks, the Flask
+    app) use the same values.
+
+    :param path: Path to the INI file. If None, the environment variable
+        RADGUESTAUTH_CONFIG is used.
+    :returns: dict with the items of the [radguestauth] section, or a
+        default config if no file is given.
+    """
+    # Default config:
+    guestauth_cfg = {'chat': 'udp'}
+
+    confpath = path or os.environ.get('RADGUESTAUTH_CONFIG')
+    if confpath:
+        cparser = configparser.ConfigParser()
+        cparser.read(confpath)
+        if 'radguestauth' in cparser.sections():
+            guestauth_cfg = dict(cparser['radguestauth'])
+
+    return guestauth_cfg
@@ -4,10 +4,21 @@
 
 import time
 import logging
+
+from threading import RLock
+
 import radguestauth.auth as auth
+import radguestauth.metrics as metrics
+import radguestauth.users.bulk as bulk
+import radguestauth.users.shared as shared
 from radguestauth.users.usermanager import UserManager
 from radguestauth.users.storage import UserIdentifier, UserData
+from radguestauth.userstorage import UserStorage, storage_name
+from radguestauth.userstorages.memory import MemoryUserStorage
 from radguestauth.chatctl import ChatController
+from radguestauth.replycache import ReplyCache
+from radguestauth.eapsessions import EapSessionTable
+from radguestauth.expiry import ExpiryScheduler
 from radguestauth.authhandlers.default import DefaultAuthHandler
 from radguestauth.loader import ImplLoader
 
@@ -18,6 +29,12 @@ EAP_TYPE_MS_EAP_AUTH = 26
 EAP_TYPE_MSCHAP_2 = 29
 EAP_TYPE_PWD = 52
 
+# FreeRADIUS request attributes read in authorize and post_auth
+REQUEST_ATTRIBUTES = frozenset([
+    'User-Name', 'Calling-Station-Id', 'Acct-Session-Id', 'EAP-Message',
+    'FreeRADIUS-Proxied-To', 'NAS-IP-Address'
+])
+
 
 logger = logging.getLogger(__name__)
 
@@ -25,13 +42,27 @@ logger = logging.getLogger(__name__)
 class GuestAuthCore(object):
     def __init__(self):
         self._user_manager = UserManager()
+        # UserStorage providing the UserManager, loaded in startup()
+        self._storage = None
         self._config = dict()
         # AuthHandler and ChatController get dynamically loaded in startup()
         self._auth_handler = None
         self._chat_controller = None
-        self._last_device = None
-        self._last_session = None
-        self._last_request_eap_pwd = False
+        # handler results of known users, only used with a local UserManager
+        self._reply_cache = None
+        # expires users at their valid_until time, local UserManager only
+        self._expiry = None
+        # set when the user state is shared with other processes
+        self._state = None
+        self._chat_ownership = None
+        self._relay = None
+        self._metrics = metrics.Metrics()
+        # attributes of outer EAP-PWD requests, see authorize
+        self._eap_sessions = EapSessionTable()
+        # Held while the user state is read and changed. Requests, chat
+        # commands and the ExpiryScheduler run in different threads, and
+        # their changes consist of several UserManager calls.
+        self._lock = RLock()
 
     @staticmethod
     def get_eap_type(items_dict):
@@ -68,6 +99,44 @@ class GuestAuthCore(object):
             EAP_TYPE_PWD
         ]
 
+    @staticmethod
+    def skip_request(items_dict):
+        """
+        Indicates whether authorize answers the request with NO_OP, based on
+        the EAP attributes.
+
+        :returns: True if the request should be skipped
+        """
+        keys = items_dict.keys()
+        if 'EAP-Message' in keys and 'FreeRADIUS-Proxied-To' not in keys:
+            # skip outer EAP requests
+            return True
+
+        # EAP methods may use multiple inner messages.
+        # Skip all messages except the ones specifying the authentication
+        # method (such as PEAP or MSCHAPv2).
+        return ('FreeRADIUS-Proxied-To' in keys
+                and GuestAuthCore.skip_eap_message(items_dict))
+
+    def can_skip(self, items):
+        """
+        Checks if authorize would return NO_OP for the request without
+        changing any state, such that the call can be omitted.
+
+        :param items: dict of request attributes. User-Name, EAP-Message,
+            FreeRADIUS-Proxied-To and Calling-Station-Id are sufficient.
+        :returns: True if the request does not need to be processed
+        """
+        # EAP-PWD requests have to be processed, as attributes are
+        # remembered or restored (see authorize)
+        if GuestAuthCore.get_eap_type(items) == EAP_TYPE_PWD:
+            return False
+        if (not items.get('Calling-Station-Id')
+                and self._eap_sessions.pending(items.get('User-Name'))):
+            return False
+
+        return GuestAuthCore.skip_request(items)
+
     def _add_post_auth_session_timeout(self, user_id, post_auth_dict):
         """
         Adds the Session-Timeout attribute to a dict prepared by the
@@ -80,7 +149,8 @@ class GuestAuthCore(object):
         :returns: None if post_auth_dict was none, otherwise the given dict
             with the timeout attribute added.
         """
-        stored_user = self._user_manager.find(user_id.name)
+        stored_user = self._user_manager.find_device(user_id.name,
+                                                     user_id.device_id)
 
         if (stored_user == user_id and stored_user.user_data
                 and stored_user.user_data.valid_until):
@@ -98,90 +168,222 @@ class GuestAuthCore(object):
 
         return post_auth_dict
 
+    def _acquire_chat(self):
+        """
+        Decides whether this process owns the chat, if the users are shared
+        with other processes.
+
+        :returns: True if the ChatController should be started here
+        """
+        self._chat_ownership = shared.ChatOwnership(
+            self._config.get('chat_lock', shared.DEFAULT_CHAT_LOCK)
+        )
+
+        return self._chat_ownership.acquire()
+
+    @property
+    def metrics(self):
+        """
+        The Metrics instance where requests handled by this core are recorded.
+        """
+        return self._metrics
+
+    def _register_gauges(self):
+        self._metrics.add_gauge('radguestauth_users', 'Known users.',
+                                self._user_manager.count_users)
+        self._metrics.add_gauge(
+            'radguestauth_blocked_users', 'Known users with a blocked '
+            'device.', self._user_manager.count_blocked
+        )
+        self._metrics.add_gauge(
+            'radguestauth_pending_requests', 'Join requests waiting for the '
+            'host.', lambda: int(self._user_manager.is_request_pending())
+        )
+        self._metrics.add_gauge(
+            'radguestauth_chat_outbox', 'Chat messages waiting to be sent.',
+            lambda: self._chat_controller.queued_messages()
+        )
+        self._metrics.add_gauge(
+            'radguestauth_command_queue', 'Chat commands waiting for a '
+            'worker.', lambda: self._chat_controller.queued_commands()
+        )
+        self._metrics.add_counter(
+            'radguestauth_chat_dropped_total', 'Chat messages dropped as the '
+            'outbox was full or sending failed.',
+            lambda: self._chat_controller.chat_counters().get('dropped', 0)
+        )
+        self._metrics.add_counter(
+            'radguestauth_chat_fragmented_total', 'Chat messages sent in '
+            'several fragments.',
+            lambda: self._chat_controller.chat_counters().get('fragmented', 0)
+        )
+
+    def required_attributes(self):
+        """
+        Returns the names of all request attributes which are needed by the
+        core and the loaded AuthHandler.
+        """
+        return REQUEST_ATTRIBUTES | set(
+            self._auth_handler.required_attributes()
+        )
+
+    def _max_pending(self):
+        return int(self._config.get('max_pending_requests',
+                                    UserManager.DEFAULT_MAX_PENDING))
+
     def startup(self, config):
         self._config = config
+        self._eap_sessions = EapSessionTable(
+            int(config.get('eap_sessions_max',
+                           EapSessionTable.DEFAULT_MAX_ENTRIES)),
+            float(config.get('eap_session_ttl', EapSessionTable.DEFAULT_TTL))
+        )
+        # Dynamically load UserStorage
+        storage_loader = ImplLoader(UserStorage, MemoryUserStorage)
+        storage_impl = storage_loader.load(storage_name(config))
+        self._storage = storage_impl()
+        self._user_manager = self._storage.open(config, self._max_pending())
+        self._state = self._storage.shared_state()
+        owns_chat = True
+        if self._state:
+            owns_chat = self._acquire_chat()
+        self._user_manager.set_device_limits(
+            int(config.get('max_devices', UserManager.DEFAULT_MAX_DEVICES)),
+            config.get('device_approval', 'device') == 'user'
+        )
+
         # Dynamically load AuthHandler
         auth_loader = ImplLoader(auth.AuthHandler, DefaultAuthHandler)
         auth_impl = auth_loader.load(config.get('auth_handler',
                                                 'Default'))
         self._auth_handler = auth_impl()
         self._auth_handler.start(self._config)
-        # Initialize ChatController
-        self._chat_controller = ChatController(self._user_manager,
-                                               self._auth_handler)
-        self._chat_controller.start(self._config)
+
+        # Changes in the shared state are not visible to listeners of this
+        # process, so replies are only cached with a local UserManager.
+        if not self._state:
+            self._reply_cache = ReplyCache()
+            self._user_manager.add_listener(self._reply_cache.on_user_change)
+
+            if config.get('expiry_scheduler', 'yes') == 'yes':
+                self._expiry = ExpiryScheduler(self._expire_user)
+                self._user_manager.add_listener(self._expiry.on_user_change)
+                for user in self._user_manager.list_users():
+                    for device in self._user_manager.list_devices(user.name):
+                        self._expiry.on_user_change(UserManager.EVENT_UPDATE,
+                                                    device)
+                self._expiry.start()
+
+        if owns_chat:
+            # Initialize ChatController
+            self._chat_controller = ChatController(self._user_manager,
+                                                   self._auth_handler,
+                                                   metrics=self._metrics,
+                                                   lock=self._lock)
+            self._chat_controller.start(self._config)
+            if self._state:
+                # forward join notifications of the other workers
+                self._relay = shared.NotificationRelay(
+                    self._state.outbox(), self._chat_controller
+                )
+                self._relay.start()
+        else:
+            logger.info('Chat is owned by another worker.')
+            self._chat_controller = shared.ChatRelay(self._state.outbox())
+
+        self._register_gauges()
         logger.info('radguestauth core started.')
 
     def authorize(self, items):
+        stats = self._metrics
+        start = metrics.clock()
         username = items.get('User-Name')
         calling_id = items.get('Calling-Station-Id')
         acct_session = items.get('Acct-Session-Id', '')
-        keys = items.keys()
 
         # remember attributes for EAP-PWD requests, as the inner tunnel value
         # has only the username set.
         if GuestAuthCore.get_eap_type(items) == EAP_TYPE_PWD:
-            # EAP-PWD: set flag for following inner request
-            self._last_request_eap_pwd = True
-            self._last_device = calling_id
-            self._last_session = acct_session
-        elif self._last_request_eap_pwd and not calling_id:
-            # EAP-PWD inner request: restore attributes from previous request
-            calling_id = self._last_device
-            acct_session = self._last_session
-            self._last_device = None
-            self._last_session = None
-
-        if 'EAP-Message' in keys and 'FreeRADIUS-Proxied-To' not in keys:
-            # skip outer EAP requests
-            return (auth.NO_OP, None)
-
-        if ('FreeRADIUS-Proxied-To' in keys
-                and GuestAuthCore.skip_eap_message(items)):
-            # EAP methods may use multiple inner messages.
-            # Skip all messages except the ones specifying the authentication
-            # method (such as PEAP or MSCHAPv2).
+            # EAP-PWD: store attributes for the following inner request
+            self._eap_sessions.put(username, items.get('NAS-IP-Address'),
+                                   calling_id, acct_session)
+        elif not calling_id:
+            # EAP-PWD inner request: restore attributes of the outer request
+            stored = self._eap_sessions.take(username,
+                                             items.get('NAS-IP-Address'))
+            if stored is not None:
+                calling_id, acct_session = stored
+
+        skip = GuestAuthCore.skip_request(items)
+        start = stats.stage_done(metrics.STAGE_EAP, start)
+        if skip:
             return (auth.NO_OP, None)
 
         if username and calling_id:
-            # reset EAP-PWD flag
-            self._last_request_eap_pwd = False
-            user_id = UserIdentifier(username, calling_id)
-            state = self._user_manager.may_join(user_id)
-
-            if state == UserData.JOIN_STATE_ALLOWED:
-                # look up full user object with data
-                user_id = self._user_manager.find(username)
-                logger.debug('authorize called for user %s (ALLOWED)'
-                             % username)
-            elif state == UserData.JOIN_STATE_WAITING:
-                # The user is the request user. Load the request to get the
-                # password
-                user_id = self._user_manager.get_request()
-            elif state == UserData.JOIN_STATE_NEW:
-                # always reject if another request is pending
-                if self._user_manager.is_request_pending():
-                    logger.info('Rejecting new user %s due to pending request'
-                                % username)
-                    return (auth.REJECT, None)
-                # add request and notify host if successful
-                if self._user_manager.add_request(user_id):
-                    self._chat_controller.notify_join(user_id)
-                    # load request user object with password attribute set
-                    user_id = self._user_manager.get_request()
-                    # state changes to WAITING now.
-                    state = UserData.JOIN_STATE_WAITING
-                else:
-                    logger.warn('Failed to add request for %s', username)
-                    # reject user without calling handler if something went
-                    # wrong.
-                    return (auth.REJECT, None)
-
-            return self._auth_handler.handle_user_state(user_id, state,
-                                                        acct_session)
+            with self._lock:
+                return self._authorize_user(
+                    UserIdentifier(username, calling_id), acct_session, start
+                )
 
         return (auth.REJECT, None)
 
+    def _authorize_user(self, user_id, acct_session, start):
+        """
+        Decides about a request with user name and device, called with the
+        lock held.
+        """
+        stats = self._metrics
+        username = user_id.name
+        calling_id = user_id.device_id
+        # a single call, as the user state may be in another process
+        state, user_id, added = self._user_manager.admit(user_id)
+        start = stats.stage_done(metrics.STAGE_MAY_JOIN, start)
+
+        if user_id is None:
+            # reject user without calling handler if the queue is full or
+            # something went wrong.
+            logger.info('Rejecting new user %s, no request could be added'
+                        % username)
+            return (auth.REJECT, None)
+        if added:
+            # notify host about the new request
+            notify_start = metrics.clock()
+            self._chat_controller.notify_join(user_id)
+            stats.stage_done(metrics.STAGE_NOTIFY, notify_start)
+        elif state == UserData.JOIN_STATE_ALLOWED:
+            logger.debug('authorize called for user %s (ALLOWED)'
+                         % username)
+
+        cache = self._reply_cache
+        if cache is not None:
+            cached = cache.get(username, state, calling_id)
+            if cached is not None:
+                return cached
+            generation = cache.generation
+
+        start = metrics.clock()
+        result = self._auth_handler.handle_user_state(user_id, state,
+                                                      acct_session)
+        stats.stage_done(metrics.STAGE_HANDLER, start)
+        if (cache is not None
+                and self._auth_handler.reply_cacheable(state)):
+            result = cache.put(username, state, result, generation,
+                               calling_id)
+
+        return result
+
+    def authorize_many(self, items_list):
+        """
+        Evaluates several authorize requests in the given order, e.g. to
+        replay captured RADIUS traffic. The requests go through the same
+        state as single authorize calls (including the EAP-PWD attribute
+        correlation), so each result equals the one of a sequential call.
+
+        :param items_list: iterable of request attribute dicts
+        :returns: list of authorize results in the same order
+        """
+        return [self.authorize(items) for items in items_list]
+
     def post_auth(self, items):
         username = items.get('User-Name')
         calling_id = items.get('Calling-Station-Id')
@@ -189,14 +391,40 @@ class GuestAuthCore(object):
             user_id = UserIdentifier(username, calling_id)
             acct_session = items.get('Acct-Session-Id', '')
 
-            data = self._auth_handler.on_post_auth(user_id, acct_session)
-            return self._add_post_auth_session_timeout(user_id, data)
+            with self._lock:
+                data = self._auth_handler.on_post_auth(user_id, acct_session)
+                return self._add_post_auth_session_timeout(user_id, data)
 
         return None
 
+    def _expire_user(self, key, valid_until):
+        """
+        Called by the ExpiryScheduler when the valid_until time of a user's
+        device is reached.
+
+        The user is removed under the lock, the AuthHandler (which may run
+        slow commands) is notified after releasing it.
+
+        :param key: tuple (user name, device ID)
+        """
+        username, device_id = key
+        with self._lock:
+            user = self._user_manager.find_device(username, device_id)
+            # the user might have been changed in the meantime
+            if (user is None or not user.user_data
+                    or user.user_data.valid_until != valid_until
+                    or not user.check_expired()):
+                return
+
+            self._user_manager.remove(user)
+        self._auth_handler.on_host_deny(user)
+        logger.info('User %s expired' % username)
+
     def drop_expired_users(self):
         """
-        This is intended to be called e.g. via a nightly cron job.
+        This is intended to be called e.g. via a nightly cron job. Users with
+        a valid_until time are already dropped by the ExpiryScheduler, unless
+        it is disabled or the user state is shared.
 
         Usually, users get disconnected via session timeout or if the login
         number is exceeded. However, the entries in the UserManager and
@@ -207,24 +435,77 @@ class GuestAuthCore(object):
         a later time, removing old entries regularly makes it easier for the
         host to keep track of current guests.
 
-        To avoid long-standing requests, the request also gets removed.
+        To avoid long-standing requests, pending requests also get removed.
         """
-        expired = self._user_manager.get_expired_users()
+        with self._lock:
+            expired, requests = self._drop_expired_users()
+
+        # call AuthHandler such that the users get disconnected if needed,
+        # without holding the lock
         for user in expired:
-            # call AuthHandler such that the user gets disconnected if needed
             self._auth_handler.on_host_deny(user)
-            self._user_manager.remove(user)
             logger.info('Dropped expired user %s' % user.name)
+        for request in requests:
+            self._auth_handler.on_host_deny(request)
+            logger.info('Removed ongoing request of %s during '
+                        'drop_expired_users' % request.name)
+
+    def _drop_expired_users(self):
+        """
+        Removes the expired users and the pending requests, called with the
+        lock held.
+
+        :returns: tuple (list of removed users, list of removed requests)
+        """
+        expired = self._user_manager.get_expired_users()
+        for user in expired:
+            self._user_manager.remove(user)
 
-        if self._user_manager.is_request_pending():
-            self._auth_handler.on_host_deny(self._user_manager.get_request())
-            self._user_manager.finish_request()
-            logger.info('Removed ongoing request during drop_expired_users')
+        requests = []
+        for request_id, request in self._user_manager.list_requests():
+            self._user_manager.finish_request(request_id)
+            requests.append(request)
+        return (expired, requests)
+
+    def import_users(self, lines, fmt='csv'):
+        """
+        Stores the devices of a guest list (see radguestauth.users.bulk).
+        The AuthHandler is notified about each allowed device like for an
+        OK in the chat. The lock is held per batch and not while the
+        AuthHandler runs its commands, so requests are answered meanwhile.
+
+        :param lines: iterable of text lines
+        :param fmt: csv or jsonl
+        :returns: a bulk.ImportResult
+        """
+        result = bulk.import_users(
+            self._user_manager, lines, fmt,
+            on_added=self._auth_handler.on_host_accept, lock=self._lock
+        )
+        logger.info('Imported %d devices, rejected %d (%.0f rows/s)'
+                    % (result.imported, result.rejected,
+                       result.rows_per_second))
+        return result
+
+    def export_users(self, fmt='csv'):
+        """
+        Writes all devices (see radguestauth.users.bulk).
+
+        :returns: iterator of text lines
+        """
+        return bulk.export_users(self._user_manager, fmt, lock=self._lock)
 
     def shutdown(self):
         try:
+            if self._expiry:
+                self._expiry.stop()
+            if self._relay:
+                self._relay.stop()
             self._chat_controller.stop()
+            if self._chat_ownership:
+                self._chat_ownership.release()
             self._auth_handler.shutdown()
+            self._storage.close()
         except AttributeError as exc:
             logger.error(
                 'Failed to shutdown. Likely, this occured because'
@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+
+from threading import Lock
+from collections import OrderedDict
+
+
+class EapSessionTable(object):
+    """
+    Correlates the outer request of an EAP-PWD conversation with the inner
+    request, which only carries the User-Name. The attributes of the outer
+    request are stored per user name and device, as a user may join with
+    several devices at the same time, and taken by the inner request.
+
+    Entries expire after ttl seconds and the number of entries is limited,
+    the oldest ones are evicted first. All operations are O(1) (amortized,
+    take and pending with one step per device of the user) and thread-safe.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1024
+    DEFAULT_TTL = 30
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        # (user name, device) -> (expiry time, NAS-IP-Address, session).
+        # The TTL is the same for all entries and put() moves updated
+        # entries to the end, so the order is also the expiry order.
+        self._entries = OrderedDict()
+        # user name -> OrderedDict of its devices in _entries (as keys), the
+        # oldest first
+        self._devices = dict()
+        self._lock = Lock()
+
+    def _remove(self, key):
+        """
+        Removes an entry. Has to be called with the lock held.
+        """
+        del self._entries[key]
+        name, device = key
+        devices = self._devices[name]
+        del devices[device]
+        if not devices:
+            del self._devices[name]
+
+    def _evict(self, now):
+        """
+        Drops expired entries, and the oldest ones if the table is full.
+        Has to be called with the lock held.
+        """
+        entries = self._entries
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if entry[0] > now and len(entries) < self._max_entries:
+                break
+            self._remove(key)
+
+    def put(self, name, nas, device, session):
+        """
+        Stores the attributes of an outer EAP-PWD request.
+
+        :param name: User-Name
+        :param nas: NAS-IP-Address, or None
+        :param device: Calling-Station-Id
+        :param session: Acct-Session-Id
+        """
+        now = time.monotonic()
+        key = (name, device)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._evict(now)
+            self._entries[key] = (now + self._ttl, nas, session)
+            self._devices.setdefault(name, OrderedDict())[device] = True
+
+    def take(self, name, nas=None):
+        """
+        Removes and returns the attributes stored for an inner request. With
+        several devices of the user in progress, the oldest conversation is
+        taken, as the inner requests follow the outer ones.
+
+        :param name: User-Name of the inner request
+        :param nas: NAS-IP-Address of the inner request. If given, it has to
+            match the stored one.
+        :returns: tuple (device, session), or None if there is no valid entry
+        """
+        now = time.monotonic()
+        with self._lock:
+            for device in list(self._devices.get(name, ())):
+                key = (name, device)
+                expiry, stored_nas, session = self._entries[key]
+                if expiry <= now:
+                    self._remove(key)
+                    continue
+                if nas and stored_nas and nas != stored_nas:
+                    continue
+
+                self._remove(key)
+                return (device, session)
+
+        return None
+
+    def pending(self, name):
+        """
+        :returns: True if an inner request of the user may take attributes
+        """
+        now = time.monotonic()
+        with self._lock:
+            return any(self._entries[(name, device)][0] > now
+                       for device in self._devices.get(name, ()))
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import logging
+
+from threading import Thread, Condition
+
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.deadlines import DeadlineHeap
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler(object):
+    """
+    Calls a function when the valid_until time of a user's device is
+    reached.
+
+    Deadlines are kept in a DeadlineHeap, so scheduling and expiring a user
+    costs O(log n). The heap is fed by UserManager events (see
+    on_user_change).
+
+    Deadlines are kept per key, which is a tuple (user name, device ID) for
+    the entries added by on_user_change. The callback runs in the scheduler
+    thread and gets the key and the deadline. It has to check whether the
+    user actually expired.
+    """
+
+    def __init__(self, expire_callback):
+        """
+        :param expire_callback: function taking the key and the valid_until
+            timestamp
+        """
+        self._callback = expire_callback
+        self._deadlines = DeadlineHeap()
+        self._cond = Condition()
+        self._quit = False
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def schedule(self, key, valid_until):
+        """
+        Sets the deadline of a key, replacing an earlier one.
+
+        :param valid_until: timestamp as in UserData.valid_until, or None to
+            unschedule the key
+        """
+        with self._cond:
+            # wake up the thread if this is the new earliest deadline
+            if self._deadlines.set(key, valid_until):
+                self._cond.notify()
+
+    def on_user_change(self, event, user_id):
+        """
+        Listener for UserManager.add_listener.
+        """
+        key = (user_id.name, user_id.device_id)
+        if event == UserManager.EVENT_UPDATE:
+            data = user_id.user_data
+            self.schedule(key, data.valid_until if data else None)
+        elif event == UserManager.EVENT_REMOVE:
+            self.schedule(key, None)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _next_due(self):
+        """
+        Waits until the earliest deadline is reached.
+
+        :returns: tuple (valid_until, key), or None on shutdown
+        """
+        with self._cond:
+            while not self._quit:
+                first = self._deadlines.first()
+                if first is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = first[0] - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+                return self._deadlines.pop()
+
+        return None
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            if due is None:
+                return
+
+            valid_until, key = due
+            try:
+                self._callback(key, valid_until)
+            except Exception:
+                logger.error('Failed to expire user %s' % (key,), exc_info=1)
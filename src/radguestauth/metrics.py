@@ -0,0 +1,229 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Request metrics in the Prometheus text exposition format.
+
+Recording a value costs a counter increment or a bisect over a short tuple,
+so the metrics are always collected. The tables of requests and commands
+are locked, as chat commands record from the threads of the command pool
+while a scrape renders them. Histogram updates are not locked: single
+observations may get lost, which is acceptable for metrics.
+"""
+
+import time
+
+from bisect import bisect_left
+from threading import Lock
+
+import radguestauth.auth as auth
+
+
+# upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+
+# stages of the authorize call, see GuestAuthCore.authorize
+STAGE_UNPACK = 'unpack'
+STAGE_EAP = 'eap'
+STAGE_MAY_JOIN = 'may_join'
+STAGE_HANDLER = 'handle_user_state'
+STAGE_NOTIFY = 'notify_join'
+STAGES = (STAGE_UNPACK, STAGE_EAP, STAGE_MAY_JOIN, STAGE_HANDLER,
+          STAGE_NOTIFY)
+
+# label values of the authorize results
+DECISIONS = {
+    auth.ALLOW: 'allow',
+    auth.REJECT: 'reject',
+    auth.NO_OP: 'no_op',
+}
+# decision label of endpoints which do not decide about a user
+NO_DECISION = 'none'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+clock = time.perf_counter
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with fixed upper bounds.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._bounds = buckets
+        # the last bucket is +Inf
+        self._counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def cumulative(self):
+        """
+        :returns: list of (upper bound as string, cumulative count) tuples,
+            ending with +Inf.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self._bounds, self._counts):
+            total += count
+            result.append((repr(bound), total))
+        result.append(('+Inf', total + self._counts[-1]))
+        return result
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % item for item in sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    Collects request counts, latencies and stage timings, and renders them
+    together with gauges evaluated at scrape time.
+    """
+
+    def __init__(self):
+        # (endpoint, decision) -> count
+        self._requests = dict()
+        # endpoint -> Histogram
+        self._latency = dict()
+        self._stages = dict((stage, Histogram()) for stage in STAGES)
+        # chat command name -> Histogram
+        self._commands = dict()
+        # lists of (name, description, callable)
+        self._gauges = []
+        self._counters = []
+        # protects the keys of _requests, _latency and _commands
+        self._lock = Lock()
+
+    def count_request(self, endpoint, decision, seconds):
+        """
+        Records a finished request.
+
+        :param endpoint: endpoint name, e.g. authorize
+        :param decision: authorize result (auth.ALLOW etc.) or NO_DECISION
+        :param seconds: time spent handling the request
+        """
+        key = (endpoint, DECISIONS.get(decision, NO_DECISION))
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+            hist = self._latency.get(endpoint)
+            if hist is None:
+                hist = self._latency[endpoint] = Histogram()
+        hist.observe(seconds)
+
+    def observe_stage(self, stage, seconds):
+        self._stages[stage].observe(seconds)
+
+    def stage_done(self, stage, start):
+        """
+        Records the time since start for the stage.
+
+        :param start: clock() value at the beginning of the stage
+        :returns: the current clock() value, i.e. the start of the next stage
+        """
+        now = clock()
+        self._stages[stage].observe(now - start)
+        return now
+
+    def observe_command(self, command, seconds):
+        """
+        Records the execution time of a chat command.
+
+        :param command: command name, e.g. ok
+        """
+        with self._lock:
+            hist = self._commands.get(command)
+            if hist is None:
+                hist = self._commands[command] = Histogram()
+        hist.observe(seconds)
+
+    def add_gauge(self, name, description, func):
+        """
+        Registers a gauge which is evaluated when rendering.
+
+        :param func: callable without arguments returning a number
+        """
+        self._gauges.append((name, description, func))
+
+    def add_counter(self, name, description, func):
+        """
+        Registers a counter which is kept elsewhere and evaluated when
+        rendering, like add_gauge.
+        """
+        self._counters.append((name, description, func))
+
+    def requests(self, endpoint, decision=NO_DECISION):
+        """
+        :returns: number of requests recorded for endpoint and decision
+        """
+        return self._requests.get(
+            (endpoint, DECISIONS.get(decision, decision)), 0
+        )
+
+    def render(self):
+        """
+        :returns: all metrics as text in the Prometheus exposition format
+        """
+        with self._lock:
+            requests = sorted(self._requests.items())
+            latency = sorted(self._latency.items())
+            commands = sorted(self._commands.items())
+
+        lines = [
+            '# HELP radguestauth_requests_total Handled requests per '
+            'endpoint and decision.',
+            '# TYPE radguestauth_requests_total counter',
+        ]
+        for (endpoint, decision), count in requests:
+            lines.append('radguestauth_requests_total{%s} %d' % (
+                _labels(endpoint=endpoint, decision=decision), count
+            ))
+
+        lines.append('# HELP radguestauth_request_seconds Request handling '
+                     'time per endpoint.')
+        lines.append('# TYPE radguestauth_request_seconds histogram')
+        for endpoint, hist in latency:
+            self._render_histogram(lines, 'radguestauth_request_seconds',
+                                   hist, endpoint=endpoint)
+
+        lines.append('# HELP radguestauth_stage_seconds Time spent in the '
+                     'stages of authorize.')
+        lines.append('# TYPE radguestauth_stage_seconds histogram')
+        for stage in STAGES:
+            self._render_histogram(lines, 'radguestauth_stage_seconds',
+                                   self._stages[stage], stage=stage)
+
+        lines.append('# HELP radguestauth_command_seconds Execution time '
+                     'of chat commands.')
+        lines.append('# TYPE radguestauth_command_seconds histogram')
+        for command, hist in commands:
+            self._render_histogram(lines, 'radguestauth_command_seconds',
+                                   hist, command=command)
+
+        for kind, values in [('gauge', self._gauges),
+                             ('counter', self._counters)]:
+            for name, description, func in values:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s %s' % (name, kind))
+                lines.append('%s %s' % (name, func()))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histogram(lines, name, hist, **labels):
+        label_str = _labels(**labels)
+        for bound, count in hist.cumulative():
+            lines.append('%s_bucket{%s,le="%s"} %d'
+                         % (name, label_str, bound, count))
+        lines.append('%s_sum{%s} %r' % (name, label_str, hist.sum))
+        lines.append('%s_count{%s} %d' % (name, label_str, hist.count))
@@ -0,0 +1,244 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import logging
+
+from collections import deque
+from threading import Thread, Condition
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOutbox(object):
+    """
+    Passes messages to a Chat in a separate thread, such that a slow or
+    stalled chat connection does not delay the caller, e.g. authorize
+    sending a join notification.
+
+    Messages are sent one at a time in the order of send calls. At most
+    max_size messages wait; when the outbox is full, the oldest one is
+    dropped.
+
+    With a spool file, waiting messages survive a restart: a second thread
+    appends the messages to the file, such that send does not wait for the
+    file system, and empties it whenever all messages were passed to the
+    chat. Under steady traffic the queue may never run empty, so the file is
+    rewritten from the waiting messages once it would exceed twice max_size
+    lines, which keeps it bounded at O(1) amortized cost per message.
+    Messages found in the file on startup are sent first. A crash may
+    therefore repeat messages, and lose only those not written yet.
+    """
+
+    DEFAULT_MAX_SIZE = 1000
+    # seconds stop() waits for the remaining messages
+    STOP_TIMEOUT = 5
+
+    def __init__(self, chat, max_size=DEFAULT_MAX_SIZE, spool_path=None):
+        """
+        :param chat: the Chat, started before start() is called
+        :param max_size: number of waiting messages
+        :param spool_path: optional file name of the spool
+        """
+        self._chat = chat
+        self._max_size = max_size
+        self._queue = deque()
+        self._cond = Condition()
+        # a message was taken from the queue and is being sent
+        self._sending = False
+        # the message being sent, kept in the spool when it is rewritten
+        self._current = None
+        self._quit = False
+        self._dropped = 0
+        self._spool = None
+        self._spool_path = spool_path
+        # messages not written to the spool yet, older ones were dropped
+        self._unspooled = deque(maxlen=max_size)
+        # number of lines in the spool, only used by the spool thread
+        self._spooled = 0
+        self._spool_quit = False
+        if spool_path:
+            self._open_spool(spool_path)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._spool_thread = Thread(target=self._run_spool, daemon=True)
+
+    def _open_spool(self, path):
+        # only the newest max_size messages would be kept in the queue
+        self._queue = deque(maxlen=self._max_size)
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._queue.append(json.loads(line))
+                    except ValueError:
+                        # the last line of a crashed process may be cut off
+                        pass
+        except FileNotFoundError:
+            pass
+        self._queue = deque(self._queue)
+        if self._queue:
+            logger.info('Resending %d spooled chat messages'
+                        % len(self._queue))
+        # keep the spooled messages until they are sent
+        self._spool = open(path, 'a')
+        self._rewrite_spool(list(self._queue))
+
+    def start(self):
+        self._thread.start()
+        if self._spool is not None:
+            self._spool_thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Sends the remaining messages and stops the thread. Messages which
+        could not be sent within timeout seconds are kept in the spool.
+        """
+        with self._cond:
+            self._quit = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        # the spool thread writes the remaining messages and closes the file
+        with self._cond:
+            self._spool_quit = True
+            self._cond.notify_all()
+        if self._spool_thread.is_alive():
+            self._spool_thread.join(timeout)
+        with self._cond:
+            if self._queue:
+                logger.warning('%d chat messages were not sent'
+                               % len(self._queue))
+            # let the thread end after the current message
+            self._queue.clear()
+
+    def send(self, message):
+        """
+        Queues a message for Chat.send_message.
+        """
+        with self._cond:
+            self._enqueue(message)
+            if self._spool is not None:
+                self._unspooled.append(message)
+            # wakes the sender and the spool thread
+            self._cond.notify_all()
+
+    def _spool_pending(self):
+        """
+        :returns: True if the spool thread has to write or empty the spool.
+            Has to be called with the lock held.
+        """
+        return bool(self._unspooled or self._spool_quit
+                    or (self._spooled and not self._queue
+                        and not self._sending))
+
+    def _run_spool(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._spool_pending)
+                # everything was sent
+                empty = not self._queue and not self._sending
+                compact = (not empty and self._spooled + len(self._unspooled)
+                           > 2 * self._max_size)
+                if compact:
+                    messages = list(self._queue)
+                    if self._sending:
+                        messages.insert(0, self._current)
+                else:
+                    messages = [] if empty else list(self._unspooled)
+                self._unspooled.clear()
+                stopping = self._spool_quit
+
+            try:
+                if compact:
+                    self._rewrite_spool(messages)
+                elif messages:
+                    self._spool.write(
+                        ''.join(json.dumps(m) + '\n' for m in messages)
+                    )
+                    self._spool.flush()
+                    self._spooled += len(messages)
+                elif empty and self._spooled:
+                    self._spool.truncate(0)
+                    self._spooled = 0
+            except OSError:
+                logger.error('Failed to spool chat messages', exc_info=1)
+                # do not retry in a busy loop
+                self._spooled = 0
+
+            if stopping:
+                self._spool.close()
+                return
+
+    def _rewrite_spool(self, messages):
+        """
+        Rewrites the spool with the waiting messages only, which drops the
+        sent and the dropped ones.
+        """
+        tmp_path = self._spool_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(json.dumps(m) + '\n' for m in messages))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._spool_path)
+        self._spool.close()
+        self._spool = open(self._spool_path, 'a')
+        self._spooled = len(messages)
+
+    def _enqueue(self, message):
+        if len(self._queue) >= self._max_size:
+            self._queue.popleft()
+            self._dropped += 1
+        self._queue.append(message)
+
+    def flush(self, timeout=None):
+        """
+        Waits until all messages were passed to the chat.
+
+        :returns: False if the timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._sending, timeout
+            )
+
+    def queued_messages(self):
+        return len(self._queue) + int(self._sending)
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def _next(self):
+        """
+        Waits for the next message.
+
+        :returns: the message, or None on shutdown
+        """
+        with self._cond:
+            self._sending = False
+            self._current = None
+            if not self._queue:
+                # wakes flush and the spool thread
+                self._cond.notify_all()
+            while not self._queue:
+                if self._quit:
+                    return None
+                self._cond.wait()
+            self._sending = True
+            self._current = self._queue.popleft()
+            return self._current
+
+    def _run(self):
+        while True:
+            message = self._next()
+            if message is None:
+                return
+            try:
+                self._chat.send_message(message)
+            except Exception:
+                with self._cond:
+                    self._dropped += 1
+                logger.error('Failed to send chat message', exc_info=1)
@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+
+from threading import Lock
+
+from radguestauth.users.storage import UserData
+
+
+def serialize_attributes(attrs):
+    """
+    Encodes a dict of RADIUS attributes as JSON response body (bytes).
+    """
+    return json.dumps(attrs, separators=(',', ':')).encode()
+
+
+class CachedReply(dict):
+    """
+    Attribute dict of an authorize result which keeps its serialized form in
+    body. Instances are shared between requests and must not be modified.
+    """
+
+    def __init__(self, attrs):
+        super(CachedReply, self).__init__(attrs)
+        self.body = serialize_attributes(attrs)
+
+
+class ReplyCache(object):
+    """
+    Keeps the results of AuthHandler.handle_user_state per user name, device
+    and join state, such that returning guests get a prepared reply.
+
+    Only replies to allowed devices are kept. These are stored in the
+    UserManager, while the names and devices of other requests are chosen by
+    the client and would let the cache grow without bound.
+
+    Entries are dropped when the UserManager reports a change of the user
+    (see on_user_change), and all entries are dropped when the password
+    changes.
+    """
+
+    def __init__(self):
+        # user name -> {(join state, device) -> result tuple}
+        self._replies = dict()
+        # increased on every invalidation, see put()
+        self.generation = 0
+        # listeners may run in other threads than put
+        self._lock = Lock()
+
+    def get(self, name, state, device=None):
+        """
+        :param device: device ID, as users may have several devices
+        :returns: the cached result tuple, or None
+        """
+        entry = self._replies.get(name)
+        if entry is None:
+            return None
+        return entry.get((state, device))
+
+    def put(self, name, state, result, generation, device=None):
+        """
+        Stores a handle_user_state result.
+
+        :param generation: value of the generation attribute before the
+            result was computed. If the cache was invalidated in between, the
+            result is not stored as it might be outdated.
+        :returns: the result to use, with the attribute dict replaced by a
+            CachedReply
+        """
+        code, attrs = result
+        if attrs is not None:
+            result = (code, CachedReply(attrs))
+
+        if state != UserData.JOIN_STATE_ALLOWED:
+            return result
+
+        with self._lock:
+            if generation == self.generation:
+                entry = self._replies.setdefault(name, dict())
+                entry[(state, device)] = result
+
+        return result
+
+    def on_user_change(self, event, user_id):
+        """
+        Listener for UserManager.add_listener.
+        """
+        with self._lock:
+            self.generation += 1
+            if user_id is None:
+                self._replies = dict()
+            else:
+                self._replies.pop(user_id.name, None)
+
+    def __len__(self):
+        return len(self._replies)
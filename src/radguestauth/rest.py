@@ -0,0 +1,340 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Handling of the FreeRADIUS mod_rest JSON format, independent from the web
+framework.
+"""
+
+import io
+import json
+import radguestauth.auth as auth
+import radguestauth.metrics as metrics
+
+from radguestauth.replycache import serialize_attributes
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+# constant response bodies
+REJECT_BODY = b'{}'
+NO_CONTENT_BODY = b''
+JSON_CONTENT_TYPE = 'application/json'
+
+
+def reply_body(attrs):
+    """
+    Returns the serialized response body for an attribute dict. The body of
+    a CachedReply is reused.
+    """
+    body = getattr(attrs, 'body', None)
+    if body is None:
+        body = serialize_attributes(attrs)
+    return body
+
+
+def json_rest_unpack(data):
+    """
+    FreeRADIUS JSON data is formatted as follows (see mod_rest config file):
+
+    "<attributeN>": {
+          "type":"<typeN>",
+          "value":[...]
+    }
+
+    This takes the first item from value, so the result is
+
+    "<attributeN>": "<value>"
+    """
+    res = dict()
+    try:
+        for key in data:
+            res[key] = str(data[key]['value'][0])
+    except TypeError:
+        # ignore malformed data
+        pass
+    return res
+
+
+def _find_value_start(text, key):
+    """
+    Looks up the top-level attribute key (including quotes) in text. If the
+    key occurs more than once, the last one is used like in json.loads.
+
+    :returns: index of the attribute object after the colon, or -1 if the
+        key is not present.
+    """
+    pos = text.rfind(key)
+    while pos != -1:
+        # keys are preceded by { or , - this skips occurrences inside of
+        # strings, where the quotes would be escaped.
+        before = pos - 1
+        while before >= 0 and text[before] in _WHITESPACE:
+            before -= 1
+        after = pos + len(key)
+        while after < len(text) and text[after] in _WHITESPACE:
+            after += 1
+
+        if (before >= 0 and text[before] in '{,'
+                and after < len(text) and text[after] == ':'):
+            after += 1
+            while after < len(text) and text[after] in _WHITESPACE:
+                after += 1
+            return after
+
+        pos = text.rfind(key, 0, pos)
+
+    return -1
+
+
+def extract_attributes(raw, names):
+    """
+    Variant of json_rest_unpack for a raw request body. Only the attribute
+    objects of the given names get decoded, the remaining attributes are
+    skipped without parsing. mod_rest bodies are small enough that this is
+    not faster than json.loads, but is_skipped uses it to look at a few
+    attributes.
+
+    :param raw: request body as bytes or str
+    :param names: iterable of attribute names to extract
+    :returns: dict as returned by json_rest_unpack, limited to names which
+        are present in the body
+    :raises ValueError: if an attribute is malformed
+    """
+    text = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+    res = dict()
+    for name in names:
+        start = _find_value_start(text, '"%s"' % name)
+        if start == -1:
+            continue
+
+        attr, _ = _decoder.raw_decode(text, start)
+        try:
+            res[name] = str(attr['value'][0])
+        except (TypeError, KeyError, IndexError):
+            raise ValueError('Malformed attribute %s' % name)
+
+    return res
+
+
+def unpack_request(raw, names=None):
+    """
+    Unpacks a mod_rest request body.
+
+    :param raw: request body as bytes or str
+    :param names: If given, only these attributes are extracted (see
+        extract_attributes). Otherwise, the whole body is decoded.
+    :returns: dict mapping attribute names to their first value. Malformed
+        bodies result in an empty or partial dict, like in json_rest_unpack.
+    """
+    if names is not None:
+        try:
+            return extract_attributes(raw, names)
+        except ValueError:
+            # let the complete parser decide how much can be used
+            pass
+
+    try:
+        return json_rest_unpack(json.loads(raw))
+    except ValueError:
+        return dict()
+
+
+class RestHandler(object):
+    """
+    Implements the REST endpoints independent from the server framework.
+    The endpoint methods take the raw request body and return a tuple of
+    HTTP status code and response body (bytes, JSON encoded).
+    """
+
+    # attributes which are sufficient for GuestAuthCore.can_skip
+    SKIP_ATTRIBUTES = ('User-Name', 'EAP-Message', 'FreeRADIUS-Proxied-To',
+                       'Calling-Station-Id')
+
+    def __init__(self, core, config):
+        """
+        :param core: a started GuestAuthCore
+        :param config: config dict, the rest_parser setting is evaluated
+        """
+        self._core = core
+        self._metrics = core.metrics
+        # With the fast parser, only the attributes which are actually used
+        # get extracted from the request body. json.loads is just as fast
+        # for mod_rest bodies, so the full parser is the default.
+        self._attributes = None
+        if config.get('rest_parser', 'full') == 'fast':
+            self._attributes = core.required_attributes()
+        # number of requests answered by is_skipped
+        self.skipped = 0
+        self._metrics.add_counter(
+            'radguestauth_authorize_skipped_total', 'Authorize requests '
+            'answered with NO_OP before the body was parsed.',
+            lambda: self.skipped
+        )
+
+    def is_skipped(self, body):
+        """
+        Checks with a shallow look at the raw authorize body whether the
+        request can be answered with NO_OP without calling the core (see
+        GuestAuthCore.can_skip). Matching requests are counted in skipped.
+        """
+        # requests without EAP message are never skipped, so avoid
+        # extracting attributes for those
+        if b'"EAP-Message"' not in body:
+            return False
+        start = metrics.clock()
+        try:
+            items = extract_attributes(body, self.SKIP_ATTRIBUTES)
+        except ValueError:
+            return False
+
+        if self._core.can_skip(items):
+            self.skipped += 1
+            self._metrics.count_request('authorize', auth.NO_OP,
+                                        metrics.clock() - start)
+            return True
+
+        return False
+
+    @staticmethod
+    def _authorize_response(result):
+        state, attr_dict = result
+        if state == auth.REJECT:
+            return (401, REJECT_BODY)
+
+        if state == auth.NO_OP:
+            return (204, NO_CONTENT_BODY)
+
+        return (200, reply_body(attr_dict))
+
+    def authorize(self, body):
+        start = metrics.clock()
+        data = unpack_request(body, self._attributes)
+        self._metrics.stage_done(metrics.STAGE_UNPACK, start)
+        result = self._core.authorize(data)
+        self._metrics.count_request('authorize', result[0],
+                                    metrics.clock() - start)
+        return self._authorize_response(result)
+
+    def authorize_batch(self, body):
+        """
+        Takes a JSON array of mod_rest authorize bodies and evaluates them in
+        order (see GuestAuthCore.authorize_many). The response is an array
+        with one object per request, containing the status code and reply
+        attributes /authorize would have returned:
+
+        [{"status": 200, "reply": {...}}, {"status": 204, "reply": null}]
+
+        Requests which are not JSON objects are rejected like malformed
+        /authorize bodies. The decision of each request is recorded in the
+        metrics, with the time of the batch split evenly between them.
+        """
+        start = metrics.clock()
+        try:
+            requests = json.loads(body)
+        except ValueError:
+            return (400, REJECT_BODY)
+        if not isinstance(requests, list):
+            return (400, REJECT_BODY)
+
+        results = self._core.authorize_many(
+            json_rest_unpack(req) if isinstance(req, dict) else dict()
+            for req in requests
+        )
+
+        # the reply bodies are already serialized, so only wrap them
+        parts = []
+        for result in results:
+            status, reply = self._authorize_response(result)
+            parts.append(b'{"status":%d,"reply":%s}'
+                         % (status, reply or b'null'))
+
+        if results:
+            seconds = (metrics.clock() - start) / len(results)
+            for result in results:
+                self._metrics.count_request('authorize_batch', result[0],
+                                            seconds)
+        return (200, b'[' + b','.join(parts) + b']')
+
+    def post_auth(self, body):
+        start = metrics.clock()
+        data = unpack_request(body, self._attributes)
+        attr_dict = self._core.post_auth(data)
+        self._metrics.count_request('post_auth', metrics.NO_DECISION,
+                                    metrics.clock() - start)
+        if not attr_dict:
+            return (204, NO_CONTENT_BODY)
+
+        return (200, reply_body(attr_dict))
+
+    def drop_expired(self):
+        start = metrics.clock()
+        self._core.drop_expired_users()
+        self._metrics.count_request('drop_expired', metrics.NO_DECISION,
+                                    metrics.clock() - start)
+        return (200, b'OK')
+
+    def import_users(self, fmt, lines):
+        """
+        Imports a guest list, see GuestAuthCore.import_users.
+
+        :param fmt: csv or jsonl
+        :param lines: iterable of the lines of the body as bytes, e.g. the
+            request stream
+        :returns: JSON object with the number of imported and rejected rows,
+            error messages and the throughput
+        """
+        start = metrics.clock()
+        text = (line.decode('utf-8', 'replace') for line in lines)
+        result = self._core.import_users(text, fmt)
+        self._metrics.count_request('import_users', metrics.NO_DECISION,
+                                    metrics.clock() - start)
+        return (200, json.dumps(result.to_dict()).encode())
+
+    def export_users(self, fmt):
+        """
+        Exports all devices, see GuestAuthCore.export_users. The body is an
+        iterator of bytes, such that it can be streamed.
+        """
+        return (200, (line.encode() for line in self._core.export_users(fmt)))
+
+    def metrics(self):
+        """
+        Returns the metrics of the core, use metrics.CONTENT_TYPE for the
+        response.
+        """
+        return (200, self._metrics.render().encode())
+
+
+class NoOpShortcut(object):
+    """
+    WSGI middleware which answers /authorize requests that the core would
+    skip (outer EAP messages and unneeded inner EAP types) with a prebuilt
+    204 response, see RestHandler.is_skipped. The wrapped application is not
+    called for those.
+    """
+
+    def __init__(self, app, rest_handler, path='/authorize'):
+        """
+        :param app: the WSGI application to wrap
+        :param rest_handler: RestHandler deciding about skipped requests
+        :param path: URL path of the authorize endpoint
+        """
+        self._app = app
+        self._handler = rest_handler
+        self._path = path
+
+    def __call__(self, environ, start_response):
+        if (environ.get('PATH_INFO') == self._path
+                and environ.get('REQUEST_METHOD') == 'POST'
+                and environ.get('CONTENT_LENGTH')):
+            body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+            if self._handler.is_skipped(body):
+                start_response('204 NO CONTENT', [])
+                return [NO_CONTENT_BODY]
+
+            # the body was consumed, so pass it on as a new stream
+            environ['wsgi.input'] = io.BytesIO(body)
+
+        return self._app(environ, start_response)
@@ -2,57 +2,32 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import os
-import configparser
-import radguestauth.auth as auth
+import radguestauth.metrics as metrics
+import radguestauth.users.bulk as bulk
+import radguestauth.users.shared as shared
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 
+from radguestauth.config import load_config
 from radguestauth.core import GuestAuthCore
+from radguestauth.userstorage import storage_name
+from radguestauth.rest import RestHandler, NoOpShortcut, JSON_CONTENT_TYPE
 
 
 guestauthcore = GuestAuthCore()
 
 
-def json_rest_unpack(data):
-    """
-    FreeRADIUS JSON data is formatted as follows (see mod_rest config file):
-
-    "<attributeN>": {
-          "type":"<typeN>",
-          "value":[...]
-    }
-
-    This takes the first item from value, so the result is
-
-    "<attributeN>": "<value>"
-    """
-    res = dict()
-    try:
-        for key in data:
-            res[key] = str(data[key]['value'][0])
-    except TypeError:
-        # ignore malformed data
-        pass
-    return res
-
-
 def create_app():
     # use INI config instead of Flask config, such that radguestauth stays
     # completely independent from the config format of Flask
-    # Default config:
-    guestauth_cfg = {'chat': 'udp'}
+    config = load_config()
+    guestauthcore.startup(config)
 
-    confpath = os.environ.get('RADGUESTAUTH_CONFIG')
-    if confpath:
-        cparser = configparser.ConfigParser()
-        cparser.read(confpath)
-        if 'radguestauth' in cparser.sections():
-            guestauth_cfg = dict(cparser['radguestauth'])
-
-    guestauthcore.startup(guestauth_cfg)
+    handler = RestHandler(guestauthcore, config)
 
     app = Flask(__name__)
+    # answer skipped EAP requests before Flask processes them
+    app.wsgi_app = NoOpShortcut(app.wsgi_app, handler)
 
     @app.route('/')
     def info():
@@ -60,39 +35,54 @@ def create_app():
 
     @app.route('/authorize', methods=['POST'])
     def authorize():
-        data = json_rest_unpack(request.json)
-        state, attr_dict = guestauthcore.authorize(data)
-
-        if state == auth.REJECT:
-            return (jsonify({}), 401)
+        status, body = handler.authorize(request.get_data())
+        return Response(body, status, mimetype=JSON_CONTENT_TYPE)
 
-        if state == auth.NO_OP:
-            return (jsonify(''), 204)
-
-        return jsonify(attr_dict)
+    @app.route('/authorize/batch', methods=['POST'])
+    def authorize_batch():
+        status, body = handler.authorize_batch(request.get_data())
+        return Response(body, status, mimetype=JSON_CONTENT_TYPE)
 
     @app.route('/post-auth', methods=['POST'])
     def post_auth():
-        data = json_rest_unpack(request.json)
-        attr_dict = guestauthcore.post_auth(data)
-        if not attr_dict:
-            return (jsonify(''), 204)
-
-        return jsonify(attr_dict)
+        status, body = handler.post_auth(request.get_data())
+        return Response(body, status, mimetype=JSON_CONTENT_TYPE)
 
     @app.route('/drop-expired')
     def drop_expired():
-        guestauthcore.drop_expired_users()
-        return 'OK'
+        status, body = handler.drop_expired()
+        return Response(body, status)
+
+    @app.route('/users.<fmt>', methods=['GET', 'POST'])
+    def users(fmt):
+        if fmt not in bulk.FORMATS:
+            return Response(b'', 404)
+        if request.method == 'POST':
+            # read line by line, the list is not kept in memory
+            status, body = handler.import_users(fmt, request.stream)
+            return Response(body, status, mimetype=JSON_CONTENT_TYPE)
+
+        status, body = handler.export_users(fmt)
+        return Response(body, status, mimetype=bulk.CONTENT_TYPES[fmt])
+
+    @app.route('/metrics')
+    def get_metrics():
+        status, body = handler.metrics()
+        return Response(body, status, content_type=metrics.CONTENT_TYPE)
 
     return app
 
 
 # -- gunicorn config --
 
-# More than one worker would result in undefined behavior, as there is only
-# one GuestAuthCore instance available.
+_guestauth_cfg = load_config()
+_state_server = None
+
+# Each worker has its own GuestAuthCore instance. More than one worker would
+# result in undefined behavior unless the user state is shared.
 workers = 1
+if storage_name(_guestauth_cfg) == 'shared':
+    workers = int(_guestauth_cfg.get('workers', 1))
 # The standard worker does not support persistent connections.
 # Thread-based workers result in deadlocks on exit due to SleekXMPP Threads
 # (probably because two thread pools are used, see
@@ -101,12 +91,28 @@ workers = 1
 worker_class = 'eventlet'
 
 
+# Start the state server in the master process, such that it is available
+# before the workers get forked.
+def on_starting(server):
+    global _state_server
+    if storage_name(_guestauth_cfg) == 'shared':
+        _state_server = shared.start_state_server(
+            _guestauth_cfg.get('state_socket', shared.DEFAULT_STATE_SOCKET),
+            int(_guestauth_cfg.get('max_pending_requests', 1))
+        )
+
+
 # Exit hook for proper shutdown. Has to be called from the worker process,
 # therefore worker_exit and not on_exit.
 def worker_exit(server, worker):
     guestauthcore.shutdown()
 
 
+def on_exit(server):
+    if _state_server:
+        _state_server.shutdown()
+
+
 # Enable log output. See CONFIG_DEFAULTS in gunicorn.glogging
 logconfig_dict = dict(
     version=1,
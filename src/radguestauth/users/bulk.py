@@ -0,0 +1,397 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Import and export of guest lists as CSV or JSON lines, e.g. to pre-approve
+the attendees of a conference.
+
+Each row describes one device with the columns
+
+    name, device, state, valid_until, max_num_joins, num_joins, password
+
+of which only name and device are required. device is a MAC address,
+separated by dashes, colons or not at all. It is stored in the notation
+FreeRADIUS uses for the Calling-Station-Id. state is allowed (default) or
+blocked. valid_until is an
+ISO 8601 time (YYYY-MM-DD, optionally followed by hh:mm[:ss[.ffffff]] and
+an offset like +01:00 or Z) or a UNIX timestamp between 1970 and 9999;
+without it, the device has no time limit. The password defaults to the
+current guest password.
+
+Rows are read and written one at a time and stored in batches, so memory
+use does not depend on the size of the list. Run
+
+    python3 -m radguestauth.users.bulk import guests.csv
+    python3 -m radguestauth.users.bulk export users.csv
+
+to send a file to (or get it from) the /users.csv or /users.jsonl endpoint
+of a running server.
+"""
+
+import io
+import os
+import re
+import csv
+import sys
+import json
+import math
+import time
+import argparse
+import urllib.request
+
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+COLUMNS = ('name', 'device', 'state', 'valid_until', 'max_num_joins',
+           'num_joins', 'password')
+
+DEFAULT_BATCH_SIZE = 500
+# rows per UserManager.list_users call during export
+EXPORT_PAGE_SIZE = 500
+# number of error messages kept in an ImportResult
+MAX_ERRORS = 20
+
+# latest valid_until, 9999-12-31T23:59:59Z, which can still be formatted
+MAX_VALID_UNTIL = 253402300799
+
+# datetime.fromisoformat needs Python 3.7
+_ISO_TIME = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?'
+    r'(Z|[+-]\d\d:?\d\d)?'
+)
+
+STATES = {
+    'allowed': UserData.JOIN_STATE_ALLOWED,
+    'blocked': UserData.JOIN_STATE_BLOCKED,
+}
+
+DEFAULT_URL = 'http://127.0.0.1:5000'
+
+
+class ImportResult(object):
+    """
+    Counters of an import.
+    """
+
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        # first MAX_ERRORS messages, with row numbers
+        self.errors = []
+        self.seconds = 0.0
+
+    def reject(self, row_number, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append('row %d: %s' % (row_number, message))
+
+    @property
+    def rows_per_second(self):
+        if self.seconds <= 0:
+            return 0.0
+        return (self.imported + self.rejected) / self.seconds
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+
+
+def radius_device_id(mac):
+    """
+    Formats a MAC address integer as FreeRADIUS does for the
+    Calling-Station-Id, e.g. 02-00-00-00-00-01.
+    """
+    digits = '%012X' % mac
+    return '-'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def _parse_iso_time(value):
+    match = _ISO_TIME.fullmatch(value.strip())
+    if match is None:
+        raise ValueError('invalid time %s' % value)
+    year, month, day, hour, minute, second, fraction, offset = \
+        match.groups()
+
+    tz = None
+    if offset == 'Z':
+        tz = timezone.utc
+    elif offset:
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        tz = timezone(timedelta(minutes=(-minutes if offset[0] == '-'
+                                         else minutes)))
+    # raises ValueError for invalid dates as well
+    moment = datetime(int(year), int(month), int(day), int(hour or 0),
+                      int(minute or 0), int(second or 0),
+                      int((fraction or '0').ljust(6, '0')), tz)
+    try:
+        # times without offset are local times
+        return moment.timestamp()
+    except (OverflowError, OSError):
+        raise ValueError('invalid time %s' % value)
+
+
+def _parse_time(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError('invalid time %s' % value)
+    if isinstance(value, (int, float)):
+        timestamp = float(value)
+    else:
+        try:
+            timestamp = float(value)
+        except ValueError:
+            timestamp = _parse_iso_time(value)
+
+    # float() also accepts nan and inf, which can't be stored or compared
+    if not (math.isfinite(timestamp) and 0 <= timestamp <= MAX_VALID_UNTIL):
+        raise ValueError('valid_until out of range: %s' % value)
+    return timestamp
+
+
+def _parse_count(row, column):
+    value = row.get(column)
+    if value is None or value == '':
+        return 0
+    count = int(value)
+    if count < 0:
+        raise ValueError('%s must not be negative' % column)
+    return count
+
+
+def user_from_row(row):
+    """
+    Validates a row and converts it to an UserIdentifier with UserData.
+
+    :param row: dict with the COLUMNS as keys
+    :raises ValueError: if the row is invalid
+    """
+    name = row.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is missing')
+
+    mac = None
+    if isinstance(row.get('device'), str):
+        mac = UserIdentifier.parse_mac(row['device'].strip())
+    if mac is None:
+        raise ValueError('device is no MAC address: %s' % row.get('device'))
+
+    state = (row.get('state') or 'allowed').strip().lower()
+    if state not in STATES:
+        raise ValueError('unknown state %s' % state)
+
+    data = UserData()
+    data.join_state = STATES[state]
+    data.valid_until = _parse_time(row.get('valid_until'))
+    data.max_num_joins = _parse_count(row, 'max_num_joins')
+    data.num_joins = _parse_count(row, 'num_joins')
+
+    user_id = UserIdentifier(name.strip(), radius_device_id(mac),
+                             row.get('password') or None)
+    user_id.user_data = data
+    return user_id
+
+
+def read_rows(lines, fmt):
+    """
+    Parses rows lazily.
+
+    :param lines: iterable of text lines, e.g. a file
+    :param fmt: csv (with a header line) or jsonl
+    :returns: iterator of (row number, dict or None if unreadable)
+    """
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(lines), 1):
+            yield (number, row)
+        return
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield (number, row if isinstance(row, dict) else None)
+
+
+def import_users(user_mgr, lines, fmt='csv', batch_size=DEFAULT_BATCH_SIZE,
+                 on_added=None, lock=None):
+    """
+    Validates the rows and stores them with UserManager.add_users.
+
+    :param user_mgr: the UserManager
+    :param lines: iterable of text lines
+    :param fmt: one of FORMATS
+    :param batch_size: number of devices per add_users call
+    :param on_added: optional function called with each stored allowed
+        device, e.g. AuthHandler.on_host_accept. It is called after each
+        batch, without holding lock.
+    :param lock: optional lock held while a batch is stored
+    :returns: an ImportResult
+    """
+    if lock is None:
+        lock = Lock()
+    if fmt not in FORMATS:
+        raise ValueError('unknown format %s' % fmt)
+
+    result = ImportResult()
+    start = time.perf_counter()
+    batch = []
+
+    def store():
+        with lock:
+            stored = user_mgr.add_users([u for _, u in batch])
+        # UserIdentifier is not hashable, compare the objects
+        skipped = set(id(u) for u in stored)
+        added = []
+        for number, user_id in batch:
+            if id(user_id) in skipped:
+                result.reject(number, 'device %s is used by another user '
+                              'or the device limit is reached'
+                              % user_id.device_id)
+                continue
+            result.imported += 1
+            if user_id.user_data.join_state == UserData.JOIN_STATE_ALLOWED:
+                added.append(user_id)
+        del batch[:]
+        if on_added is not None:
+            for user_id in added:
+                on_added(user_id)
+
+    for number, row in read_rows(lines, fmt):
+        if row is None:
+            result.reject(number, 'unreadable row')
+            continue
+        try:
+            batch.append((number, user_from_row(row)))
+        except (ValueError, TypeError) as exc:
+            result.reject(number, str(exc))
+            continue
+        if len(batch) >= batch_size:
+            store()
+
+    if batch:
+        store()
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def _row_of(user_id):
+    data = user_id.user_data
+    row = {'name': user_id.name, 'device': user_id.device_id,
+           'state': 'blocked', 'valid_until': None, 'max_num_joins': 0,
+           'num_joins': 0, 'password': user_id.password}
+    if isinstance(data, UserData):
+        if data.join_state == UserData.JOIN_STATE_ALLOWED:
+            row['state'] = 'allowed'
+        if data.valid_until:
+            row['valid_until'] = datetime.fromtimestamp(
+                data.valid_until, timezone.utc
+            ).isoformat()
+        row['max_num_joins'] = data.max_num_joins
+        row['num_joins'] = data.num_joins
+    return row
+
+
+def export_users(user_mgr, fmt='csv', page_size=EXPORT_PAGE_SIZE,
+                 lock=None):
+    """
+    Writes all devices of all users in name order.
+
+    :param lock: optional lock held while a page is read from user_mgr
+    :returns: iterator of text lines, including a header line for CSV
+    """
+    if lock is None:
+        lock = Lock()
+    if fmt not in FORMATS:
+        raise ValueError('unknown format %s' % fmt)
+
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, COLUMNS, lineterminator='\n')
+    if fmt == 'csv':
+        writer.writeheader()
+        yield buf.getvalue()
+
+    offset = 0
+    while True:
+        with lock:
+            users = user_mgr.list_users(None, offset, page_size)
+            devices = [device for user in users
+                       for device in user_mgr.list_devices(user.name)]
+        for device in devices:
+            row = _row_of(device)
+            if fmt == 'csv':
+                buf.seek(0)
+                buf.truncate()
+                writer.writerow(row)
+                yield buf.getvalue()
+            else:
+                yield json.dumps(row) + '\n'
+        if len(users) < page_size:
+            return
+        offset += page_size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import or export the users of a radguestauth server.'
+    )
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('file', help='.csv or .jsonl file, - for stdin or '
+                        'stdout')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='default: taken from the file name, else csv')
+    parser.add_argument('--url', default=DEFAULT_URL,
+                        help='server address (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'jsonl' if args.file.endswith('.jsonl') else 'csv'
+    url = '%s/users.%s' % (args.url.rstrip('/'), fmt)
+
+    if args.action == 'import':
+        if args.file == '-':
+            # the servers need a Content-Length
+            source = io.BytesIO(sys.stdin.buffer.read())
+            length = len(source.getvalue())
+        else:
+            source = open(args.file, 'rb')
+            length = os.fstat(source.fileno()).st_size
+        with source:
+            # urllib sends file objects in blocks
+            request = urllib.request.Request(
+                url, data=source, method='POST',
+                headers={'Content-Type': CONTENT_TYPES[fmt],
+                         'Content-Length': str(length)}
+            )
+            with urllib.request.urlopen(request) as response:
+                print(response.read().decode())
+    else:
+        target = (sys.stdout.buffer if args.file == '-'
+                  else open(args.file, 'wb'))
+        with urllib.request.urlopen(url) as response:
+            while True:
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+                target.write(chunk)
+        if target is not sys.stdout.buffer:
+            target.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import heapq
+
+
+class DeadlineHeap(object):
+    """
+    Keeps one deadline per key, ordered by time. Used by UserManager to find
+    the expired devices and by the ExpiryScheduler to wait for the next one.
+
+    Deadlines are kept in a heap, so setting one costs O(log n). Changed or
+    removed deadlines leave outdated heap entries, which are skipped when
+    they come up. Not thread safe.
+    """
+
+    # number of outdated heap entries which are tolerated before the heap
+    # gets rebuilt (in addition to one per key)
+    SLACK = 64
+
+    def __init__(self):
+        # heap of (deadline, key)
+        self._heap = []
+        # key -> deadline of the current heap entry
+        self._deadlines = dict()
+
+    def set(self, key, deadline):
+        """
+        Sets the deadline of a key, replacing an earlier one.
+
+        :param deadline: timestamp, or None to remove the key
+        :returns: True if the earliest deadline may have changed
+        """
+        if not deadline:
+            return self._deadlines.pop(key, None) is not None
+        if self._deadlines.get(key) == deadline:
+            return False
+
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + self.SLACK:
+            # drop outdated entries, amortized O(1) per call
+            self._heap = [(t, k) for k, t in self._deadlines.items()]
+            heapq.heapify(self._heap)
+            return True
+        return self._heap[0][1] == key
+
+    def discard(self, key):
+        self._deadlines.pop(key, None)
+
+    def get(self, key):
+        return self._deadlines.get(key)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def first(self):
+        """
+        :returns: tuple (deadline, key) of the earliest deadline, or None
+        """
+        heap = self._heap
+        while heap:
+            deadline, key = heap[0]
+            if self._deadlines.get(key) == deadline:
+                return (deadline, key)
+            # outdated entry
+            heapq.heappop(heap)
+        return None
+
+    def pop(self):
+        """
+        Removes the earliest deadline.
+
+        :returns: tuple (deadline, key), or None
+        """
+        entry = self.first()
+        if entry is not None:
+            heapq.heappop(self._heap)
+            del self._deadlines[entry[1]]
+        return entry
+
+    def before(self, limit):
+        """
+        Finds the deadlines before limit, without removing them.
+
+        Each heap entry is smaller than its children, so only the entries
+        below limit and their direct children are visited: O(k) for k
+        results, regardless of the number of keys.
+
+        :returns: list of (deadline, key) tuples, ordered by deadline
+        """
+        heap = self._heap
+        size = len(heap)
+        found = dict()
+        stack = [0] if heap else []
+        while stack:
+            i = stack.pop()
+            deadline, key = heap[i]
+            if deadline >= limit:
+                continue
+            if self._deadlines.get(key) == deadline:
+                found[key] = deadline
+            child = 2 * i + 1
+            if child < size:
+                stack.append(child)
+                if child + 1 < size:
+                    stack.append(child + 1)
+
+        return sorted((t, k) for k, t in found.items())
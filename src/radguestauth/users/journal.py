@@ -0,0 +1,326 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import mmap
+import logging
+
+from threading import Thread, Condition
+
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+# /tmp and /var are tmpfs on OpenWRT, see radguestauth.users.sqlite
+DEFAULT_STATE_DIR = '/etc/radguestauth/state'
+
+SNAPSHOT_FILE = 'snapshot'
+JOURNAL_PREFIX = 'journal.'
+
+# Record types. Each record is a JSON array on its own line, starting with
+# the type. All records set or delete an entry, so replaying a record twice
+# gives the same state.
+REC_GENERATION = 's'    # ["s", first journal generation to replay]
+REC_USER = 'u'          # ["u", name, device, password, data or null]
+REC_REMOVE = 'r'        # ["r", name, device]
+REC_REQUEST = 'q'       # ["q", request ID, name, device, password]
+REC_FINISH = 'f'        # ["f", name]
+REC_PASSWORD = 'p'      # ["p", password]
+REC_NEXT_ID = 'n'       # ["n", next request ID]
+
+
+logger = logging.getLogger(__name__)
+
+
+# skips the encoding detection of json.loads
+_decode = json.JSONDecoder().decode
+
+
+def _encode(record):
+    return json.dumps(record, separators=(',', ':')).encode() + b'\n'
+
+
+def _user_record(user_id):
+    data = user_id.user_data
+    if isinstance(data, UserData):
+        data = [data.valid_until, data.num_joins, data.max_num_joins,
+                data.join_state]
+    else:
+        data = None
+
+    return [REC_USER, user_id.name, user_id.device_id, user_id.password, data]
+
+
+class JournalUserManager(UserManager):
+    """
+    UserManager which appends every change to a journal file and keeps
+    the state across restarts.
+
+    The journal is written by a background thread which collects the records
+    of COMMIT_INTERVAL seconds and writes them with one write and one fsync,
+    so requests never wait for the disk. Once SNAPSHOT_RECORDS records were
+    written, the complete state is written to a snapshot and a new journal is
+    started. On startup, the snapshot is read and only the journals written
+    after it are replayed.
+
+    The files only grow by appending, and snapshots are written sequentially
+    and renamed into place. This avoids the small random writes of a database,
+    which are slow on flash storage. Changes of the last COMMIT_INTERVAL
+    seconds are lost on a crash.
+    """
+
+    COMMIT_INTERVAL = 1.0
+    SNAPSHOT_RECORDS = 10000
+
+    def __init__(self, directory=DEFAULT_STATE_DIR,
+                 max_pending=UserManager.DEFAULT_MAX_PENDING):
+        """
+        :param directory: directory of the snapshot and journal files,
+            created if it does not exist
+        :param max_pending: see UserManager
+        """
+        super(JournalUserManager, self).__init__(max_pending)
+        self._dir = directory
+        # encoded records which are not written yet
+        self._buffer = []
+        # (name, device ID) of users whose join count changed, see _joined
+        self._dirty = set()
+        self._records = 0
+        self._cond = Condition()
+        self._quit = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._generation = self._load_snapshot()
+        self._replay_journals()
+        self._journal = open(self._journal_path(self._generation), 'ab')
+
+        self.add_listener(self._on_change)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _journal_path(self, generation):
+        return os.path.join(self._dir, JOURNAL_PREFIX + str(generation))
+
+    def _journal_generations(self):
+        result = []
+        for name in os.listdir(self._dir):
+            if name.startswith(JOURNAL_PREFIX):
+                try:
+                    result.append(int(name[len(JOURNAL_PREFIX):]))
+                except ValueError:
+                    pass
+        return sorted(result)
+
+    def _apply(self, record):
+        """
+        Applies a snapshot or journal record to the in-memory state.
+        """
+        kind = record[0]
+        if kind == REC_USER:
+            _, name, device, password, data = record
+            user_id = UserIdentifier(name, device, password)
+            if data is not None:
+                user_id.user_data = UserData()
+                (user_id.user_data.valid_until, user_id.user_data.num_joins,
+                 user_id.user_data.max_num_joins,
+                 user_id.user_data.join_state) = data
+            self._store(user_id)
+        elif kind == REC_REMOVE:
+            self._drop(UserIdentifier(record[1], record[2]))
+        elif kind == REC_REQUEST:
+            _, request_id, name, device, password = record
+            request = UserIdentifier(name, device, password)
+            self._requests[name] = (request_id, request)
+            self._devices[request.device_key] = request
+            self._next_request_id = max(self._next_request_id,
+                                        request_id + 1)
+        elif kind == REC_FINISH:
+            self._pop_request(record[1])
+        elif kind == REC_PASSWORD:
+            self._current_password = record[1]
+        elif kind == REC_NEXT_ID:
+            self._next_request_id = max(self._next_request_id, record[1])
+
+    def _load_snapshot(self):
+        """
+        Reads the snapshot, if any.
+
+        :returns: the generation of the first journal to replay
+        """
+        path = os.path.join(self._dir, SNAPSHOT_FILE)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0
+
+        generation = 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0,
+                                              access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b''):
+                record = _decode(line.decode())
+                if record[0] == REC_GENERATION:
+                    generation = record[1]
+                else:
+                    self._apply(record)
+
+        return generation
+
+    def _replay_journals(self):
+        """
+        Applies the journals written after the snapshot and deletes older
+        ones.
+        """
+        count = 0
+        for generation in self._journal_generations():
+            path = self._journal_path(generation)
+            if generation < self._generation:
+                os.unlink(path)
+                continue
+
+            with open(path, 'rb+') as f:
+                valid_size = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError()
+                        record = _decode(line.decode())
+                    except ValueError:
+                        # incomplete write during a crash
+                        logger.warning('Truncating %s after %d bytes'
+                                       % (path, valid_size))
+                        f.truncate(valid_size)
+                        break
+                    self._apply(record)
+                    valid_size += len(line)
+                    count += 1
+            self._generation = generation
+
+        self._records = count
+        logger.info('Loaded %d users and %d requests, replayed %d records'
+                    % (len(self._users), len(self._requests), count))
+
+    def _on_change(self, event, user_id):
+        """
+        Listener which buffers a journal record for each change.
+        """
+        if event == self.EVENT_UPDATE:
+            record = _user_record(user_id)
+        elif event == self.EVENT_REMOVE:
+            record = [REC_REMOVE, user_id.name, user_id.device_id]
+        elif event == self.EVENT_ADD_REQUEST:
+            request_id = self._requests[user_id.name][0]
+            record = [REC_REQUEST, request_id, user_id.name,
+                      user_id.device_id, user_id.password]
+        elif event == self.EVENT_FINISH_REQUEST:
+            record = [REC_FINISH, user_id.name]
+        elif event == self.EVENT_PASSWORD:
+            record = [REC_PASSWORD, self._current_password]
+        else:
+            return
+
+        line = _encode(record)
+        with self._cond:
+            self._buffer.append(line)
+
+    def _joined(self, user_id):
+        # the count only changes for users with a limit
+        if user_id.user_data.max_num_joins:
+            # _take_records replaces the set in the journal thread
+            with self._cond:
+                self._dirty.add((user_id.name, user_id.device_id))
+
+    def _take_records(self):
+        """
+        Returns the buffered records, including the changed join counts.
+        Has to be called with the lock held.
+        """
+        lines = self._buffer
+        self._buffer = []
+        dirty = self._dirty
+        self._dirty = set()
+        for name, device_id in dirty:
+            user_id = self.find_device(name, device_id)
+            if user_id is not None:
+                lines.append(_encode(_user_record(user_id)))
+        return lines
+
+    def _capture(self):
+        """
+        Returns the records describing the current state. Has to be called
+        with the lock held, directly after _take_records.
+        """
+        records = [[REC_PASSWORD, self._current_password],
+                   [REC_NEXT_ID, self._next_request_id]]
+        # in name order, such that loading the snapshot appends to the
+        # sorted name list
+        user_devices = self._user_devices
+        records.extend(_user_record(d) for name in list(self._names)
+                       for d in list(user_devices.get(name, {}).values()))
+        records.extend([REC_REQUEST, request_id, r.name, r.device_id,
+                        r.password]
+                       for request_id, r in list(self._requests.values()))
+        return records
+
+    def _write_snapshot(self, generation, records):
+        path = os.path.join(self._dir, SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_encode([REC_GENERATION, generation]))
+            f.write(b''.join(_encode(r) for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _commit(self, lines):
+        if lines:
+            self._journal.write(b''.join(lines))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._records += len(lines)
+
+    def _run(self):
+        while True:
+            snapshot = None
+            with self._cond:
+                if not self._quit:
+                    self._cond.wait(self.COMMIT_INTERVAL)
+                stop = self._quit
+                lines = self._take_records()
+                if stop or self._records + len(lines) >= self.SNAPSHOT_RECORDS:
+                    # Records after this point go to the next journal. They
+                    # may repeat changes contained in the snapshot, which is
+                    # harmless.
+                    snapshot = self._capture()
+
+            try:
+                self._commit(lines)
+                if snapshot is not None:
+                    self._rotate(snapshot)
+            except OSError:
+                logger.error('Failed to write the user journal', exc_info=1)
+
+            if stop:
+                return
+
+    def _rotate(self, snapshot):
+        """
+        Writes a snapshot and continues with a new journal.
+        """
+        old_generation = self._generation
+        self._generation += 1
+        self._journal.close()
+        self._journal = open(self._journal_path(self._generation), 'ab')
+        self._write_snapshot(self._generation, snapshot)
+        os.unlink(self._journal_path(old_generation))
+        self._records = 0
+
+    def close(self):
+        """
+        Writes outstanding changes and a snapshot, and stops the journal
+        thread.
+        """
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+        self._thread.join()
+        self._journal.close()
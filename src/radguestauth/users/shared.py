@@ -0,0 +1,300 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import stat
+import time
+import queue
+import fcntl
+import logging
+import functools
+
+from threading import Thread, Event, RLock
+from multiprocessing.managers import BaseManager
+
+from radguestauth.config import load_config
+from radguestauth.users.usermanager import UserManager
+
+
+DEFAULT_STATE_SOCKET = '/tmp/radguestauth-state.sock'
+DEFAULT_CHAT_LOCK = '/tmp/radguestauth-chat.lock'
+# seconds a worker waits for the state server to come up
+CONNECT_TIMEOUT = 10
+CONNECT_INTERVAL = 0.1
+
+
+logger = logging.getLogger(__name__)
+
+
+def _locked(method):
+    """
+    Wraps an UserManager method such that it holds the instance lock.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class LockedUserManager(UserManager):
+    """
+    UserManager which serializes all calls.
+
+    The state server handles each worker connection in its own thread, so
+    compound operations like may_join (which might remove an user) need to be
+    protected.
+    """
+
+    def __init__(self, max_pending=UserManager.DEFAULT_MAX_PENDING):
+        super(LockedUserManager, self).__init__(max_pending)
+        # re-entrant, as some methods call others (may_join -> remove)
+        self._lock = RLock()
+
+    may_join = _locked(UserManager.may_join)
+    admit = _locked(UserManager.admit)
+    is_request_pending = _locked(UserManager.is_request_pending)
+    can_add_request = _locked(UserManager.can_add_request)
+    add_request = _locked(UserManager.add_request)
+    get_request = _locked(UserManager.get_request)
+    find_request = _locked(UserManager.find_request)
+    list_requests = _locked(UserManager.list_requests)
+    finish_request = _locked(UserManager.finish_request)
+    find = _locked(UserManager.find)
+    find_device = _locked(UserManager.find_device)
+    find_by_mac = _locked(UserManager.find_by_mac)
+    list_devices = _locked(UserManager.list_devices)
+    set_device_limits = _locked(UserManager.set_device_limits)
+    add_users = _locked(UserManager.add_users)
+    update = _locked(UserManager.update)
+    remove = _locked(UserManager.remove)
+    list_users = _locked(UserManager.list_users)
+    count_users = _locked(UserManager.count_users)
+    count_blocked = _locked(UserManager.count_blocked)
+    get_expired_users = _locked(UserManager.get_expired_users)
+    get_expiring_within = _locked(UserManager.get_expiring_within)
+    generate_password = _locked(UserManager.generate_password)
+
+
+# Objects living in the state server process. They are created on first
+# access, i.e. only in the server process and never in the workers.
+_user_manager = None
+_outbox = None
+_max_pending = UserManager.DEFAULT_MAX_PENDING
+
+
+def _init_state_server(max_pending):
+    """
+    Runs in the state server process before it starts serving.
+    """
+    global _max_pending
+    _max_pending = max_pending
+
+
+def _get_user_manager():
+    global _user_manager
+    if _user_manager is None:
+        _user_manager = LockedUserManager(_max_pending)
+    return _user_manager
+
+
+def _get_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = queue.Queue()
+    return _outbox
+
+
+class StateManager(BaseManager):
+    """
+    Serves one UserManager and a queue of join notifications to all worker
+    processes. Return values are copies, which is fine as all callers store
+    modified users via UserManager.update.
+    """
+    pass
+
+
+StateManager.register('user_manager', callable=_get_user_manager)
+StateManager.register('outbox', callable=_get_outbox)
+
+
+def start_state_server(address=DEFAULT_STATE_SOCKET,
+                       max_pending=UserManager.DEFAULT_MAX_PENDING):
+    """
+    Starts the state server in a child process. This is intended to be called
+    once, before the workers are forked (e.g. in the gunicorn master).
+
+    :param address: Path of the unix socket to listen on
+    :param max_pending: size of the pending request queue
+    :returns: the started StateManager
+    """
+    remove_stale_socket(address)
+    manager = StateManager(address=address)
+    manager.start(_init_state_server, (max_pending,))
+    logger.info('Shared state server listening on %s' % address)
+    return manager
+
+
+def remove_stale_socket(address):
+    """
+    Removes the socket left from a previous run, but doesn't touch anything
+    else.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+    except FileNotFoundError:
+        pass
+
+
+def open_state(address=DEFAULT_STATE_SOCKET, timeout=CONNECT_TIMEOUT):
+    """
+    Connects to the state server at address.
+
+    The server is started by the gunicorn master (see on_starting in
+    radguestauth.server), or by running this module for the Flask
+    development server. Workers never start one: workers starting at the
+    same time would each get their own server and split the state.
+
+    :param timeout: seconds to retry while the server is starting up
+    :returns: a connected StateManager
+    :raises ConnectionError: if no server answers within timeout
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        manager = StateManager(address=address)
+        try:
+            manager.connect()
+            return manager
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() >= deadline:
+                raise ConnectionError('No state server at %s' % address)
+            time.sleep(CONNECT_INTERVAL)
+
+
+def main():
+    """
+    Runs the state server in the foreground, for setups without gunicorn
+    master (e.g. the Flask development server):
+
+    $ RADGUESTAUTH_CONFIG=config.ini python3 -m radguestauth.users.shared
+    """
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+    address = config.get('state_socket', DEFAULT_STATE_SOCKET)
+    _init_state_server(int(config.get('max_pending_requests',
+                                      UserManager.DEFAULT_MAX_PENDING)))
+    remove_stale_socket(address)
+    server = StateManager(address=address).get_server()
+    logger.info('Shared state server listening on %s' % address)
+    server.serve_forever()
+
+
+class ChatOwnership(object):
+    """
+    Inter-process lock deciding which worker holds the chat connection.
+
+    The lock is released by the OS when the owning process exits, so a
+    replacement worker can take over.
+    """
+
+    def __init__(self, path=DEFAULT_CHAT_LOCK):
+        self._path = path
+        self._fd = None
+
+    def acquire(self):
+        """
+        Tries to become the chat owner without blocking.
+
+        :returns: True if this instance owns the chat now
+        """
+        if self._fd is not None:
+            return True
+
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class ChatRelay(object):
+    """
+    Used instead of the ChatController in workers which do not own the chat.
+    Join notifications are passed to the owner via the state server, the
+    owner forwards them using a NotificationRelay.
+    """
+
+    def __init__(self, outbox):
+        self._outbox = outbox
+
+    def start(self, config):
+        pass
+
+    def notify_join(self, user_id):
+        self._outbox.put(user_id)
+
+    def queued_messages(self):
+        # notifications which were not taken over by the chat owner yet
+        return self._outbox.qsize()
+
+    def queued_commands(self):
+        # commands are run by the chat owner
+        return 0
+
+    def chat_counters(self):
+        # counted by the chat owner
+        return {}
+
+    def stop(self):
+        pass
+
+
+class NotificationRelay(object):
+    """
+    Runs in the chat owner and hands join notifications from other workers to
+    the ChatController.
+    """
+
+    # seconds to wait for a notification before checking for shutdown
+    POLL_TIMEOUT = 1
+
+    def __init__(self, outbox, chat_controller):
+        self._outbox = outbox
+        self._chat_controller = chat_controller
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                user_id = self._outbox.get(timeout=self.POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                logger.error('Lost connection to state server.')
+                return
+
+            self._chat_controller.notify_join(user_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sqlite3
+import logging
+
+from threading import Lock, Timer
+
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+# /tmp and /var are tmpfs on OpenWRT, so keep the database in /etc, which is
+# on the persistent overlay
+DEFAULT_STATE_DB = '/etc/radguestauth/users.db'
+
+
+logger = logging.getLogger(__name__)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    password TEXT,
+    has_data INTEGER NOT NULL,
+    valid_until REAL,
+    num_joins INTEGER,
+    max_num_joins INTEGER,
+    join_state INTEGER,
+    PRIMARY KEY (name, device_id)
+);
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    password TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _user_row(user_id):
+    data = user_id.user_data
+    if isinstance(data, UserData):
+        return (user_id.name, user_id.device_id, user_id.password, 1,
+                data.valid_until, data.num_joins, data.max_num_joins,
+                data.join_state)
+
+    return (user_id.name, user_id.device_id, user_id.password, 0,
+            None, None, None, None)
+
+
+def _user_from_row(row):
+    (name, device_id, password, has_data, valid_until, num_joins,
+     max_num_joins, join_state) = row
+    user_id = UserIdentifier(name, device_id, password)
+    if has_data:
+        data = UserData()
+        data.valid_until = valid_until
+        data.num_joins = num_joins
+        data.max_num_joins = max_num_joins
+        data.join_state = join_state
+        user_id.user_data = data
+
+    return user_id
+
+
+class SqliteUserManager(UserManager):
+    """
+    UserManager which keeps users, pending requests and the guest password in
+    an SQLite database, such that they survive restarts.
+
+    All data is read into the in-memory structures of UserManager once on
+    construction, so lookups (e.g. may_join) never touch the database.
+    Changes are written through on every UserManager event. The only
+    exception are join counts increased by may_join (see _joined), which are
+    written FLUSH_DELAY seconds later to keep disk writes off the authorize
+    path.
+    """
+
+    # seconds until increased join counts get written
+    FLUSH_DELAY = 5
+
+    def __init__(self, path=DEFAULT_STATE_DB,
+                 max_pending=UserManager.DEFAULT_MAX_PENDING):
+        """
+        :param path: database file, created with its directory if it does
+            not exist
+        :param max_pending: see UserManager
+        """
+        super(SqliteUserManager, self).__init__(max_pending)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The connection is used by the request handler, the chat thread and
+        # the flush timer.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = Lock()
+        # (name, device ID) of users with unwritten join counts
+        self._dirty = set()
+        self._flush_timer = None
+        # rows of an add_users call, written in one transaction
+        self._batch = None
+
+        with self._db_lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(_SCHEMA)
+
+        self._load()
+        self.add_listener(self._on_change)
+
+    def _load(self):
+        cursor = self._db.execute(
+            'SELECT name, device_id, password, has_data, valid_until, '
+            'num_joins, max_num_joins, join_state FROM users ORDER BY name'
+        )
+        for row in cursor:
+            self._store(_user_from_row(row))
+
+        cursor = self._db.execute(
+            'SELECT id, name, device_id, password FROM requests ORDER BY id'
+        )
+        for request_id, name, device_id, password in cursor:
+            request = UserIdentifier(name, device_id, password)
+            self._requests[name] = (request_id, request)
+            self._devices.setdefault(request.device_key, request)
+            self._next_request_id = request_id + 1
+
+        for key, value in self._db.execute('SELECT key, value FROM meta'):
+            if key == 'password':
+                self._current_password = value
+            elif key == 'next_request_id':
+                self._next_request_id = max(self._next_request_id,
+                                            int(value))
+
+        logger.info('Loaded %d users and %d requests from the database'
+                    % (len(self._users), len(self._requests)))
+
+    def _write_user(self, user_id):
+        self._db.execute(
+            'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            _user_row(user_id)
+        )
+
+    def _on_change(self, event, user_id):
+        """
+        Listener writing each change of the in-memory state.
+        """
+        if self._batch is not None and event == self.EVENT_UPDATE:
+            self._batch.append(_user_row(user_id))
+            return
+
+        with self._db_lock, self._db:
+            if event == self.EVENT_UPDATE:
+                self._write_user(user_id)
+                self._dirty.discard((user_id.name, user_id.device_id))
+            elif event == self.EVENT_REMOVE:
+                self._db.execute(
+                    'DELETE FROM users WHERE name = ? AND device_id = ?',
+                    (user_id.name, user_id.device_id)
+                )
+                self._dirty.discard((user_id.name, user_id.device_id))
+            elif event == self.EVENT_ADD_REQUEST:
+                request_id = self._requests[user_id.name][0]
+                self._db.execute(
+                    'INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?)',
+                    (request_id, user_id.name, user_id.device_id,
+                     user_id.password)
+                )
+                self._db.execute(
+                    'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                    ('next_request_id', str(self._next_request_id))
+                )
+            elif event == self.EVENT_FINISH_REQUEST:
+                self._db.execute('DELETE FROM requests WHERE name = ?',
+                                 (user_id.name,))
+            elif event == self.EVENT_PASSWORD:
+                self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                 ('password', self._current_password))
+
+    def add_users(self, user_ids):
+        # one transaction for all devices instead of one per device
+        self._batch = []
+        try:
+            skipped = super(SqliteUserManager, self).add_users(user_ids)
+        finally:
+            rows = self._batch
+            self._batch = None
+            with self._db_lock, self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO users VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?)', rows
+                )
+        return skipped
+
+    def _joined(self, user_id):
+        # the count only changes for users with a limit
+        if user_id.user_data.max_num_joins:
+            self._mark_dirty((user_id.name, user_id.device_id))
+
+    def _mark_dirty(self, key):
+        if key in self._dirty and self._flush_timer is not None:
+            # already scheduled, skip the lock
+            return
+        with self._db_lock:
+            self._dirty.add(key)
+            if self._flush_timer is None:
+                self._flush_timer = Timer(self.FLUSH_DELAY, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        """
+        Writes the pending join count changes.
+        """
+        with self._db_lock, self._db:
+            self._flush_timer = None
+            for name, device_id in self._dirty:
+                user_id = self.find_device(name, device_id)
+                if user_id is not None:
+                    self._write_user(user_id)
+            self._dirty = set()
+
+    def close(self):
+        """
+        Writes outstanding changes and closes the database.
+        """
+        timer = self._flush_timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
@@ -2,13 +2,23 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import re
 import time
 
 
+# the hex digits of a MAC address without separators. int() alone would
+# also accept signs, whitespace, '_', a 0x prefix and non-ASCII digits.
+_MAC_DIGITS = re.compile('[0-9a-fA-F]{12}')
+
+
 class UserIdentifier(object):
     """
     Describes an user entity.
     """
+    # One instance is kept per user and one is created per request, so avoid
+    # the memory and allocation of an instance dict.
+    __slots__ = ('name', '_device_id', '_device_key', 'password',
+                 'user_data')
 
     def __init__(self, name, device_id, password=None):
         self.name = name
@@ -16,14 +26,34 @@ class UserIdentifier(object):
         self.password = password
         self.user_data = None
 
+    @property
+    def device_id(self):
+        return self._device_id
+
+    @device_id.setter
+    def device_id(self, device_id):
+        self._device_id = device_id
+        self._device_key = None
+
+    @property
+    def device_key(self):
+        """
+        The device ID normalized by device_key_of. It is computed once on
+        first use, as known users are looked up by name only.
+        """
+        if self._device_key is None:
+            self._device_key = UserIdentifier.device_key_of(self._device_id)
+        return self._device_key
+
     def __eq__(self, cmp):
         # users are considered equal if name and device match, regardless
-        # what user_data is assigned or what password is stored
+        # what user_data is assigned or what password is stored. Devices are
+        # compared by device_key, so all notations of a MAC address match.
         if not isinstance(cmp, UserIdentifier):
             return False
 
         return (self.name == cmp.name
-                and self.device_id == cmp.device_id)
+                and self.device_key == cmp.device_key)
 
     def __str__(self):
         pw_str = (('Password: ' + self.password) if self.password
@@ -65,11 +95,50 @@ class UserIdentifier(object):
         """
         return rad_device_id.replace('-', ':').lower()
 
+    @staticmethod
+    def parse_mac(rad_device_id):
+        """
+        Converts a MAC address separated by dashes or colons (or not at all)
+        to a 48-bit integer.
+
+        :returns: the integer, or None if the device ID is no MAC address
+        """
+        digits = rad_device_id.replace('-', '').replace(':', '')
+        if _MAC_DIGITS.fullmatch(digits) is None:
+            return None
+        return int(digits, 16)
+
+    @staticmethod
+    def device_key_of(rad_device_id):
+        """
+        Gets the key under which UserManager indexes a device: the MAC
+        address as integer (see parse_mac), such that all notations of a MAC
+        are equal. Device IDs which are no MAC address are kept as string,
+        formatted like format_mac.
+
+        If an UserIdentifier object is available, use its device_key
+        attribute, which is only computed once.
+        """
+        mac = UserIdentifier.parse_mac(rad_device_id)
+        if mac is None:
+            return rad_device_id.replace('-', ':').lower()
+        return mac
+
+    @staticmethod
+    def mac_to_str(mac):
+        """
+        Formats a MAC address integer like format_mac.
+        """
+        digits = '%012x' % mac
+        return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
 
 class UserData(object):
     """
     Describes additional data assigned to an User.
     """
+    __slots__ = ('valid_until', 'num_joins', 'max_num_joins', 'join_state')
+
     # See UserManager.may_join for details on state transitions.
     JOIN_STATE_NEW = 0
     JOIN_STATE_WAITING = 1
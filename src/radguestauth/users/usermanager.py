@@ -4,24 +4,90 @@
 
 import time
 
+from bisect import bisect_left, insort
 from random import SystemRandom
-from operator import attrgetter
+from collections import OrderedDict
 
 from radguestauth.users.storage import UserIdentifier, UserData
+from radguestauth.users.deadlines import DeadlineHeap
 
 
 class UserManager(object):
     """
     Keeps track of known users and provides logic to let new users join.
     """
+    # Events passed to listeners, see add_listener
+    EVENT_ADD_REQUEST = 'add_request'
+    EVENT_FINISH_REQUEST = 'finish_request'
+    EVENT_UPDATE = 'update'
+    EVENT_REMOVE = 'remove'
+    EVENT_PASSWORD = 'password'
 
-    def __init__(self):
-        self._request_user = None
+    DEFAULT_MAX_PENDING = 1
+    DEFAULT_MAX_DEVICES = 1
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param max_pending: number of join requests which may wait for the
+            host at the same time
+        """
+        # pending requests in order of arrival:
+        # user name -> (request ID, UserIdentifier)
+        self._requests = OrderedDict()
+        self._max_pending = max_pending
+        self._next_request_id = 1
         self._current_password = ''
-        # keeps UserIdentifier objects with their name as key
+        # keeps UserIdentifier objects with their name as key. With several
+        # devices per user, this is the first one (see list_devices).
         self._users = dict()
-        # also keep track of used MAC addresses to avoid duplicates
-        self._mac_addrs = set()
+        # all devices of the users: name -> {device key -> UserIdentifier},
+        # each device with its own UserData. The device key (see
+        # UserIdentifier.device_key) matches all notations of a MAC address.
+        self._user_devices = dict()
+        # sorted names of all users, for list_users
+        self._names = []
+        # valid_until of the devices with a validity time, by
+        # (name, device key)
+        self._deadlines = DeadlineHeap()
+        # (name, device key) -> UserIdentifier of the devices which used up
+        # their number of joins
+        self._exhausted = dict()
+        # (name, device key) of the blocked devices, and user name -> number
+        # of blocked devices, for count_blocked
+        self._blocked = set()
+        self._blocked_users = dict()
+        self._max_devices = self.DEFAULT_MAX_DEVICES
+        self._approve_per_user = False
+        # also keep track of used MAC addresses to avoid duplicates:
+        # UserIdentifier.device_key -> user or request UserIdentifier
+        self._devices = dict()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Registers a function which is called after the stored users changed.
+
+        :param listener: callable taking two arguments: one of the EVENT
+            constants, and the affected UserIdentifier (None for
+            EVENT_PASSWORD).
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, event, user_id):
+        for listener in self._listeners:
+            listener(event, user_id)
+
+    def set_device_limits(self, max_devices, approve_per_user=False):
+        """
+        Allows users to join with more than one device.
+
+        :param max_devices: number of devices per user name
+        :param approve_per_user: If True, further devices of an allowed user
+            join without asking the host, with the limits of the user.
+            Otherwise, the host gets a join request for each device.
+        """
+        self._max_devices = max_devices
+        self._approve_per_user = approve_per_user
 
     def may_join(self, user_id):
         """
@@ -38,23 +104,27 @@ class UserManager(object):
         if not isinstance(user_id, UserIdentifier):
             return UserData.JOIN_STATE_BLOCKED
 
-        # The request user doesn't have UserData assigned yet,
+        # Request users don't have UserData assigned yet,
         # so handle separately before querying the user list.
-        if (self._request_user and user_id == self._request_user):
+        request = self._requests.get(user_id.name)
+        if request and user_id == request[1]:
             return UserData.JOIN_STATE_WAITING
 
-        stored = self._users.get(user_id.name)
+        devices = self._user_devices.get(user_id.name)
         # When the user wasn't found, a new request can be added if there
         # is no other user with this MAC/device ID
-        if stored is None:
-            if user_id.device_id_as_mac() in self._mac_addrs:
+        if devices is None:
+            if user_id.device_key in self._devices:
                 return UserData.JOIN_STATE_BLOCKED
 
             return UserData.JOIN_STATE_NEW
 
-        # block user if devices don't match or data is invalid
-        if (user_id != stored
-                or not isinstance(stored.user_data, UserData)):
+        stored = devices.get(user_id.device_key)
+        if stored is None:
+            return self._may_add_device(user_id, devices)
+
+        # block user if data is invalid
+        if not isinstance(stored.user_data, UserData):
             return UserData.JOIN_STATE_BLOCKED
 
         # If the user is blocked do not process time or number of joins
@@ -64,67 +134,441 @@ class UserManager(object):
         # finally check validity time and number of joins, and remove the user
         # if any is exceeded. Then, the host will be prompted again.
         if stored.check_expired(True):
-            self.remove(user_id)
+            self.remove(stored)
             return UserData.JOIN_STATE_NEW
+        if stored.user_data.max_num_joins:
+            self._index_joins(stored)
+        self._joined(stored)
 
         # at this point, all checks are passed and the stored state can be
         # considered (very likely ALLOWED).
         return stored.user_data.join_state
 
+    def admit(self, user_id):
+        """
+        Runs the steps of an authorize request in one call: may_join, then
+        the lookup of the stored device or request, and a new request for a
+        new device. A shared UserManager is thereby asked once per request.
+
+        :returns: tuple (state, device, added). device is the stored device
+            or request (the given user_id if blocked), or None if a new
+            device could not be requested, e.g. as the queue is full. added
+            is True if the request was just added, state is WAITING then.
+        """
+        state = self.may_join(user_id)
+        if state == UserData.JOIN_STATE_ALLOWED:
+            return (state, self.find_device(user_id.name, user_id.device_id),
+                    False)
+        if state == UserData.JOIN_STATE_WAITING:
+            return (state, self.find_request(user_id.name), False)
+        if state == UserData.JOIN_STATE_NEW:
+            if not self.can_add_request() or not self.add_request(user_id):
+                return (state, None, False)
+            return (UserData.JOIN_STATE_WAITING,
+                    self.find_request(user_id.name), True)
+        return (state, user_id, False)
+
+    def _may_add_device(self, user_id, devices):
+        """
+        may_join for a device which is not yet known for this user.
+        """
+        if (len(devices) >= self._max_devices
+                or user_id.device_key in self._devices):
+            return UserData.JOIN_STATE_BLOCKED
+
+        data = self._users[user_id.name].user_data
+        if not isinstance(data, UserData):
+            return UserData.JOIN_STATE_BLOCKED
+        if data.join_state == UserData.JOIN_STATE_BLOCKED:
+            return UserData.JOIN_STATE_BLOCKED
+
+        if self._approve_per_user and not data.check_expired():
+            # the host allowed the user, so take over the limits
+            device = UserIdentifier(user_id.name, user_id.device_id,
+                                    self._users[user_id.name].password)
+            device.user_data = UserData()
+            device.user_data.valid_until = data.valid_until
+            device.user_data.max_num_joins = data.max_num_joins
+            device.user_data.join_state = data.join_state
+            self._store(device)
+            self._notify(self.EVENT_UPDATE, device)
+            return self.may_join(user_id)
+
+        # ask the host
+        return UserData.JOIN_STATE_NEW
+
+    def _joined(self, user_id):
+        """
+        Called by may_join for a stored user which passed the expiry check.
+        Its num_joins may have been increased, but listeners are not notified
+        as this happens on every join. Subclasses which persist users may
+        override it.
+        """
+        pass
+
     def is_request_pending(self):
-        return (self._request_user is not None)
+        return len(self._requests) > 0
+
+    def can_add_request(self):
+        """
+        Indicates whether the queue of pending requests has space left.
+        """
+        return len(self._requests) < self._max_pending
 
     def add_request(self, user_id):
+        """
+        Appends a join request to the queue.
+
+        :returns: True if the request was added, False if the queue is full
+            or the user is already known or requested.
+        """
         if not isinstance(user_id, UserIdentifier):
             return False
 
-        if self.is_request_pending():
+        if not self.can_add_request():
             return False
 
-        # TODO: this form only allows each name to be used once, with one
-        # device. Enhance such that multiple devices are possible
-        if self._users.get(user_id.name):
+        # one request per name at a time, and no devices of other users
+        if (user_id.name in self._requests
+                or user_id.device_key in self._devices):
+            return False
+        devices = self._user_devices.get(user_id.name)
+        if devices is not None and len(devices) >= self._max_devices:
             return False
 
-        self._request_user = UserIdentifier(user_id.name, user_id.device_id,
-                                            self._current_password)
-        self._mac_addrs.add(user_id.device_id_as_mac())
+        request = UserIdentifier(user_id.name, user_id.device_id,
+                                 self._current_password)
+        self._requests[user_id.name] = (self._next_request_id, request)
+        self._next_request_id += 1
+        self._devices[request.device_key] = request
+        self._notify(self.EVENT_ADD_REQUEST, request)
 
         return True
 
-    def get_request(self):
-        return self._request_user
+    def _find_request_name(self, request_id):
+        if request_id is None:
+            return next(iter(self._requests), None)
 
-    def finish_request(self):
-        self._request_user = None
+        for name, (req_id, _) in self._requests.items():
+            if req_id == request_id:
+                return name
+        return None
+
+    def get_request(self, request_id=None):
+        """
+        :param request_id: ID of the request, or None for the oldest one
+        :returns: the UserIdentifier of the request, or None
+        """
+        name = self._find_request_name(request_id)
+        if name is None:
+            return None
+        return self._requests[name][1]
+
+    def find_request(self, username):
+        """
+        :returns: the UserIdentifier of the user's request, or None
+        """
+        request = self._requests.get(username)
+        if request is None:
+            return None
+        return request[1]
+
+    def list_requests(self):
+        """
+        :returns: list of (request ID, UserIdentifier) tuples, the oldest
+            request first
+        """
+        return list(self._requests.values())
+
+    def finish_request(self, request_id=None):
+        """
+        Removes a request from the queue.
+
+        :param request_id: ID of the request, or None for the oldest one
+        """
+        name = self._find_request_name(request_id)
+        if name is not None:
+            req = self._pop_request(name)
+            self._notify(self.EVENT_FINISH_REQUEST, req)
+
+    def _pop_request(self, name):
+        """
+        Removes a request, without notifying listeners. The device is
+        released unless it was stored for the user meanwhile.
+
+        :returns: the UserIdentifier of the request, or None
+        """
+        entry = self._requests.pop(name, None)
+        if entry is None:
+            return None
+        req = entry[1]
+        stored = self._user_devices.get(name, dict()).get(req.device_key)
+        if stored is None and self._devices.get(req.device_key) is req:
+            del self._devices[req.device_key]
+        return req
 
     def find(self, username):
         return self._users.get(username)
 
+    def find_device(self, username, device_id):
+        """
+        :returns: the UserIdentifier of the user's device, or None
+        """
+        devices = self._user_devices.get(username)
+        if devices is None:
+            return None
+        return devices.get(UserIdentifier.device_key_of(device_id))
+
+    def list_devices(self, username):
+        """
+        :returns: list of the UserIdentifier objects of all devices of the
+            user, the first one is the one returned by find
+        """
+        return list(self._user_devices.get(username, dict()).values())
+
+    def find_by_mac(self, mac):
+        """
+        Looks up the user or pending request of a device.
+
+        :param mac: device ID as string, or a MAC address as integer (see
+            UserIdentifier.parse_mac)
+        :returns: UserIdentifier, or None if the device is unknown
+        """
+        if isinstance(mac, str):
+            mac = UserIdentifier.device_key_of(mac)
+        return self._devices.get(mac)
+
+    def _store(self, user_id):
+        """
+        Adds or replaces a device, without notifying listeners.
+        """
+        devices = self._user_devices.get(user_id.name)
+        if devices is None:
+            devices = self._user_devices[user_id.name] = dict()
+            # O(log n) when loading in name order, as the name is appended
+            insort(self._names, user_id.name)
+        devices[user_id.device_key] = user_id
+        primary = self._users.get(user_id.name)
+        if primary is None or primary.device_key == user_id.device_key:
+            self._users[user_id.name] = user_id
+        self._devices[user_id.device_key] = user_id
+        self._index_limits(user_id)
+
+    def _index_limits(self, user_id):
+        """
+        Updates the deadline heap and the join limited devices after a
+        device was stored.
+        """
+        key = (user_id.name, user_id.device_key)
+        data = user_id.user_data
+        if not isinstance(data, UserData):
+            data = None
+
+        self._deadlines.set(key, data.valid_until if data else None)
+
+        if data and data.max_num_joins:
+            self._index_joins(user_id)
+        else:
+            self._exhausted.pop(key, None)
+
+        if data and data.join_state == UserData.JOIN_STATE_BLOCKED:
+            if key not in self._blocked:
+                self._blocked.add(key)
+                self._blocked_users[key[0]] = (
+                    self._blocked_users.get(key[0], 0) + 1
+                )
+        else:
+            self._unblock(key)
+
+    def _index_joins(self, user_id):
+        """
+        Tracks whether a device with a join limit used up its joins, called
+        when it is stored and when it joined.
+        """
+        data = user_id.user_data
+        key = (user_id.name, user_id.device_key)
+        if data.num_joins >= data.max_num_joins:
+            self._exhausted[key] = user_id
+        else:
+            self._exhausted.pop(key, None)
+
+    def _unblock(self, key):
+        if key in self._blocked:
+            self._blocked.remove(key)
+            if self._blocked_users[key[0]] == 1:
+                del self._blocked_users[key[0]]
+            else:
+                self._blocked_users[key[0]] -= 1
+
+    def _drop(self, user_id):
+        """
+        Removes a device, without notifying listeners.
+
+        :returns: the stored device, or None if the device was unknown
+        """
+        devices = self._user_devices.get(user_id.name)
+        stored = None
+        if devices is not None:
+            stored = devices.pop(user_id.device_key, None)
+        if stored is None:
+            return None
+
+        self._devices.pop(user_id.device_key, None)
+        key = (user_id.name, user_id.device_key)
+        self._deadlines.discard(key)
+        self._exhausted.pop(key, None)
+        self._unblock(key)
+        if not devices:
+            del self._user_devices[user_id.name]
+            del self._users[user_id.name]
+            del self._names[bisect_left(self._names, user_id.name)]
+        elif self._users[user_id.name].device_key == user_id.device_key:
+            # the next device becomes the one returned by find
+            self._users[user_id.name] = next(iter(devices.values()))
+        return stored
+
+    def add_users(self, user_ids):
+        """
+        Stores devices which were approved without a join request, e.g.
+        imported from a guest list (see radguestauth.users.bulk). Known
+        devices are replaced. Devices without password get the current
+        guest password.
+
+        :param user_ids: list of UserIdentifier objects with UserData
+        :returns: list of the devices which were skipped, as the device is
+            used by another user or a pending request, or the user has
+            reached the device limit
+        """
+        skipped = []
+        for user_id in user_ids:
+            known = self.find_device(user_id.name, user_id.device_id)
+            owner = self._devices.get(user_id.device_key)
+            devices = self._user_devices.get(user_id.name)
+            if ((owner is not None and owner is not known)
+                    or (known is None and devices is not None
+                        and len(devices) >= self._max_devices)):
+                skipped.append(user_id)
+                continue
+
+            if known is not None:
+                # keep the notation the device was stored with
+                user_id.device_id = known.device_id
+            if user_id.password is None:
+                user_id.password = self._current_password
+            self._store(user_id)
+            self._notify(self.EVENT_UPDATE, user_id)
+
+        return skipped
+
     def update(self, user_id):
+        """
+        Stores changes of a device, or adds the device of a request.
+        """
         if not isinstance(user_id, UserIdentifier):
             return
 
-        # update a stored item, or add the request user to the list
-        if self._users.get(user_id.name) or self._request_user == user_id:
-            self._users[user_id.name] = user_id
+        known = self.find_device(user_id.name, user_id.device_id)
+        if known is not None:
+            # keep the notation the device was stored with
+            user_id.device_id = known.device_id
+        if known is not None or self.find_request(user_id.name) == user_id:
+            self._store(user_id)
+            self._notify(self.EVENT_UPDATE, user_id)
 
     def remove(self, user_id):
+        """
+        Removes a device of a user. The user is removed with the last device.
+        """
         if not isinstance(user_id, UserIdentifier):
             return
 
-        if self._users.get(user_id.name):
-            self._mac_addrs.remove(user_id.device_id_as_mac())
-            self._users.pop(user_id.name)
+        stored = self._drop(user_id)
+        if stored is not None:
+            # listeners store the device in its original notation
+            self._notify(self.EVENT_REMOVE, stored)
 
-    def list_users(self):
-        return sorted(self._users.values(), key=attrgetter('name'))
+    def _name_range(self, prefix):
+        """
+        :returns: tuple (start, end) of the names starting with prefix in
+            the sorted name list
+        """
+        if not prefix:
+            return (0, len(self._names))
+
+        # all names with the prefix are below the prefix with its last
+        # character incremented
+        end = prefix[:-1] + chr(min(ord(prefix[-1]) + 1, 0x10ffff))
+        return (bisect_left(self._names, prefix),
+                bisect_left(self._names, end))
+
+    def list_users(self, prefix=None, offset=0, limit=None):
+        """
+        Lists users ordered by name, with the first device of each user
+        (see list_devices). The order is maintained on changes, so this
+        costs O(log n + k) for k returned users.
+
+        :param prefix: only list users whose name starts with this string
+        :param offset: number of matching users to skip
+        :param limit: maximum number of users to return, None for all
+        """
+        start, end = self._name_range(prefix)
+        start += offset
+        if limit is not None:
+            end = min(end, start + limit)
+        return [self._users[name] for name in self._names[start:end]]
+
+    def count_users(self, prefix=None):
+        """
+        :returns: the number of users whose name starts with prefix, or of
+            all users
+        """
+        start, end = self._name_range(prefix)
+        return end - start
+
+    def count_blocked(self):
+        """
+        :returns: the number of users with a blocked device, in O(1) as
+            blocked devices are indexed on changes like the limits
+        """
+        return len(self._blocked_users)
 
     def get_expired_users(self):
-        return list(filter(lambda u: u.check_expired(), self._users.values()))
+        """
+        Finds the expired devices of all users in O(k log k) for k expired
+        devices. The limits are indexed by update and may_join, so changes
+        of the UserData have to be passed to update as usual.
+
+        :returns: list of the expired devices, those with an expired
+            validity time first and ordered by it
+        """
+        expired = self._deadlines.before(time.time())
+        result = [self._user_devices[name][device_key]
+                  for _, (name, device_key) in expired]
+
+        found = set(key for _, key in expired)
+        result.extend(device for key, device in self._exhausted.items()
+                      if key not in found)
+
+        return result
+
+    def get_expiring_within(self, seconds):
+        """
+        Finds the devices whose validity time ends within the given time,
+        in O(k log k) for k results. Devices which already expired and the
+        join limits are not considered.
+
+        :param seconds: time span from now
+        :returns: list of the devices, ordered by valid_until
+        """
+        now = time.time()
+        return [self._user_devices[name][device_key]
+                for valid_until, (name, device_key)
+                in self._deadlines.before(now + seconds)
+                if valid_until >= now]
 
     def generate_password(self):
         # TODO: For now, use random numbers. Improve this mechanism later.
         rand = SystemRandom()
         self._current_password = str(rand.randint(0, 999999))
+        self._notify(self.EVENT_PASSWORD, None)
         return self._current_password
@@ -0,0 +1,53 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from abc import ABCMeta, abstractmethod
+
+
+class UserStorage(object):
+    """
+    Interface which defines where the users of the guest auth module are
+    kept. Implementations are selected with the user_storage config key and
+    provide the UserManager used by the core module, so they only differ in
+    persistence and sharing, not in the join logic.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def open(self, config, max_pending):
+        """
+        Called when the guest auth module starts.
+
+        :param config: config dict from core module
+        :param max_pending: size of the pending request queue
+        :returns: the UserManager to use
+        """
+        return NotImplemented
+
+    def shared_state(self):
+        """
+        Returns the connection to a state server if the users are shared
+        with other processes, which requires the chat to be owned by one of
+        them. Storages used by one process only return None.
+        """
+        return None
+
+    def close(self):
+        """
+        Called before the guest auth module exits. Outstanding changes
+        should be written here.
+        """
+        pass
+
+
+def storage_name(config):
+    """
+    Returns the UserStorage selected by the config dict. state_backend is
+    the former name of the user_storage key, where the in-memory storage was
+    called local.
+    """
+    name = config.get('user_storage', config.get('state_backend', 'memory'))
+    if name == 'local':
+        return 'memory'
+    return name
@@ -0,0 +1,26 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from radguestauth.userstorage import UserStorage
+from radguestauth.users.journal import JournalUserManager, DEFAULT_STATE_DIR
+
+
+class JournalUserStorage(UserStorage):
+    """
+    Keeps the users in journal and snapshot files in the state_dir
+    directory, see JournalUserManager.
+    """
+
+    def __init__(self):
+        self._user_manager = None
+
+    def open(self, config, max_pending):
+        self._user_manager = JournalUserManager(
+            config.get('state_dir', DEFAULT_STATE_DIR), max_pending
+        )
+        return self._user_manager
+
+    def close(self):
+        if self._user_manager is not None:
+            self._user_manager.close()
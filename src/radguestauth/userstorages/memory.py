@@ -0,0 +1,15 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from radguestauth.userstorage import UserStorage
+from radguestauth.users.usermanager import UserManager
+
+
+class MemoryUserStorage(UserStorage):
+    """
+    Keeps the users in memory. They are lost on restart.
+    """
+
+    def open(self, config, max_pending):
+        return UserManager(max_pending)
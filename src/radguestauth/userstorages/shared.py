@@ -0,0 +1,28 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import radguestauth.users.shared as shared
+
+from radguestauth.userstorage import UserStorage
+
+
+class SharedUserStorage(UserStorage):
+    """
+    Keeps the users in a state server process shared by all workers, which
+    is reached via the unix socket given by the state_socket config key. The
+    server has to be started before, see shared.open_state.
+    """
+
+    def __init__(self):
+        self._state = None
+
+    def open(self, config, max_pending):
+        # the size of the request queue is set when the server starts
+        self._state = shared.open_state(
+            config.get('state_socket', shared.DEFAULT_STATE_SOCKET)
+        )
+        return self._state.user_manager()
+
+    def shared_state(self):
+        return self._state
@@ -0,0 +1,26 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from radguestauth.userstorage import UserStorage
+from radguestauth.users.sqlite import SqliteUserManager, DEFAULT_STATE_DB
+
+
+class SqliteUserStorage(UserStorage):
+    """
+    Keeps the users in the SQLite database given by the state_db config
+    key, see SqliteUserManager.
+    """
+
+    def __init__(self):
+        self._user_manager = None
+
+    def open(self, config, max_pending):
+        self._user_manager = SqliteUserManager(
+            config.get('state_db', DEFAULT_STATE_DB), max_pending
+        )
+        return self._user_manager
+
+    def close(self):
+        if self._user_manager is not None:
+            self._user_manager.close()
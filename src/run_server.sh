@@ -15,5 +15,22 @@ fi;
 # start by copying example_config.ini to config.ini in this directory (src).
 # It will work in the Vagrant env.
 # You can also give the config file name as argument to this script.
-RADGUESTAUTH_CONFIG=${1:-config.ini} gunicorn --log-level debug -b 127.0.0.1:5000 \
-"radguestauth.server:create_app()" -c python:radguestauth.server
+# The listen address can be set via RADGUESTAUTH_BIND, use
+# unix:/path/to/socket for a unix domain socket (see README).
+# RADGUESTAUTH_SOCKET_GROUP gives the group which may connect to it.
+BIND=${RADGUESTAUTH_BIND:-127.0.0.1:5000}
+SOCKET_ARGS=()
+case "$BIND" in
+  unix:*)
+    # gunicorn creates the socket with umask 0, so any local user could
+    # connect to the unauthenticated endpoints
+    SOCKET_ARGS+=(--umask 007)
+    if [ -n "$RADGUESTAUTH_SOCKET_GROUP" ]
+    then
+      SOCKET_ARGS+=(--group "$RADGUESTAUTH_SOCKET_GROUP")
+    fi
+    ;;
+esac
+RADGUESTAUTH_CONFIG=${1:-config.ini} gunicorn --log-level debug -b "$BIND" \
+"${SOCKET_ARGS[@]}" "radguestauth.server:create_app()" \
+-c python:radguestauth.server
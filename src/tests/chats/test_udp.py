@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import queue
+import socket
+
+from unittest import TestCase
+from radguestauth.chats.udp import UdpChat, split_message
+
+
+class UdpChatTest(TestCase):
+    def setUp(self):
+        # plays the host side
+        self.host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.host.bind(('127.0.0.1', 0))
+        self.host.settimeout(2)
+        self.chat = UdpChat()
+        self.chat.NET_HOST_PORT = self.host.getsockname()[1]
+        self.received = queue.Queue()
+        self.chat.register_receive(self.received.put)
+
+    def tearDown(self):
+        self.chat.shutdown()
+        self.host.close()
+
+    def test_message_sent_immediately(self):
+        self.chat.startup({})
+        start = time.perf_counter()
+        self.chat.send_message('join request')
+
+        data, address = self.host.recvfrom(1024)
+        # the previous implementation polled once per second
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(data, b'join request\n')
+        self.assertEqual(self.chat.queued_messages(), 0)
+
+        self.host.sendto(b'OK', address)
+        self.assertEqual(self.received.get(timeout=2), 'OK')
+
+    def test_messages_before_startup(self):
+        self.chat.send_message('first')
+        self.chat.send_message('second')
+        self.assertEqual(self.chat.queued_messages(), 2)
+
+        self.chat.startup({})
+
+        # one datagram per message
+        self.assertEqual(self.host.recv(1024), b'first\n')
+        self.assertEqual(self.host.recv(1024), b'second\n')
+
+    def test_config(self):
+        self.chat.startup({'udp_mtu': '10', 'udp_max_queue': '5',
+                           'udp_overflow': 'drop_new'})
+
+        self.assertEqual(self.chat._mtu, UdpChat.MIN_MTU)
+        self.assertEqual(self.chat._max_queue, 5)
+        self.assertTrue(self.chat._drop_new)
+
+    def test_outbox_bounded(self):
+        # the outbox is filled before the thread sends anything
+        self.chat._max_queue = 2
+        for i in range(4):
+            self.chat.send_message(i)
+        self.assertEqual(self.chat.queued_messages(), 2)
+
+        self.chat.startup({'udp_max_queue': '2'})
+
+        self.assertEqual(self.host.recv(1024), b'2\n')
+        self.assertEqual(self.host.recv(1024), b'3\n')
+        self.assertEqual(self.chat.counters()['dropped'], 2)
+
+    def test_outbox_drop_new(self):
+        self.chat._max_queue = 2
+        self.chat._drop_new = True
+        for i in range(4):
+            self.chat.send_message(i)
+
+        self.chat.startup({'udp_max_queue': '2', 'udp_overflow': 'drop_new'})
+
+        self.assertEqual(self.host.recv(1024), b'0\n')
+        self.assertEqual(self.host.recv(1024), b'1\n')
+        self.assertEqual(self.chat.counters()['dropped'], 2)
+
+    def test_fragmentation(self):
+        self.chat.startup({'udp_mtu': '100'})
+        message = 'user%d wants to join\n' * 30 % tuple(range(30))
+        self.chat.send_message(message)
+
+        fragments = [self.host.recv(1024)]
+        count = int(fragments[0][3:fragments[0].index(b']')])
+        for _ in range(count - 1):
+            fragments.append(self.host.recv(1024))
+
+        self.assertGreater(count, 1)
+        for i, fragment in enumerate(fragments, 1):
+            self.assertTrue(fragment.startswith(b'[%d/%d] ' % (i, count)))
+            self.assertLessEqual(len(fragment), 100)
+        self.assertEqual(
+            b''.join(f.split(b'] ', 1)[1] for f in fragments).decode(),
+            message + '\n'
+        )
+        self.assertEqual(self.chat.counters(),
+                         {'dropped': 0, 'fragmented': 1})
+
+    def test_reassembly(self):
+        self.chat.startup({})
+        self.chat.send_message('hello')
+        address = self.host.recvfrom(1024)[1]
+
+        for prefix, part in split_message(b'x' * 100 + b'y' * 100, 80):
+            self.host.sendto(prefix + part, address)
+        # a lost fragment drops the message
+        self.host.sendto(b'[2/3] lost', address)
+        self.host.sendto(b'[1/0] no fragment', address)
+
+        self.assertEqual(self.received.get(timeout=2),
+                         'x' * 100 + 'y' * 100)
+        self.assertEqual(self.received.get(timeout=2), '[1/0] no fragment')
+
+    def test_split_message(self):
+        data = ('ä' * 100).encode()
+        fragments = split_message(data, 64)
+
+        self.assertEqual(len(fragments), 4)
+        for i, (prefix, part) in enumerate(fragments, 1):
+            self.assertEqual(prefix, b'[%d/4] ' % i)
+            self.assertIsInstance(part, memoryview)
+            self.assertLessEqual(len(prefix) + len(part), 64)
+            # no character is split
+            bytes(part).decode()
+        self.assertEqual(b''.join(part for _, part in fragments), data)
+
+    def test_split_message_prefix_width(self):
+        # ten fragments need a wider prefix than nine
+        for size in range(500, 620):
+            fragments = split_message(b'x' * size, 64)
+            for prefix, part in fragments:
+                self.assertLessEqual(len(prefix) + len(part), 64)
+            self.assertEqual(sum(len(p) for _, p in fragments), size)
+
+    def test_receive_hook_error(self):
+        self.chat.register_receive(self._failing_hook)
+        self.chat.startup({})
+        self.chat.send_message('hello')
+        address = self.host.recvfrom(1024)[1]
+
+        self.host.sendto(b'fail', address)
+        self.host.sendto(b'OK', address)
+
+        self.assertEqual(self.received.get(timeout=2), 'OK')
+
+    def _failing_hook(self, message):
+        if message == 'fail':
+            raise RuntimeError('test')
+        self.received.put(message)
+
+    def test_shutdown(self):
+        self.chat.startup({})
+        start = time.perf_counter()
+        self.chat.shutdown()
+
+        self.assertLess(time.perf_counter() - start, 0.5)
+        # messages after shutdown are dropped
+        self.chat.send_message('late')
+
+    def test_shutdown_without_startup(self):
+        UdpChat().shutdown()
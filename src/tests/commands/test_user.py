@@ -7,9 +7,11 @@ import time
 from unittest import TestCase
 from unittest.mock import Mock, call
 
+from radguestauth.command import Failure
 from radguestauth.commands.user import (AllowCommand, DenyCommand,
                                         ListUsersCommand, ManageUserCommand)
 from radguestauth.users.storage import UserIdentifier, UserData
+from radguestauth.users.usermanager import UserManager
 
 
 # tests shared by allow and manage. Not based on TestCase so they are not
@@ -46,6 +48,7 @@ class ModifyBaseTest(object):
             result = self.cmd.execute(self.pre_arg + arg + self.post_arg)
             self.assertEqual(result, usage,
                              'No usage output for invalid arg: %s' % arg)
+            self.assertIsInstance(result, Failure)
 
         self.mock_um.update.assert_not_called()
         self.mock_um.finish_request.assert_not_called()
@@ -129,6 +132,35 @@ class AllowCommandTest(ModifyBaseTest, TestCase):
         self.mock_um.update.assert_not_called()
         self.mock_um.finish_request.assert_not_called()
 
+    def test_request_id(self):
+        self.mock_um.is_request_pending.return_value = True
+        testuser = UserIdentifier('user', 'device')
+        self.mock_um.get_request.return_value = testuser
+
+        self.assertIn('OK', self.cmd.execute(['4', 'for', '2', 'h']))
+        self.assertIn('OK', self.cmd.execute(['5', '3', 'times']))
+        # the first number is the join count without ID
+        self.assertIn('OK', self.cmd.execute(['3', 'times']))
+
+        self.mock_um.get_request.assert_has_calls([
+            call(4), call(5), call(None)
+        ])
+        self.mock_um.finish_request.assert_has_calls([
+            call(4), call(5), call(None)
+        ])
+        self.assertEqual(testuser.user_data.max_num_joins, 3)
+
+    def test_unknown_request_id(self):
+        self.mock_um.is_request_pending.return_value = True
+        self.mock_um.get_request.return_value = None
+
+        result = self.cmd.execute(['4', 'for', '2', 'h'])
+
+        self.assertEqual(result, 'No request with ID 4.')
+        self.assertIsInstance(result, Failure)
+        self.mock_um.update.assert_not_called()
+        self.mock_um.finish_request.assert_not_called()
+
 
 class DenyCommandTest(TestCase):
     def setUp(self):
@@ -177,48 +209,140 @@ class DenyCommandTest(TestCase):
         self.mock_um.finish_request.assert_not_called()
         self.mock_auth.on_host_deny.assert_not_called()
 
+    def test_request_id(self):
+        self.mock_um.is_request_pending.return_value = True
+        testuser = UserIdentifier('user', 'device')
+        self.mock_um.get_request.return_value = testuser
 
-class ListUsersCommandTest(TestCase):
-    def setUp(self):
-        self.mock_um = Mock()
-        self.cmd = ListUsersCommand(self.mock_um)
+        self.cmd.execute(['7'])
 
-    def _exec_list(self):
-        result = self.cmd.execute([])
-        # args should be ignored
-        result_args = self.cmd.execute(['with', 'unnecessary', 'args'])
+        self.mock_um.get_request.assert_called_once_with(7)
+        self.mock_um.finish_request.assert_called_once_with(7)
+        self.mock_auth.on_host_deny.assert_called_once_with(testuser)
+
+    def test_unknown_request_id(self):
+        self.mock_um.is_request_pending.return_value = True
+        self.mock_um.get_request.return_value = None
+
+        self.assertEqual(self.cmd.execute(['7']), 'No request with ID 7.')
+        self.mock_um.update.assert_not_called()
+        self.mock_auth.on_host_deny.assert_not_called()
 
-        self.mock_um.list_users.assert_called()
-        self.assertIn('someone', result)
-        self.assertIn('123', result)
-        self.assertIn('someoneElse', result)
-        self.assertIn('deviceId1', result)
-        self.assertEqual(result, result_args)
-        return result
+
+class ListUsersCommandTest(TestCase):
+    def setUp(self):
+        # a real UserManager, as the command relies on its ordering
+        self.mgr = UserManager()
+        self.cmd = ListUsersCommand(self.mgr)
+
+    def _add(self, name, device, join_state=UserData.JOIN_STATE_ALLOWED,
+             valid_until=None):
+        user = UserIdentifier(name, device)
+        self.assertTrue(self.mgr.add_request(user))
+        user.user_data = UserData()
+        user.user_data.join_state = join_state
+        user.user_data.valid_until = valid_until
+        self.mgr.update(user)
+        self.mgr.finish_request()
+        return user
+
+    def _exec(self, argv):
+        result = self.cmd.execute(argv)
+        self.assertIsInstance(result, list)
+        for message in result:
+            self.assertLessEqual(len(message.encode()),
+                                 ListUsersCommand.MAX_MESSAGE_SIZE)
+        return '\n'.join(result)
 
     def test_list_output(self):
-        self.mock_um.list_users.return_value = [
-            UserIdentifier('someone', '123'),
-            UserIdentifier('someoneElse', 'deviceId1'),
-        ]
+        self._add('someoneElse', 'deviceId1')
+        self._add('someone', '123')
+
+        result = self._exec([])
 
-        result = self._exec_list()
-        self.assertFalse('[blocked]' in result)
+        self.assertIn('someone (device 123)', result)
+        self.assertIn('someoneElse (device deviceId1)', result)
+        self.assertLess(result.index('someone '), result.index('someoneElse'))
+        self.assertIn('page 1 of 1', result)
+        self.assertNotIn('[blocked]', result)
 
     def test_block_state(self):
-        user1 = UserIdentifier('someone', '123')
-        user1.user_data = UserData()
-        user1.user_data.join_state = UserData.JOIN_STATE_ALLOWED
-        user2 = UserIdentifier('someoneElse', 'deviceId1')
-        user2.user_data = UserData()
-        user2.user_data.join_state = UserData.JOIN_STATE_BLOCKED
-        self.mock_um.list_users.return_value = [
-            user1, user2
-        ]
+        self._add('someone', '123')
+        self._add('someoneElse', 'deviceId1', UserData.JOIN_STATE_BLOCKED)
 
-        result = self._exec_list()
+        result = self._exec([])
         self.assertEqual(result.count('[blocked]'), 1)
 
+    def test_pending_requests(self):
+        self.mgr = Mock()
+        self.mgr.list_requests.return_value = [
+            (3, UserIdentifier('first', 'aa')),
+            (5, UserIdentifier('second', 'bb')),
+        ]
+        self.mgr.list_users.return_value = []
+        self.mgr.count_users.return_value = 0
+        self.cmd = ListUsersCommand(self.mgr)
+
+        result = self._exec([])
+
+        self.assertIn('[3] first (device aa)', result)
+        self.assertIn('[5] second (device bb)', result)
+        self.assertLess(result.index('first'), result.index('second'))
+
+    def test_pages(self):
+        for i in range(45):
+            self._add('user%02d' % i, 'dev%02d' % i)
+
+        page1 = self._exec([])
+        page3 = self._exec(['3'])
+
+        self.assertIn('user19', page1)
+        self.assertNotIn('user20', page1)
+        self.assertIn('page 1 of 3', page1)
+        self.assertIn('LIST 2 shows the next page.', page1)
+        self.assertIn('user40', page3)
+        self.assertNotIn('user39', page3)
+        self.assertNotIn('next page', page3)
+
+    def test_prefix(self):
+        self._add('bob', 'a')
+        self._add('bobby', 'b')
+        self._add('alice', 'c')
+
+        result = self._exec(['bob'])
+
+        self.assertIn('bobby', result)
+        self.assertNotIn('alice', result)
+
+    def test_state_filters(self):
+        now = time.time()
+        self._add('a', '1')
+        self._add('b', '2', UserData.JOIN_STATE_BLOCKED)
+        self._add('c', '3', valid_until=now + 600)
+        self._add('d', '4', valid_until=now + 7200)
+
+        blocked = self._exec(['blocked'])
+        allowed = self._exec(['allowed'])
+        expiring = self._exec(['expiring'])
+
+        self.assertIn('b (device 2)', blocked)
+        self.assertNotIn('a (device 1)', blocked)
+        self.assertIn('a (device 1)', allowed)
+        self.assertNotIn('b (device 2)', allowed)
+        self.assertIn('c (device 3)', expiring)
+        self.assertNotIn('d (device 4)', expiring)
+        self.assertNotIn('a (device 1)', expiring)
+
+    def test_message_size(self):
+        self.cmd.PAGE_SIZE = 100
+        for i in range(100):
+            self._add('user with a rather long name %03d' % i, 'dev%d' % i)
+
+        result = self.cmd.execute([])
+
+        self.assertGreater(len(result), 1)
+        self.assertEqual('\n'.join(result).count('* user'), 100)
+
 
 class ManageUsersCommandBase(ModifyBaseTest):
     """
@@ -257,6 +381,7 @@ class ManageUsersCommandBase(ModifyBaseTest):
         self.testdata = UserData()
         self.testuser.user_data = self.testdata
         self.mock_um.find.return_value = self.testuser
+        self.mock_um.list_devices.return_value = [self.testuser]
 
     def test_show(self):
         expected = str(self.testuser)
@@ -283,6 +408,18 @@ class ManageUsersCommandBase(ModifyBaseTest):
         self.mock_um.remove.assert_called_once_with(self.testuser)
         self.mock_auth.on_host_deny.assert_called_once_with(self.testuser)
 
+    def test_drop_all_devices(self):
+        laptop = UserIdentifier('user', 'laptop', 'pw')
+        self.mock_um.list_devices.return_value = [self.testuser, laptop]
+
+        result = self.cmd.execute(['drop'] + self.post_arg)
+
+        self.mock_um.remove.assert_has_calls([call(self.testuser),
+                                              call(laptop)])
+        self.assertEqual(self.mock_auth.on_host_deny.call_count, 2)
+        # the same answer is only given once
+        self.assertEqual(result.count('User removed.'), 1)
+
     def test_drop_auth_handler_blocked(self):
         self.testdata.join_state = UserData.JOIN_STATE_BLOCKED
         self.cmd.execute(['drop'] + self.post_arg)
@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import stat
+import socket
+import asyncio
+import tempfile
+import radguestauth.auth as auth
+
+from threading import Event
+from unittest import TestCase
+from unittest.mock import Mock
+from radguestauth.aioserver import AsyncRestServer, build_response
+from radguestauth.users.bulk import ImportResult
+
+
+AUTHORIZE_BODY = json.dumps({
+    'User-Name': {'type': 'string', 'value': ['user']},
+    'Calling-Station-Id': {'type': 'string', 'value': ['aabb']},
+}).encode()
+
+OUTER_EAP_BODY = json.dumps({
+    'User-Name': {'type': 'string', 'value': ['user']},
+    'Calling-Station-Id': {'type': 'string', 'value': ['aabb']},
+    'EAP-Message': {'type': 'octets',
+                    'value': ['0x0200000c19736f6d656f6e65']},
+}).encode()
+
+
+def post(path, body, extra_headers=''):
+    return (('POST %s HTTP/1.1\r\nHost: localhost\r\n'
+             'Content-Length: %d\r\n%s\r\n' % (path, len(body), extra_headers))
+            .encode() + body)
+
+
+def run_loop(coro):
+    """
+    Runs coro in a new event loop, like asyncio.run in Python 3.7.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncRestServerTest(TestCase):
+    def setUp(self):
+        self.core = Mock()
+        self.core.required_attributes.return_value = {
+            'User-Name', 'Calling-Station-Id', 'EAP-Message'
+        }
+        self.core.can_skip.return_value = False
+        self.core.authorize.return_value = (
+            auth.ALLOW, {'control:Cleartext-Password': 'pw'}
+        )
+        self.server = AsyncRestServer(self.core, {})
+
+    def _exchange(self, *requests, unix_path=None):
+        """
+        Sends all requests over one connection and returns everything the
+        server sent until it closed the connection or went idle.
+        """
+        async def run():
+            if unix_path:
+                server = await self.server.start('unix:' + unix_path)
+                reader, writer = await asyncio.open_unix_connection(unix_path)
+            else:
+                server = await self.server.start('127.0.0.1:0')
+                port = server.sockets[0].getsockname()[1]
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+            for req in requests:
+                writer.write(req)
+            await writer.drain()
+
+            data = b''
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(reader.read(65536), 0.5)
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                data += chunk
+
+            writer.close()
+            # let the server see the closed connection
+            await asyncio.sleep(0.05)
+            server.close()
+            await server.wait_closed()
+            return data
+
+        return run_loop(run())
+
+    def test_build_response(self):
+        resp = build_response(200, b'{}')
+        self.assertTrue(resp.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Content-Length: 2\r\n', resp)
+        self.assertTrue(resp.endswith(b'\r\n\r\n{}'))
+
+        no_content = build_response(204, b'', keep_alive=False)
+        self.assertNotIn(b'Content-Length', no_content)
+        self.assertIn(b'Connection: close', no_content)
+
+    def test_authorize_keep_alive(self):
+        data = self._exchange(post('/authorize', AUTHORIZE_BODY),
+                              post('/authorize', AUTHORIZE_BODY))
+
+        # both requests are answered on the same connection
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertIn(b'{"control:Cleartext-Password":"pw"}', data)
+        self.core.authorize.assert_called_with(
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb'}
+        )
+        self.assertEqual(self.core.authorize.call_count, 2)
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.sock')
+            # a stale socket of a previous run is replaced
+            stale = socket.socket(socket.AF_UNIX)
+            stale.bind(path)
+            stale.close()
+            data = self._exchange(post('/authorize', AUTHORIZE_BODY),
+                                  post('/authorize', AUTHORIZE_BODY),
+                                  unix_path=path)
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 2)
+        # other local users can't connect
+        self.assertEqual(mode, 0o660)
+
+    def test_unix_socket_keeps_other_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'config.ini')
+            open(path, 'w').close()
+
+            with self.assertRaises(OSError):
+                run_loop(self.server.start('unix:' + path))
+            self.assertTrue(os.path.isfile(path))
+
+    def test_connection_close(self):
+        data = self._exchange(
+            post('/authorize', AUTHORIZE_BODY, 'Connection: close\r\n'),
+            post('/authorize', AUTHORIZE_BODY)
+        )
+
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 1)
+        self.core.authorize.assert_called_once()
+
+    def test_skipped_request(self):
+        self.core.can_skip.return_value = True
+        data = self._exchange(post('/authorize', OUTER_EAP_BODY))
+
+        self.assertTrue(data.startswith(b'HTTP/1.1 204 No Content\r\n'))
+        self.core.authorize.assert_not_called()
+        self.assertEqual(self.server.rest_handler.skipped, 1)
+
+    def test_post_auth_and_drop_expired(self):
+        self.core.post_auth.return_value = None
+        data = self._exchange(
+            post('/post-auth', AUTHORIZE_BODY),
+            b'GET /drop-expired HTTP/1.1\r\nHost: localhost\r\n\r\n',
+        )
+
+        self.assertIn(b'HTTP/1.1 204 No Content', data)
+        self.assertIn(b'HTTP/1.1 200 OK', data)
+        self.core.post_auth.assert_called_once()
+        self.core.drop_expired_users.assert_called_once()
+
+    def test_users_endpoints(self):
+        self.core.import_users.return_value = ImportResult()
+        self.core.export_users.return_value = iter(['name\n', 'a\n'])
+        data = self._exchange(
+            post('/users.csv', b'name,device\r\na,02-00-00-00-00-01\r\n'),
+            b'GET /users.jsonl HTTP/1.1\r\nHost: localhost\r\n\r\n',
+        )
+
+        self.assertIn(b'Content-Type: application/x-ndjson', data)
+        self.assertTrue(data.endswith(b'name\na\n'))
+        lines, fmt = self.core.import_users.call_args[0]
+        self.assertEqual(fmt, 'csv')
+        self.assertEqual(list(lines),
+                         ['name,device\r\n', 'a,02-00-00-00-00-01\r\n'])
+        self.core.export_users.assert_called_once_with('jsonl')
+
+    def test_blocking_endpoint(self):
+        release = Event()
+        self.core.drop_expired_users.side_effect = lambda: release.wait(5)
+        self.core.authorize.side_effect = lambda items: (
+            release.set() or (auth.ALLOW, {})
+        )
+
+        async def run():
+            server = await self.server.start('127.0.0.1:0')
+            port = server.sockets[0].getsockname()[1]
+            slow = await asyncio.open_connection('127.0.0.1', port)
+            slow[1].write(b'GET /drop-expired HTTP/1.1\r\n\r\n')
+            fast = await asyncio.open_connection('127.0.0.1', port)
+            fast[1].write(post('/authorize', AUTHORIZE_BODY))
+            # authorize is answered while drop-expired blocks, and releases
+            # it
+            responses = [await asyncio.wait_for(conn[0].read(65536), 2)
+                         for conn in (fast, slow)]
+            for _, writer in (slow, fast):
+                writer.close()
+            await asyncio.sleep(0.05)
+            server.close()
+            await server.wait_closed()
+            return responses
+
+        fast, slow = run_loop(run())
+
+        self.assertTrue(fast.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(slow.startswith(b'HTTP/1.1 200'))
+
+    def test_errors(self):
+        self.assertTrue(self._exchange(
+            b'GET /unknown HTTP/1.1\r\n\r\n'
+        ).startswith(b'HTTP/1.1 404'))
+        self.assertTrue(self._exchange(
+            b'GET /authorize HTTP/1.1\r\n\r\n'
+        ).startswith(b'HTTP/1.1 405'))
+        self.assertTrue(self._exchange(
+            b'POST /authorize HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        ).startswith(b'HTTP/1.1 411'))
+        self.assertTrue(self._exchange(
+            b'garbage\r\n\r\n'
+        ).startswith(b'HTTP/1.1 400'))
+
+        self.core.authorize.side_effect = RuntimeError('test')
+        self.assertTrue(self._exchange(
+            post('/authorize', AUTHORIZE_BODY)
+        ).startswith(b'HTTP/1.1 500'))
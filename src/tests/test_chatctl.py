@@ -2,10 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import time
+
+from threading import Event, RLock, Thread
 from unittest import TestCase
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, call
 from radguestauth.chatctl import ChatController
+from radguestauth.command import Failure
 from radguestauth.users.storage import UserIdentifier
+from radguestauth.users.usermanager import UserManager
 
 
 @patch('radguestauth.chatctl.ImplLoader')
@@ -19,8 +24,17 @@ class ChatControllerTest(TestCase):
         mock_loader_obj.load.return_value = mock_chat
         mock_loader.return_value = mock_loader_obj
 
-        chatc = ChatController(Mock(), Mock())
+        mock_usermgr = Mock()
+        mock_usermgr.list_requests.return_value = [
+            (3, UserIdentifier('fooName', 'barDevice'))
+        ]
+        chatc = ChatController(mock_usermgr, Mock())
         chatc.start(config)
+        self.addCleanup(chatc._outbox.stop)
+        self.addCleanup(chatc._pool.stop, 1)
+        # messages are sent by the outbox thread
+        self.assertTrue(chatc.flush(1))
+        self._chatc = chatc
 
         # chat should be loaded according to given config
         mock_loader_obj.load.assert_called_once_with(config.get('chat'))
@@ -29,18 +43,25 @@ class ChatControllerTest(TestCase):
         return (chatc, mock_chat_obj)
 
     def _check_sent_messages_for(self, chat_mock, check_items):
+        self.assertTrue(self._chatc.flush(1))
         chat_mock.send_message.assert_called()
 
         found_items = set()
-        for call in chat_mock.send_message.call_args_list:
+        for sent in chat_mock.send_message.call_args_list:
             # first non-keyword argument of send_message
-            text = call[0][0]
+            text = sent[0][0]
             for item in check_items:
                 if item in text:
                     found_items.add(item)
 
         return found_items
 
+    def _wait_for(self, predicate):
+        deadline = time.monotonic() + 2
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
     def _assert_in_chat_messages(self, mock_chat_obj, check_items):
         res = self._check_sent_messages_for(mock_chat_obj, check_items)
         self.assertSetEqual(set(check_items), res)
@@ -88,7 +109,35 @@ class ChatControllerTest(TestCase):
 
         # device and username should have been sent, possibly in multiple
         # messages.
-        self._assert_in_chat_messages(mock_chat_obj, ['fooName', 'barDevice'])
+        self._assert_in_chat_messages(mock_chat_obj, ['fooName', 'barDevice',
+                                                      'request 3'])
+
+    def test_notify_join_other_device(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.reset_mock()
+        chatc._user_manager.find.return_value = UserIdentifier('fooName',
+                                                               'phone')
+
+        chatc.notify_join(UserIdentifier('fooName', 'barDevice'))
+
+        self._assert_in_chat_messages(mock_chat_obj, ['another device',
+                                                      'barDevice'])
+
+    def test_queued_messages(self, mock_loader):
+        chatc = ChatController(Mock(), Mock())
+        self.assertEqual(chatc.queued_messages(), 0)
+
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.queued_messages.return_value = 3
+        self.assertEqual(chatc.queued_messages(), 3)
+
+    def test_chat_counters(self, mock_loader):
+        chatc = ChatController(Mock(), Mock())
+        self.assertDictEqual(chatc.chat_counters(), {})
+
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.counters.return_value = {'dropped': 1}
+        self.assertDictEqual(chatc.chat_counters(), {'dropped': 1})
 
     def test_notify_join_wrong_arg(self, mock_loader):
         chatc, mock_chat_obj = self._startup_controller(mock_loader)
@@ -96,6 +145,7 @@ class ChatControllerTest(TestCase):
 
         chatc.notify_join(dict())
 
+        chatc.flush(1)
         mock_chat_obj.send_message.assert_not_called()
 
     def test_parse_commands(self, mock_loader):
@@ -128,6 +178,186 @@ class ChatControllerTest(TestCase):
         self._assert_in_chat_messages(mock_chat_obj, [test_message])
         command_mock.execute.assert_called_once_with(['with', 'Args'])
 
+    def test_several_reply_messages(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.reset_mock()
+        command_mock = Mock()
+        command_mock.execute.return_value = ['part 1', 'part 2']
+        chatc._commands = {'testcommand': command_mock}
+
+        chatc.receive_callback('testcommand')
+
+        chatc.flush(1)
+        mock_chat_obj.send_message.assert_has_calls([call('part 1'),
+                                                     call('part 2')])
+        self.assertEqual(mock_chat_obj.send_message.call_count, 2)
+
+    def test_slow_command_does_not_block(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.reset_mock()
+        release = Event()
+        slow_mock = Mock()
+        slow_mock.execute.side_effect = lambda args: release.wait(5) and 'slow'
+        fast_mock = Mock()
+        fast_mock.execute.return_value = 'fast'
+        chatc._commands = {'manage': slow_mock, 'testcommand': fast_mock}
+
+        chatc.receive_callback('manage remove fooName')
+        chatc.receive_callback('manage remove barName')
+        # the second MANAGE concerns another guest, so both run
+        self._wait_for(lambda: slow_mock.execute.call_count == 2)
+        self.assertEqual(chatc.queued_commands(), 0)
+        self.assertFalse(chatc.flush(0.05))
+
+        release.set()
+        self.assertTrue(chatc.flush(1))
+        self.assertEqual(mock_chat_obj.send_message.call_count, 2)
+
+        # commands without a guest wait for all earlier ones
+        chatc.receive_callback('testcommand')
+        self._assert_in_chat_messages(mock_chat_obj, ['fast'])
+
+    def test_hooks_run_without_lock(self, mock_loader):
+        lock = RLock()
+        user_mgr = UserManager()
+        auth_handler = Mock()
+        chatc = ChatController(user_mgr, auth_handler, lock=lock)
+        chatc.start({'chat': 'udp'})
+        self.addCleanup(chatc._outbox.stop)
+        self.addCleanup(chatc._pool.stop, 1)
+        user_mgr.add_request(UserIdentifier('fooName', 'barDevice'))
+
+        def lock_free(user_id):
+            # acquired by another thread, e.g. a request
+            result = []
+            other = Thread(target=lambda: result.append(
+                lock.acquire(timeout=1) and lock.release() is None
+            ))
+            other.start()
+            other.join()
+            return 'lock free: %s' % result[0]
+        auth_handler.on_host_accept.side_effect = lock_free
+
+        chatc.receive_callback('OK 2 times')
+        self.assertTrue(chatc.flush(2))
+
+        self.assertEqual(user_mgr.find('fooName').user_data.max_num_joins, 2)
+        self.assertFalse(user_mgr.is_request_pending())
+        chatc._chat.send_message.assert_called_with('OK\nlock free: True')
+
+    def test_commands_wait_for_lock(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+
+        # e.g. a request is being handled
+        with chatc._lock:
+            chatc.receive_callback('manage show fooName')
+            self.assertFalse(chatc.flush(0.05))
+            chatc._user_manager.find.assert_not_called()
+
+        self.assertTrue(chatc.flush(1))
+        chatc._user_manager.find.assert_called_once_with('fooName')
+
+    def test_ok_claims_request(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        chatc._user_manager.list_requests.return_value = [
+            (3, UserIdentifier('fooName', 'barDevice')),
+            (4, UserIdentifier('bazName', 'barDevice')),
+        ]
+        release = Event()
+        command_mock = Mock()
+        command_mock.execute.side_effect = lambda args: release.wait(5) and ''
+        chatc._commands = {'ok': command_mock, 'no': command_mock}
+
+        chatc.receive_callback('OK 2 times')
+        # the request is answered, but still listed by the UserManager
+        chatc.receive_callback('NO')
+        self.assertSetEqual(chatc._claimed, {3, 4})
+
+        release.set()
+        self.assertTrue(chatc.flush(1))
+        command_mock.execute.assert_has_calls(
+            [call(['3', '2', 'times']), call(['4'])], any_order=True
+        )
+        self.assertSetEqual(chatc._claimed, set())
+
+    def test_commands_queue_full(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(
+            mock_loader, {'chat': 'udp', 'command_workers': '1',
+                          'command_queue_size': '1'}
+        )
+        mock_chat_obj.reset_mock()
+        release = Event()
+        command_mock = Mock()
+        command_mock.execute.side_effect = lambda args: release.wait(5) and ''
+        chatc._commands = {'list': command_mock}
+
+        chatc.receive_callback('list')
+        self._wait_for(lambda: command_mock.execute.called)
+        # one command waits, the third does not fit
+        for _ in range(2):
+            chatc.receive_callback('list')
+        release.set()
+
+        self._assert_in_chat_messages(mock_chat_obj,
+                                      ['Too many commands waiting'])
+        self.assertEqual(command_mock.execute.call_count, 2)
+
+    def test_failing_command(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.reset_mock()
+        command_mock = Mock()
+        command_mock.name.return_value = 'TEST'
+        command_mock.execute.side_effect = RuntimeError('test')
+        chatc._commands = {'testcommand': command_mock}
+
+        chatc.receive_callback('testcommand')
+
+        self._assert_in_chat_messages(mock_chat_obj, ['TEST failed'])
+
+    def test_script(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.reset_mock()
+        ok_mock = Mock()
+        ok_mock.execute.side_effect = [Failure('No request pending.'), 'OK']
+        list_mock = Mock()
+        list_mock.execute.return_value = ['page 1', 'page 2']
+        chatc._commands = {'ok': ok_mock, 'list': list_mock}
+
+        chatc.receive_callback('OK 7 2 times\n\n  OK 3 times \nfoo\nLIST')
+
+        self.assertTrue(chatc.flush(1))
+        # the second OK answers the claimed request 3
+        ok_mock.execute.assert_has_calls([call(['7', '2', 'times']),
+                                          call(['3', '3', 'times'])])
+        list_mock.execute.assert_called_once_with([])
+        mock_chat_obj.send_message.assert_called_once_with(
+            '> OK 7 2 times\nNo request pending.\n\n'
+            '> OK 3 times\nOK\n\n'
+            '> foo\nUnknown command.\n\n'
+            '> LIST\npage 1\npage 2'
+        )
+        self.assertSetEqual(chatc._claimed, set())
+
+    def test_script_strict(self, mock_loader):
+        chatc, mock_chat_obj = self._startup_controller(mock_loader)
+        mock_chat_obj.reset_mock()
+        command_mock = Mock()
+        command_mock.execute.side_effect = ['OK', Failure('Unknown user')]
+        chatc._commands = {'manage': command_mock, 'ok': command_mock}
+
+        chatc.receive_callback('strict\nMANAGE drop foo\nMANAGE drop bar\n'
+                               'OK 2 times\nMANAGE drop baz')
+
+        self.assertTrue(chatc.flush(1))
+        self.assertEqual(command_mock.execute.call_count, 2)
+        mock_chat_obj.send_message.assert_called_once_with(
+            '> MANAGE drop foo\nOK\n\n'
+            '> MANAGE drop bar\nUnknown user\n\n'
+            'Stopped, 2 commands were not run.'
+        )
+        # the OK which did not run does not keep its request
+        self.assertSetEqual(chatc._claimed, set())
+
     def test_correct_shutdown(self, mock_loader):
         chatc, mock_chat_obj = self._startup_controller(mock_loader)
         mock_chat_obj.reset_mock()
@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+
+from threading import Event
+from unittest import TestCase
+
+from radguestauth.commandpool import CommandPool
+
+
+class CommandPoolTest(TestCase):
+    def setUp(self):
+        self.done = []
+
+    def _start(self, **kwargs):
+        pool = CommandPool(**kwargs)
+        pool.start()
+        self.addCleanup(pool.stop, 1)
+        return pool
+
+    def _task(self, name, wait=None):
+        def run():
+            if wait is not None:
+                wait.wait(5)
+            self.done.append(name)
+        return run
+
+    def test_same_key_in_order(self):
+        pool = self._start()
+        for i in range(20):
+            pool.submit('guest', self._task(i))
+
+        self.assertTrue(pool.join(2))
+        self.assertListEqual(self.done, list(range(20)))
+
+    def test_other_keys_in_parallel(self):
+        pool = self._start(workers=2)
+        release = Event()
+        pool.submit('slow', self._task('slow', release))
+        pool.submit('slow', self._task('slow 2'))
+        pool.submit('fast', self._task('fast'))
+
+        # fast does not wait for slow
+        deadline = time.monotonic() + 2
+        while not self.done and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertListEqual(self.done, ['fast'])
+
+        release.set()
+        self.assertTrue(pool.join(2))
+        self.assertListEqual(self.done, ['fast', 'slow', 'slow 2'])
+
+    def test_exclusive_task(self):
+        pool = self._start(workers=3)
+        release = Event()
+        pool.submit('a', self._task('a', release))
+        pool.submit(None, self._task('list'))
+        pool.submit('b', self._task('b'))
+
+        self.assertFalse(pool.join(0.05))
+        self.assertListEqual(self.done, [])
+        self.assertEqual(pool.queued(), 2)
+
+        release.set()
+        self.assertTrue(pool.join(2))
+        self.assertListEqual(self.done, ['a', 'list', 'b'])
+
+    def test_queue_full(self):
+        pool = self._start(workers=1, max_queue=2)
+        release = Event()
+        pool.submit('a', self._task('a', release))
+        pool.submit('a', self._task('a 2'))
+        pool.submit('a', self._task('a 3'))
+
+        self.assertFalse(pool.submit('b', self._task('b')))
+        release.set()
+        self.assertTrue(pool.join(2))
+        self.assertTrue(pool.submit('b', self._task('b')))
+
+    def test_failing_task(self):
+        pool = self._start()
+
+        def fail():
+            raise RuntimeError('test')
+        pool.submit('a', fail)
+        pool.submit('a', self._task('a'))
+
+        self.assertTrue(pool.join(2))
+        self.assertListEqual(self.done, ['a'])
+
+    def test_stop(self):
+        pool = CommandPool()
+        pool.start()
+        pool.submit(None, self._task('last'))
+        pool.stop()
+
+        self.assertListEqual(self.done, ['last'])
+        self.assertFalse(pool.submit(None, self._task('late')))
@@ -5,10 +5,22 @@
 import time
 import radguestauth.auth as auth
 from unittest import TestCase
-from unittest.mock import patch, Mock, ANY, call
+from unittest.mock import patch, Mock, ANY, DEFAULT, call
 from radguestauth.core import GuestAuthCore
+from radguestauth.loader import ImplLoader
+from radguestauth.userstorage import UserStorage
 from radguestauth.authhandlers.default import DefaultAuthHandler
 from radguestauth.users.storage import UserIdentifier, UserData
+from radguestauth.users.usermanager import UserManager
+
+
+def _user_manager_mock():
+    """
+    Mock of an UserManager whose admit runs on the mocked methods.
+    """
+    mgr = Mock()
+    mgr.admit.side_effect = lambda user_id: UserManager.admit(mgr, user_id)
+    return mgr
 
 
 # use a separate test class for helpers, as those are independent from
@@ -65,17 +77,58 @@ class GuestAuthCoreHelpersTest(TestCase):
         result = GuestAuthCore.skip_eap_message(input)
         self.assertFalse(result)
 
+    def test_skip_request(self):
+        outer = {'EAP-Message': '0x0200000c19736f6d656f6e65'}
+        self.assertTrue(GuestAuthCore.skip_request(outer))
+
+        inner_identity = {'EAP-Message': '0x0206000c01736f6d656f6e65',
+                          'FreeRADIUS-Proxied-To': '127.0.0.1'}
+        self.assertTrue(GuestAuthCore.skip_request(inner_identity))
+
+        inner_peap = {'EAP-Message': '0x0201001619100a5cedafe5b632',
+                      'FreeRADIUS-Proxied-To': '127.0.0.1'}
+        self.assertFalse(GuestAuthCore.skip_request(inner_peap))
+        self.assertFalse(GuestAuthCore.skip_request({'User-Name': 'user'}))
+
+    def test_can_skip_eap_pwd(self):
+        gacore = GuestAuthCore()
+        outer_pwd = {'Calling-Station-Id': 'aabb',
+                     'EAP-Message': '0x0200000c34736f6d656f6e65'}
+        outer_peap = {'EAP-Message': '0x0200000c19736f6d656f6e65'}
+
+        self.assertTrue(gacore.can_skip(outer_peap))
+        # EAP-PWD attributes are remembered, so never skip those
+        self.assertFalse(gacore.can_skip(outer_pwd))
+
+        gacore.authorize(outer_pwd)
+        # now, requests without device might restore the attributes
+        self.assertFalse(gacore.can_skip(outer_peap))
+        self.assertTrue(gacore.can_skip(dict(outer_peap,
+                                             **{'Calling-Station-Id': 'a'})))
+
 
 # from imports lead to a change of the namespace
-@patch('radguestauth.core.ImplLoader')
+def _impl_loader(base_type, default_impl):
+    """
+    side_effect of the patched ImplLoader: user storages are loaded as usual,
+    other loaders return the mock's return_value.
+    """
+    if base_type is UserStorage:
+        return ImplLoader(base_type, default_impl)
+    return DEFAULT
+
+
+@patch('radguestauth.core.ImplLoader', side_effect=_impl_loader)
 @patch('radguestauth.core.ChatController')
-@patch('radguestauth.core.UserManager')
+@patch('radguestauth.userstorages.memory.UserManager')
 class GuestAuthCoreTest(TestCase):
     def _get_auth_handler_mock(self, mock_loader):
         """
         Lets the ImplLoader return a Mock to abstract AuthHandler.
         """
         auth_mock_obj = Mock(auth.AuthHandler)
+        # results of mocked handlers must not be cached
+        auth_mock_obj.reply_cacheable.return_value = False
         auth_mock = Mock()
         auth_mock.return_value = auth_mock_obj
         mock_loader_obj = Mock()
@@ -100,27 +153,131 @@ class GuestAuthCoreTest(TestCase):
     def _init_and_start(self):
         """
         Creates an instance and ensures startup() gets called with a default
-        config.
+        config. The ExpiryScheduler is disabled, as it would query the mocked
+        UserManager.
         """
         gacore = GuestAuthCore()
-        gacore.startup({'chat': 'udp'})
+        gacore.startup({'chat': 'udp', 'expiry_scheduler': 'no'})
         return gacore
 
     def test_helpers_initialized(self, mock_usermgr, mock_chat, mock_loader):
         # mock object creation
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_usermgr.return_value = mock_usermgr_obj
         mock_auth = self._get_auth_handler_mock(mock_loader)
 
         self._init_and_start()
 
-        mock_loader.assert_called_once_with(auth.AuthHandler,
-                                            DefaultAuthHandler)
+        mock_loader.assert_any_call(auth.AuthHandler, DefaultAuthHandler)
 
         # check if both util classes were initialized and that the chat
         # gets the correct UserManager and AuthHandler references.
         mock_usermgr.assert_called()
-        mock_chat.assert_called_once_with(mock_usermgr_obj, mock_auth)
+        mock_chat.assert_called_once_with(mock_usermgr_obj, mock_auth,
+                                          metrics=ANY, lock=ANY)
+
+    @patch('radguestauth.userstorages.shared.shared')
+    @patch('radguestauth.core.shared')
+    def test_shared_state_chat_owner(self, mock_shared, mock_storage,
+                                     mock_usermgr, mock_chat, mock_loader):
+        mock_state = mock_storage.open_state.return_value
+        mock_shared.ChatOwnership.return_value.acquire.return_value = True
+        gacore = GuestAuthCore()
+
+        gacore.startup({'chat': 'udp', 'user_storage': 'shared',
+                        'state_socket': '/tmp/test.sock'})
+
+        mock_storage.open_state.assert_called_once_with('/tmp/test.sock')
+        # the shared UserManager is used instead of a local one
+        mock_chat.assert_called_once_with(mock_state.user_manager(), ANY,
+                                          metrics=ANY, lock=ANY)
+        mock_chat.return_value.start.assert_called_once()
+        mock_shared.NotificationRelay.return_value.start.assert_called_once()
+        mock_shared.ChatRelay.assert_not_called()
+
+    @patch('radguestauth.userstorages.shared.shared')
+    @patch('radguestauth.core.shared')
+    def test_shared_state_chat_other_worker(self, mock_shared, mock_storage,
+                                            mock_usermgr, mock_chat,
+                                            mock_loader):
+        mock_shared.ChatOwnership.return_value.acquire.return_value = False
+        gacore = GuestAuthCore()
+
+        gacore.startup({'chat': 'udp', 'state_backend': 'shared'})
+
+        # only the owner starts the chat
+        mock_chat.assert_not_called()
+        mock_shared.NotificationRelay.assert_not_called()
+        mock_shared.ChatRelay.assert_called_once()
+
+    @patch('radguestauth.userstorages.sqlite.SqliteUserManager')
+    def test_sqlite_state(self, mock_sqlite, mock_usermgr, mock_chat,
+                          mock_loader):
+        gacore = GuestAuthCore()
+
+        gacore.startup({'chat': 'udp', 'user_storage': 'sqlite',
+                        'state_db': '/tmp/test.db',
+                        'expiry_scheduler': 'no'})
+
+        mock_sqlite.assert_called_once_with('/tmp/test.db', 1)
+        mock_chat.assert_called_once_with(mock_sqlite.return_value, ANY,
+                                          metrics=ANY, lock=ANY)
+
+        gacore.shutdown()
+        mock_sqlite.return_value.close.assert_called_once()
+
+    def test_legacy_local_state(self, mock_usermgr, mock_chat, mock_loader):
+        gacore = GuestAuthCore()
+
+        gacore.startup({'chat': 'udp', 'state_backend': 'local',
+                        'expiry_scheduler': 'no'})
+
+        mock_usermgr.assert_called_once_with(1)
+        mock_chat.assert_called_once_with(mock_usermgr.return_value, ANY,
+                                          metrics=ANY, lock=ANY)
+
+    @patch('radguestauth.userstorages.journal.JournalUserManager')
+    def test_journal_state(self, mock_journal, mock_usermgr, mock_chat,
+                           mock_loader):
+        gacore = GuestAuthCore()
+
+        gacore.startup({'chat': 'udp', 'state_backend': 'journal',
+                        'state_dir': '/tmp/test-state',
+                        'max_pending_requests': '3',
+                        'expiry_scheduler': 'no'})
+
+        mock_journal.assert_called_once_with('/tmp/test-state', 3)
+        mock_chat.assert_called_once_with(mock_journal.return_value, ANY,
+                                          metrics=ANY, lock=ANY)
+
+    @patch('radguestauth.core.ExpiryScheduler')
+    def test_expiry_schedules_all_devices(self, mock_expiry, mock_usermgr,
+                                          mock_chat, mock_loader):
+        phone = UserIdentifier('user', 'phone')
+        laptop = UserIdentifier('user', 'laptop')
+        mock_usermgr.return_value.list_users.return_value = [phone]
+        mock_usermgr.return_value.list_devices.return_value = [phone, laptop]
+        gacore = GuestAuthCore()
+
+        gacore.startup({'chat': 'udp'})
+
+        mock_expiry.return_value.on_user_change.assert_has_calls([
+            call(ANY, phone),
+            call(ANY, laptop),
+        ])
+        mock_expiry.return_value.start.assert_called_once()
+
+    def test_required_attributes(self, mock_usermgr, mock_chat, mock_loader):
+        mock_auth = self._get_auth_handler_mock(mock_loader)
+        mock_auth.required_attributes.return_value = {'NAS-Identifier'}
+        gacore = self._init_and_start()
+
+        result = gacore.required_attributes()
+
+        self.assertIn('NAS-Identifier', result)
+        for attr in ['User-Name', 'Calling-Station-Id', 'Acct-Session-Id',
+                     'EAP-Message', 'FreeRADIUS-Proxied-To']:
+            self.assertIn(attr, result)
 
     def test_chat_started_correctly(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
@@ -136,7 +293,7 @@ class GuestAuthCoreTest(TestCase):
 
     def test_skip_outer_message(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_chat_obj = Mock()
         mock_usermgr.return_value = mock_usermgr_obj
         mock_chat.return_value = mock_chat_obj
@@ -158,7 +315,7 @@ class GuestAuthCoreTest(TestCase):
 
     def test_skip_inner_message(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_chat_obj = Mock()
         mock_usermgr.return_value = mock_usermgr_obj
         mock_chat.return_value = mock_chat_obj
@@ -182,7 +339,7 @@ class GuestAuthCoreTest(TestCase):
 
     def test_eap_pwd_remember_attrs(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_chat_obj = Mock()
         mock_usermgr.return_value = mock_usermgr_obj
         mock_chat.return_value = mock_chat_obj
@@ -224,11 +381,11 @@ class GuestAuthCoreTest(TestCase):
         self.assertEqual(expected_result_inner, result_inner)
 
     def test_reject_new_on_pending_request(self, mock_usermgr, mock_chat, mock_loader):
-        # When a request is ongoing, no new users should be accepted.
+        # When the request queue is full, no new users should be accepted.
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_NEW
-        mock_usermgr_obj.is_request_pending.return_value = True
+        mock_usermgr_obj.can_add_request.return_value = False
         mock_usermgr.return_value = mock_usermgr_obj
         gacore = self._init_and_start()
 
@@ -242,16 +399,16 @@ class GuestAuthCoreTest(TestCase):
         self._assert_called_once_with_user_id(
             mock_usermgr_obj.may_join, 'user', 'aabb'
         )
-        mock_usermgr_obj.is_request_pending.assert_called_once()
+        mock_usermgr_obj.can_add_request.assert_called_once()
         mock_usermgr_obj.add_request.assert_not_called()
         self.assertEqual(expected_result, result)
 
     def test_allow_known_on_pending_request(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         # state WAITING means there is a request for this user
         mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_WAITING
-        mock_usermgr_obj.get_request.return_value = UserIdentifier('user', 'aabb')
+        mock_usermgr_obj.find_request.return_value = UserIdentifier('user', 'aabb')
         mock_usermgr.return_value = mock_usermgr_obj
         mock_auth = self._get_auth_handler_mock(mock_loader)
         gacore = self._init_and_start()
@@ -267,7 +424,7 @@ class GuestAuthCoreTest(TestCase):
         self._assert_called_once_with_user_id(
             mock_usermgr_obj.may_join, 'user', 'aabb'
         )
-        mock_usermgr_obj.get_request.assert_called_once()
+        mock_usermgr_obj.find_request.assert_called_once_with('user')
         mock_usermgr_obj.add_request.assert_not_called()
         self._assert_called_once_with_user_id(
             mock_auth.handle_user_state, 'user', 'aabb'
@@ -280,7 +437,7 @@ class GuestAuthCoreTest(TestCase):
 
     def test_reject_blocked_user(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_chat_obj = Mock()
         mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_BLOCKED
         mock_usermgr.return_value = mock_usermgr_obj
@@ -307,13 +464,13 @@ class GuestAuthCoreTest(TestCase):
 
     def test_add_request_non_pending(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_chat_obj = Mock()
         mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_NEW
-        mock_usermgr_obj.is_request_pending.return_value = False
+        mock_usermgr_obj.can_add_request.return_value = True
         mock_usermgr_obj.add_request.return_value = True
-        # after add_request, the request can be obtained via get_request
-        mock_usermgr_obj.get_request.return_value = UserIdentifier('user', 'aabb')
+        # after add_request, the request can be obtained via find_request
+        mock_usermgr_obj.find_request.return_value = UserIdentifier('user', 'aabb')
         mock_usermgr.return_value = mock_usermgr_obj
         mock_chat.return_value = mock_chat_obj
         mock_auth = self._get_auth_handler_mock(mock_loader)
@@ -330,14 +487,14 @@ class GuestAuthCoreTest(TestCase):
         self._assert_called_once_with_user_id(
             mock_usermgr_obj.may_join, 'user', 'aabb'
         )
-        mock_usermgr_obj.is_request_pending.assert_called_once()
+        mock_usermgr_obj.can_add_request.assert_called_once()
         self._assert_called_once_with_user_id(
             mock_usermgr_obj.add_request, 'user', 'aabb'
         )
-        # ensure that get_request wasn't called before add_request
+        # ensure that find_request wasn't called before add_request
         mock_usermgr_obj.assert_has_calls([call.add_request(ANY),
-                                           call.get_request()])
-        mock_usermgr_obj.get_request.assert_called_once()
+                                           call.find_request('user')])
+        mock_usermgr_obj.find_request.assert_called_once()
         self._assert_called_once_with_user_id(
             mock_chat_obj.notify_join, 'user', 'aabb'
         )
@@ -355,9 +512,9 @@ class GuestAuthCoreTest(TestCase):
     def test_add_request_non_pending_error(self, mock_usermgr, mock_chat, mock_loader):
         # block if add_request failed
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_NEW
-        mock_usermgr_obj.is_request_pending.return_value = False
+        mock_usermgr_obj.can_add_request.return_value = True
         mock_usermgr_obj.add_request.return_value = False
         mock_usermgr.return_value = mock_usermgr_obj
         gacore = self._init_and_start()
@@ -372,7 +529,7 @@ class GuestAuthCoreTest(TestCase):
         self._assert_called_once_with_user_id(
             mock_usermgr_obj.may_join, 'user', 'aabb'
         )
-        mock_usermgr_obj.is_request_pending.assert_called_once()
+        mock_usermgr_obj.can_add_request.assert_called_once()
         self._assert_called_once_with_user_id(
             mock_usermgr_obj.add_request, 'user', 'aabb'
         )
@@ -380,7 +537,7 @@ class GuestAuthCoreTest(TestCase):
 
     def test_reject_without_username(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_usermgr.return_value = mock_usermgr_obj
         gacore = self._init_and_start()
 
@@ -400,7 +557,7 @@ class GuestAuthCoreTest(TestCase):
     def test_reject_without_device(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_usermgr.return_value = mock_usermgr_obj
         gacore = self._init_and_start()
         expected_result = (auth.REJECT, None)
@@ -412,10 +569,10 @@ class GuestAuthCoreTest(TestCase):
 
     def test_allow_on_may_join(self, mock_usermgr, mock_chat, mock_loader):
         # prepare test data
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         test_user = UserIdentifier('user', 'aabb')
         test_user.password = 'secure'
-        mock_usermgr_obj.find.return_value = test_user
+        mock_usermgr_obj.find_device.return_value = test_user
         mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_ALLOWED
         mock_usermgr.return_value = mock_usermgr_obj
         mock_auth = self._get_auth_handler_mock(mock_loader)
@@ -438,9 +595,63 @@ class GuestAuthCoreTest(TestCase):
         mock_auth.handle_user_state.assert_called_once_with(
             ANY, UserData.JOIN_STATE_ALLOWED, ANY
         )
-        mock_usermgr_obj.find.assert_called_once_with('user')
+        mock_usermgr_obj.find_device.assert_called_once_with('user', 'aabb')
         self.assertEqual(expected_result, result)
 
+    def test_cached_reply(self, mock_usermgr, mock_chat, mock_loader):
+        mock_usermgr_obj = _user_manager_mock()
+        test_user = UserIdentifier('user', 'aabb', 'secure')
+        mock_usermgr_obj.find_device.return_value = test_user
+        mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_ALLOWED
+        mock_usermgr.return_value = mock_usermgr_obj
+        mock_auth = self._get_auth_handler_mock(mock_loader)
+        mock_auth.reply_cacheable.return_value = True
+        expected_result = (auth.ALLOW, {'control:Cleartext-Password': 'secure'})
+        mock_auth.handle_user_state.return_value = expected_result
+        gacore = self._init_and_start()
+        request = {'User-Name': 'user', 'Calling-Station-Id': 'aabb'}
+
+        result1 = gacore.authorize(request)
+        result2 = gacore.authorize(request)
+
+        # the handler is only called once, the state is checked every time
+        self.assertEqual(expected_result, result1)
+        self.assertEqual(expected_result, result2)
+        mock_auth.handle_user_state.assert_called_once()
+        self.assertEqual(mock_usermgr_obj.may_join.call_count, 2)
+
+        # the cache is dropped when the UserManager reports changes
+        mock_usermgr_obj.add_listener.assert_called_once()
+        listener = mock_usermgr_obj.add_listener.call_args[0][0]
+        listener('update', test_user)
+        gacore.authorize(request)
+        self.assertEqual(mock_auth.handle_user_state.call_count, 2)
+
+    def test_authorize_many(self, mock_usermgr, mock_chat, mock_loader):
+        mock_usermgr_obj = _user_manager_mock()
+        mock_usermgr_obj.may_join.return_value = UserData.JOIN_STATE_BLOCKED
+        mock_usermgr.return_value = mock_usermgr_obj
+        mock_auth = self._get_auth_handler_mock(mock_loader)
+        mock_auth.handle_user_state.return_value = (auth.REJECT, None)
+        gacore = self._init_and_start()
+
+        results = gacore.authorize_many([
+            # EAP-PWD outer and inner request
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb',
+             'EAP-Message': '0x0200000c34736f6d656f6e65'},
+            {'User-Name': 'user'},
+            # no username
+            {'Calling-Station-Id': 'aabb'},
+        ])
+
+        self.assertListEqual(results, [
+            (auth.NO_OP, None), (auth.REJECT, None), (auth.REJECT, None)
+        ])
+        # the inner request got the device of the outer one
+        self._assert_called_once_with_user_id(
+            mock_auth.handle_user_state, 'user', 'aabb'
+        )
+
     def test_post_auth_too_few_args(self, mock_usermgr, mock_chat, mock_loader):
         mock_auth = self._get_auth_handler_mock(mock_loader)
         gacore = self._init_and_start()
@@ -487,8 +698,8 @@ class GuestAuthCoreTest(TestCase):
         testuser.user_data = UserData()
         test_validity = 600
         testuser.user_data.valid_until = time.time() + test_validity
-        mock_usermgr_obj = Mock()
-        mock_usermgr_obj.find.return_value = testuser
+        mock_usermgr_obj = _user_manager_mock()
+        mock_usermgr_obj.find_device.return_value = testuser
         mock_usermgr.return_value = mock_usermgr_obj
 
         return mock_usermgr_obj, test_validity
@@ -522,7 +733,7 @@ class GuestAuthCoreTest(TestCase):
         mock_auth.on_post_auth.assert_called_once_with(
             UserIdentifier('user', 'aabb'), ANY
         )
-        mock_usermgr_obj.find.assert_called_once_with('user')
+        mock_usermgr_obj.find_device.assert_called_once_with('user', 'aabb')
         self.assertDictContainsSubset(expected_result, result)
         self._assert_timeout_attr(result, test_validity)
 
@@ -545,7 +756,7 @@ class GuestAuthCoreTest(TestCase):
         mock_auth.on_post_auth.assert_called_once_with(
             UserIdentifier('user', 'aabb'), ANY
         )
-        mock_usermgr_obj.find.assert_called_once_with('user')
+        mock_usermgr_obj.find_device.assert_called_once_with('user', 'aabb')
         self.assertIsInstance(result, dict)
         self._assert_timeout_attr(result, test_validity)
 
@@ -554,8 +765,8 @@ class GuestAuthCoreTest(TestCase):
         testuser.user_data = UserData()
         testuser.user_data.valid_until = None
         testuser.user_data.max_num_joins = 10
-        mock_usermgr_obj = Mock()
-        mock_usermgr_obj.find.return_value = testuser
+        mock_usermgr_obj = _user_manager_mock()
+        mock_usermgr_obj.find_device.return_value = testuser
         mock_usermgr.return_value = mock_usermgr_obj
 
         mock_auth = self._get_auth_handler_mock(mock_loader)
@@ -571,21 +782,40 @@ class GuestAuthCoreTest(TestCase):
         mock_auth.on_post_auth.assert_called_once_with(
             UserIdentifier('user', 'aabb'), ANY
         )
-        mock_usermgr_obj.find.assert_called_once_with('user')
+        mock_usermgr_obj.find_device.assert_called_once_with('user', 'aabb')
         # no timeout should be added without valid_until.
         self.assertEqual(expected_result, result)
         self.assertIsNone(result.get('reply:Session-Timeout'))
 
+    def test_import_users(self, mock_usermgr, mock_chat, mock_loader):
+        mock_usermgr.return_value = UserManager()
+        mock_auth = self._get_auth_handler_mock(mock_loader)
+        gacore = self._init_and_start()
+
+        result = gacore.import_users([
+            'name,device,state\n',
+            'a,02:00:00:00:00:01,allowed\n',
+            'b,02:00:00:00:00:02,blocked\n',
+            'c,invalid\n',
+        ], 'csv')
+
+        self.assertEqual(result.imported, 2)
+        self.assertEqual(result.rejected, 1)
+        # only allowed devices are accepted
+        mock_auth.on_host_accept.assert_called_once_with(
+            UserIdentifier('a', '02-00-00-00-00-01')
+        )
+        self.assertEqual(len(list(gacore.export_users('csv'))), 3)
+
     def test_drop_expired_users(self, mock_usermgr, mock_chat, mock_loader):
         testuser1 = UserIdentifier('user', 'aabb')
         testuser2 = UserIdentifier('user2', 'aabb2')
         testuser3 = UserIdentifier('user3', 'aabb3')
-        mock_usermgr_obj = Mock()
+        mock_usermgr_obj = _user_manager_mock()
         mock_usermgr_obj.get_expired_users.return_value = [
             testuser1, testuser2
         ]
-        mock_usermgr_obj.is_request_pending.return_value = True
-        mock_usermgr_obj.get_request.return_value = testuser3
+        mock_usermgr_obj.list_requests.return_value = [(4, testuser3)]
         mock_usermgr.return_value = mock_usermgr_obj
         mock_auth = self._get_auth_handler_mock(mock_loader)
         gacore = self._init_and_start()
@@ -596,7 +826,7 @@ class GuestAuthCoreTest(TestCase):
             [call(testuser1), call(testuser2)],
             any_order=True
         )
-        mock_usermgr_obj.finish_request.assert_called_once()
+        mock_usermgr_obj.finish_request.assert_called_once_with(4)
 
         mock_auth.on_host_deny.assert_has_calls(
             [call(testuser1), call(testuser2), call(testuser3)],
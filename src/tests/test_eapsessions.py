@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import random
+
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import Mock
+from radguestauth.core import GuestAuthCore
+from radguestauth.eapsessions import EapSessionTable
+from radguestauth.users.storage import UserData
+
+PWD_MESSAGE = '0x0200000c34736f6d656f6e65'
+
+
+class EapSessionTableTest(TestCase):
+    def setUp(self):
+        self.table = EapSessionTable(max_entries=3, ttl=30)
+
+    def test_put_and_take(self):
+        self.table.put('a', None, 'aa-aa', 'sess-a')
+        self.table.put('b', None, 'bb-bb', 'sess-b')
+
+        self.assertTrue(self.table.pending('a'))
+        self.assertEqual(self.table.take('b'), ('bb-bb', 'sess-b'))
+        self.assertEqual(self.table.take('a'), ('aa-aa', 'sess-a'))
+        # entries are taken only once
+        self.assertIsNone(self.table.take('a'))
+        self.assertFalse(self.table.pending('a'))
+        self.assertEqual(len(self.table), 0)
+
+    def test_nas_mismatch(self):
+        self.table.put('a', '10.0.0.1', 'aa-aa', '')
+
+        self.assertIsNone(self.table.take('a', '10.0.0.2'))
+        self.assertEqual(self.table.take('a', '10.0.0.1'), ('aa-aa', ''))
+
+        # inner requests without NAS-IP-Address match any entry
+        self.table.put('a', '10.0.0.1', 'aa-aa', '')
+        self.assertEqual(self.table.take('a'), ('aa-aa', ''))
+
+    def test_several_devices(self):
+        self.table.put('a', '10.0.0.1', 'phone', 'sess-1')
+        self.table.put('a', '10.0.0.2', 'laptop', 'sess-2')
+        self.table.put('a', '10.0.0.1', 'tablet', 'sess-3')
+
+        # the devices of one user don't replace each other
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.take('a', '10.0.0.2'),
+                         ('laptop', 'sess-2'))
+        self.assertEqual(self.table.take('a'), ('phone', 'sess-1'))
+        self.assertTrue(self.table.pending('a'))
+        self.assertEqual(self.table.take('a', '10.0.0.1'),
+                         ('tablet', 'sess-3'))
+        self.assertFalse(self.table.pending('a'))
+
+    def test_ttl(self):
+        table = EapSessionTable(ttl=0)
+        table.put('a', None, 'aa-aa', '')
+
+        self.assertFalse(table.pending('a'))
+        self.assertIsNone(table.take('a'))
+
+    def test_bounded(self):
+        for i in range(10):
+            self.table.put('user%d' % i, None, 'dev%d' % i, '')
+
+        self.assertEqual(len(self.table), 3)
+        # the oldest entries got evicted
+        self.assertIsNone(self.table.take('user6'))
+        self.assertEqual(self.table.take('user9'), ('dev9', ''))
+
+    def test_put_replaces(self):
+        self.table.put('a', None, 'old', '')
+        self.table.put('b', None, 'bb', '')
+        self.table.put('a', None, 'new', '')
+        self.table.put('c', None, 'cc', '')
+        self.table.put('d', None, 'dd', '')
+
+        # the update of a made b the oldest entry
+        self.assertIsNone(self.table.take('b'))
+        self.assertEqual(self.table.take('a'), ('new', ''))
+
+
+class EapPwdCorrelationTest(TestCase):
+    """
+    Runs many EAP-PWD conversations concurrently through the core.
+    """
+    THREADS = 8
+    FLOWS = 200
+
+    def setUp(self):
+        self.core = GuestAuthCore()
+        self.core.startup({'chat': 'udp', 'eap_sessions_max': '64'})
+        self.addCleanup(self.core.shutdown)
+        self.seen = []
+        self.core._user_manager = Mock()
+        self.core._user_manager.admit.side_effect = self._admit
+        self.core._reply_cache = None
+
+    def _admit(self, user_id):
+        self.seen.append((user_id.name, user_id.device_id))
+        return (UserData.JOIN_STATE_BLOCKED, user_id, False)
+
+    def _run_flows(self, thread_no):
+        rand = random.Random(thread_no)
+        users = ['user-%d-%d' % (thread_no, i) for i in range(self.FLOWS)]
+        outstanding = []
+        for name in users:
+            self.core.authorize({
+                'User-Name': name,
+                'Calling-Station-Id': 'dev-' + name,
+                'EAP-Message': PWD_MESSAGE,
+            })
+            outstanding.append(name)
+            # answer a random number of open conversations in random order
+            rand.shuffle(outstanding)
+            while outstanding and rand.random() < 0.6:
+                self.core.authorize({'User-Name': outstanding.pop()})
+        for name in outstanding:
+            self.core.authorize({'User-Name': name})
+
+    def test_concurrent_flows(self):
+        threads = [Thread(target=self._run_flows, args=(i,))
+                   for i in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        correlated = [(name, device) for name, device in self.seen
+                      if device == 'dev-' + name]
+        # No inner request may get the device of another conversation.
+        # Conversations evicted from the full table are rejected without
+        # device, but those are rare with this table size.
+        self.assertEqual(len(self.seen), len(correlated))
+        self.assertGreater(len(correlated),
+                           self.THREADS * self.FLOWS * 0.9)
+        self.assertEqual(len(self.core._eap_sessions), 0)
+
+    def test_memory_bounded(self):
+        # outer requests whose inner request never arrives
+        for i in range(1000):
+            self.core.authorize({
+                'User-Name': 'user%d' % i,
+                'Calling-Station-Id': 'dev%d' % i,
+                'EAP-Message': PWD_MESSAGE,
+            })
+
+        self.assertEqual(len(self.core._eap_sessions), 64)
@@ -0,0 +1,190 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+
+from threading import Event, Thread
+from unittest import TestCase
+from unittest.mock import Mock
+from radguestauth.core import GuestAuthCore
+from radguestauth.expiry import ExpiryScheduler
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.deadlines import DeadlineHeap
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class ExpirySchedulerTest(TestCase):
+    def setUp(self):
+        self.expired = []
+        self.done = Event()
+        self.scheduler = ExpiryScheduler(self._callback)
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def _callback(self, name, valid_until):
+        self.expired.append((name, valid_until))
+        self.done.set()
+
+    def _wait(self):
+        self.assertTrue(self.done.wait(2))
+        self.done.clear()
+
+    def test_expire_in_order(self):
+        now = time.time()
+        self.scheduler.schedule('later', now + 0.2)
+        self.scheduler.schedule('sooner', now + 0.1)
+        self.scheduler.schedule('past', now - 10)
+
+        for _ in range(3):
+            self._wait()
+
+        self.assertListEqual([name for name, _ in self.expired],
+                             ['past', 'sooner', 'later'])
+        self.assertEqual(self.expired[1], ('sooner', now + 0.1))
+        self.assertGreaterEqual(time.time(), now + 0.2)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_reschedule_and_remove(self):
+        now = time.time()
+        self.scheduler.schedule('moved', now + 0.05)
+        self.scheduler.schedule('moved', now + 0.15)
+        self.scheduler.schedule('removed', now + 0.05)
+        self.scheduler.schedule('removed', None)
+
+        self._wait()
+        time.sleep(0.1)
+
+        # only the current deadline is reported
+        self.assertListEqual(self.expired, [('moved', now + 0.15)])
+
+    def test_user_events(self):
+        user = UserIdentifier('user', 'device')
+        user.user_data = UserData()
+        user.user_data.valid_until = time.time() + 100
+
+        self.scheduler.on_user_change(UserManager.EVENT_UPDATE, user)
+        self.assertEqual(len(self.scheduler), 1)
+        self.scheduler.on_user_change(UserManager.EVENT_REMOVE, user)
+        self.assertEqual(len(self.scheduler), 0)
+
+        # users without time limit are not scheduled
+        user.user_data.valid_until = None
+        self.scheduler.on_user_change(UserManager.EVENT_UPDATE, user)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_heap_compaction(self):
+        deadline = time.time() + 100
+        for i in range(1000):
+            self.scheduler.schedule('user', deadline + i)
+
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertLessEqual(len(self.scheduler._deadlines._heap),
+                             2 + DeadlineHeap.SLACK)
+
+
+class CoreExpiryTest(TestCase):
+    def test_expired_user_dropped(self):
+        core = GuestAuthCore()
+        core.startup({'chat': 'udp'})
+        self.addCleanup(core.shutdown)
+        core._auth_handler = Mock()
+        denied = Event()
+        core._auth_handler.on_host_deny.side_effect = \
+            lambda user: denied.set()
+        mgr = core._user_manager
+
+        user = UserIdentifier('user', '02-00-00-00-00-01')
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.valid_until = time.time() + 0.1
+        mgr.update(user)
+        mgr.finish_request()
+
+        self.assertTrue(denied.wait(2))
+        core._auth_handler.on_host_deny.assert_called_once_with(user)
+        self.assertIsNone(mgr.find('user'))
+
+    def test_extended_user_kept(self):
+        core = GuestAuthCore()
+        # call _expire_user directly instead
+        core.startup({'chat': 'udp', 'expiry_scheduler': 'no'})
+        self.addCleanup(core.shutdown)
+        core._auth_handler = Mock()
+        mgr = core._user_manager
+
+        user = UserIdentifier('user', '02-00-00-00-00-01')
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.valid_until = time.time() - 1
+        mgr.update(user)
+        mgr.finish_request()
+        # the user was extended before the scheduler got to it
+        user.user_data.valid_until = time.time() + 100
+        core._expire_user(('user', '02-00-00-00-00-01'), time.time() - 1)
+
+        core._auth_handler.on_host_deny.assert_not_called()
+        self.assertIsNotNone(mgr.find('user'))
+
+    def test_expiry_takes_core_lock(self):
+        core = GuestAuthCore()
+        core.startup({'chat': 'udp', 'expiry_scheduler': 'no'})
+        self.addCleanup(core.shutdown)
+        core._auth_handler = Mock()
+        mgr = core._user_manager
+
+        user = UserIdentifier('user', '02-00-00-00-00-01')
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.valid_until = time.time() - 1
+        mgr.update(user)
+        mgr.finish_request()
+
+        # a request thread is changing the user state
+        with core._lock:
+            expire = Thread(target=core._expire_user,
+                            args=(('user', '02-00-00-00-00-01'),
+                                  user.user_data.valid_until))
+            expire.start()
+            expire.join(0.2)
+            self.assertTrue(expire.is_alive())
+            core._auth_handler.on_host_deny.assert_not_called()
+        expire.join(2)
+
+        core._auth_handler.on_host_deny.assert_called_once_with(user)
+        self.assertIsNone(mgr.find('user'))
+
+    def test_deny_without_core_lock(self):
+        core = GuestAuthCore()
+        core.startup({'chat': 'udp', 'expiry_scheduler': 'no'})
+        self.addCleanup(core.shutdown)
+        core._auth_handler = Mock()
+        mgr = core._user_manager
+        locked = []
+
+        def on_host_deny(user):
+            # the AuthHandler may run slow commands, requests go on
+            other = Thread(target=lambda: locked.append(
+                not core._lock.acquire(timeout=1) or core._lock.release()
+            ))
+            other.start()
+            other.join()
+        core._auth_handler.on_host_deny.side_effect = on_host_deny
+
+        for i, name in enumerate(['expired', 'dropped']):
+            user = UserIdentifier(name, '02-00-00-00-00-0%d' % i)
+            mgr.add_request(user)
+            user.user_data = UserData()
+            user.user_data.valid_until = time.time() - 1
+            mgr.update(user)
+            mgr.finish_request()
+        mgr.add_request(UserIdentifier('pending', '02-00-00-00-00-09'))
+
+        core._expire_user(('expired', '02-00-00-00-00-00'),
+                          mgr.find('expired').user_data.valid_until)
+        core.drop_expired_users()
+
+        self.assertEqual(core._auth_handler.on_host_deny.call_count, 3)
+        self.assertListEqual(locked, [None] * 3)
+        self.assertEqual(mgr.count_users(), 0)
+        self.assertFalse(mgr.is_request_pending())
@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import radguestauth.auth as auth
+import radguestauth.metrics as metrics
+
+from unittest import TestCase
+from radguestauth.core import GuestAuthCore
+from radguestauth.rest import RestHandler
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class HistogramTest(TestCase):
+    def test_observe(self):
+        hist = metrics.Histogram((0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            hist.observe(value)
+
+        self.assertEqual(hist.count, 4)
+        self.assertAlmostEqual(hist.sum, 2.65)
+        # upper bounds are inclusive
+        self.assertListEqual(hist.cumulative(),
+                             [('0.1', 2), ('1.0', 3), ('+Inf', 4)])
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_count_request(self):
+        self.metrics.count_request('authorize', auth.ALLOW, 0.001)
+        self.metrics.count_request('authorize', auth.ALLOW, 0.002)
+        self.metrics.count_request('post_auth', metrics.NO_DECISION, 0.001)
+
+        self.assertEqual(self.metrics.requests('authorize', auth.ALLOW), 2)
+        self.assertEqual(self.metrics.requests('authorize', auth.REJECT), 0)
+        self.assertEqual(self.metrics.requests('post_auth'), 1)
+
+    def test_stage_done(self):
+        start = metrics.clock()
+        now = self.metrics.stage_done(metrics.STAGE_EAP, start)
+        self.assertGreaterEqual(now, start)
+
+    def test_render(self):
+        self.metrics.count_request('authorize', auth.NO_OP, 0.00002)
+        self.metrics.observe_stage(metrics.STAGE_MAY_JOIN, 0.00003)
+        self.metrics.add_gauge('test_gauge', 'A gauge.', lambda: 3)
+        self.metrics.add_counter('test_total', 'A counter.', lambda: 7)
+        self.metrics.observe_command('list', 0.002)
+
+        text = self.metrics.render()
+        lines = text.splitlines()
+
+        self.assertIn('radguestauth_requests_total'
+                      '{decision="no_op",endpoint="authorize"} 1', lines)
+        self.assertIn('radguestauth_request_seconds_bucket'
+                      '{endpoint="authorize",le="2.5e-05"} 1', lines)
+        self.assertIn('radguestauth_request_seconds_count'
+                      '{endpoint="authorize"} 1', lines)
+        self.assertIn('radguestauth_stage_seconds_bucket'
+                      '{stage="may_join",le="+Inf"} 1', lines)
+        self.assertIn('radguestauth_stage_seconds_count'
+                      '{stage="notify_join"} 0', lines)
+        self.assertIn('radguestauth_command_seconds_count'
+                      '{command="list"} 1', lines)
+        self.assertIn('# TYPE test_gauge gauge', lines)
+        self.assertIn('test_gauge 3', lines)
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total 7', lines)
+        self.assertTrue(text.endswith('\n'))
+
+
+class CoreMetricsTest(TestCase):
+    def setUp(self):
+        self.core = GuestAuthCore()
+        self.core.startup({'chat': 'udp'})
+        self.addCleanup(self.core.shutdown)
+        self.handler = RestHandler(self.core, {'rest_parser': 'full'})
+
+    def _body(self, name, device):
+        return ('{"User-Name": {"value": ["%s"]}, '
+                '"Calling-Station-Id": {"value": ["%s"]}}'
+                % (name, device)).encode()
+
+    def test_authorize_recorded(self):
+        # a new user triggers a join request, the second one is rejected
+        self.handler.authorize(self._body('new', 'aabb'))
+        self.handler.authorize(self._body('other', 'ccdd'))
+
+        stats = self.core.metrics
+        self.assertEqual(stats.requests('authorize', auth.REJECT), 2)
+        text = stats.render()
+        for stage in metrics.STAGES:
+            self.assertIn('radguestauth_stage_seconds_count{stage="%s"}'
+                          % stage, text)
+        self.assertIn('radguestauth_stage_seconds_count'
+                      '{stage="notify_join"} 1', text)
+        self.assertIn('radguestauth_stage_seconds_count'
+                      '{stage="may_join"} 2', text)
+        self.assertIn('radguestauth_pending_requests 1', text)
+
+    def test_batch_decisions(self):
+        self.handler.authorize_batch(b'[{}, %s, %s]' % (
+            self._body('new', 'aabb'), self._body('other', 'ccdd')
+        ))
+
+        stats = self.core.metrics
+        # the empty request is rejected as well
+        self.assertEqual(stats.requests('authorize_batch', auth.REJECT), 3)
+        # the batch itself is not counted
+        self.assertEqual(stats.requests('authorize_batch'), 0)
+
+    def test_gauges(self):
+        mgr = self.core._user_manager
+        for name, state in [('a', UserData.JOIN_STATE_ALLOWED),
+                            ('b', UserData.JOIN_STATE_BLOCKED)]:
+            mgr.add_request(UserIdentifier(name, '00-00-00-00-00-0' + name))
+            req = mgr.get_request()
+            req.user_data = UserData()
+            req.user_data.join_state = state
+            mgr.update(req)
+            mgr.finish_request()
+
+        status, body = self.handler.metrics()
+        lines = body.decode().splitlines()
+
+        self.assertEqual(status, 200)
+        self.assertIn('radguestauth_users 2', lines)
+        self.assertIn('radguestauth_blocked_users 1', lines)
+        self.assertIn('radguestauth_pending_requests 0', lines)
+        # the startup messages may not be sent yet
+        self.assertTrue(any(line.startswith('radguestauth_chat_outbox ')
+                            for line in lines))
+        self.assertIn('radguestauth_chat_dropped_total 0', lines)
@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import tempfile
+
+from threading import Event
+from unittest import TestCase
+from unittest.mock import Mock, call
+
+from radguestauth.outbox import ChatOutbox
+
+
+class BlockingChat(object):
+    """
+    Fake chat whose send_message waits until released.
+    """
+
+    def __init__(self):
+        self.release = Event()
+        self.messages = []
+
+    def send_message(self, message):
+        self.release.wait(5)
+        self.messages.append(message)
+
+
+class ChatOutboxTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.spool = os.path.join(self._dir.name, 'spool')
+
+    def _start(self, chat, **kwargs):
+        outbox = ChatOutbox(chat, **kwargs)
+        outbox.start()
+        self.addCleanup(outbox.stop, 1)
+        return outbox
+
+    def test_order(self):
+        chat = Mock()
+        outbox = self._start(chat)
+        for i in range(100):
+            outbox.send('message %d' % i)
+
+        self.assertTrue(outbox.flush(2))
+        chat.send_message.assert_has_calls(
+            [call('message %d' % i) for i in range(100)]
+        )
+        self.assertEqual(outbox.queued_messages(), 0)
+
+    def test_send_does_not_block(self):
+        chat = BlockingChat()
+        outbox = self._start(chat)
+
+        outbox.send('first')
+        outbox.send('second')
+
+        self.assertFalse(outbox.flush(0.05))
+        self.assertEqual(outbox.queued_messages(), 2)
+        chat.release.set()
+        self.assertTrue(outbox.flush(2))
+        self.assertListEqual(chat.messages, ['first', 'second'])
+
+    def test_drop_oldest(self):
+        chat = Mock()
+        outbox = ChatOutbox(chat, max_size=2)
+        for i in range(4):
+            outbox.send(i)
+        outbox.start()
+        self.addCleanup(outbox.stop, 1)
+
+        self.assertTrue(outbox.flush(2))
+        chat.send_message.assert_has_calls([call(2), call(3)])
+        self.assertEqual(outbox.dropped, 2)
+
+    def test_failing_chat(self):
+        chat = Mock()
+        chat.send_message.side_effect = [RuntimeError('test'), None]
+        outbox = self._start(chat)
+        outbox.send('lost')
+        outbox.send('sent')
+
+        self.assertTrue(outbox.flush(2))
+        self.assertEqual(chat.send_message.call_count, 2)
+        self.assertEqual(outbox.dropped, 1)
+
+    def test_stop_sends_remaining(self):
+        chat = Mock()
+        outbox = ChatOutbox(chat)
+        outbox.send('bye')
+        outbox.start()
+        outbox.stop()
+
+        chat.send_message.assert_called_once_with('bye')
+
+    def test_spool_emptied_when_sent(self):
+        chat = Mock()
+        outbox = self._start(chat, spool_path=self.spool)
+        outbox.send('hello')
+
+        self.assertTrue(outbox.flush(2))
+        outbox.stop()
+        self.assertEqual(os.path.getsize(self.spool), 0)
+
+    def test_send_does_not_wait_for_spool(self):
+        chat = Mock()
+        outbox = ChatOutbox(chat, spool_path=self.spool)
+        release = Event()
+        self.addCleanup(release.set)
+        # a stalled file system
+        outbox._spool.close()
+        outbox._spool = Mock()
+        outbox._spool.write.side_effect = lambda data: release.wait(5)
+        outbox.start()
+        self.addCleanup(outbox.stop, 1)
+
+        outbox.send('first')
+        outbox.send('second')
+
+        self.assertTrue(outbox.flush(2))
+        self.assertEqual(chat.send_message.call_count, 2)
+
+    def test_spool_survives_restart(self):
+        chat = BlockingChat()
+        outbox = self._start(chat, spool_path=self.spool)
+        outbox.send('first')
+        outbox.send('second ü')
+        # the chat is stalled, both messages are given up
+        outbox.stop(0.05)
+        chat.release.set()
+        with open(self.spool, 'a') as f:
+            f.write('"cut off')
+
+        chat = Mock()
+        outbox = ChatOutbox(chat, spool_path=self.spool)
+        self.assertEqual(outbox.queued_messages(), 2)
+        outbox.start()
+        self.addCleanup(outbox.stop, 1)
+        outbox.send('third')
+
+        self.assertTrue(outbox.flush(2))
+        chat.send_message.assert_has_calls(
+            [call('first'), call('second ü'), call('third')]
+        )
+
+    def test_spool_bounded(self):
+        chat = BlockingChat()
+        outbox = self._start(chat, max_size=3, spool_path=self.spool)
+        for i in range(20):
+            outbox.send('message %d' % i)
+            with open(self.spool) as f:
+                self.assertLessEqual(len(f.readlines()), 6)
+        outbox.stop(0.05)
+        chat.release.set()
+
+        chat = Mock()
+        outbox = ChatOutbox(chat, max_size=3, spool_path=self.spool)
+        # the dropped messages are not sent again
+        self.assertEqual(outbox.dropped, 0)
+        outbox.start()
+        self.addCleanup(outbox.stop, 1)
+        self.assertTrue(outbox.flush(2))
+        self.assertListEqual(chat.send_message.call_args_list,
+                             [call('message %d' % i) for i in (17, 18, 19)])
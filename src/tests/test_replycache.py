@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import radguestauth.auth as auth
+
+from unittest import TestCase
+from radguestauth.replycache import ReplyCache, CachedReply
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class ReplyCacheTest(TestCase):
+    def setUp(self):
+        self.cache = ReplyCache()
+        self.result = (auth.ALLOW, {'control:Cleartext-Password': 'pw'})
+
+    def test_cached_reply(self):
+        reply = CachedReply({'control:Cleartext-Password': 'pw'})
+
+        self.assertEqual(reply, {'control:Cleartext-Password': 'pw'})
+        self.assertEqual(json.loads(reply.body.decode()), reply)
+
+    def test_put_and_get(self):
+        allowed = UserData.JOIN_STATE_ALLOWED
+        self.assertIsNone(self.cache.get('foo', allowed))
+
+        stored = self.cache.put('foo', allowed, self.result,
+                                self.cache.generation)
+
+        self.assertEqual(stored, self.result)
+        self.assertIsInstance(stored[1], CachedReply)
+        self.assertIs(self.cache.get('foo', allowed), stored)
+        # other states and users are not affected
+        self.assertIsNone(self.cache.get('foo', UserData.JOIN_STATE_WAITING))
+        self.assertIsNone(self.cache.get('bar', allowed))
+
+    def test_devices(self):
+        allowed = UserData.JOIN_STATE_ALLOWED
+        stored = self.cache.put('foo', allowed, self.result,
+                                self.cache.generation, 'phone')
+
+        self.assertIs(self.cache.get('foo', allowed, 'phone'), stored)
+        self.assertIsNone(self.cache.get('foo', allowed, 'laptop'))
+
+        # a change of any device drops the entries of the user
+        self.cache.on_user_change(UserManager.EVENT_UPDATE,
+                                  UserIdentifier('foo', 'laptop'))
+        self.assertIsNone(self.cache.get('foo', allowed, 'phone'))
+
+    def test_only_allowed_stored(self):
+        for state in [UserData.JOIN_STATE_BLOCKED,
+                      UserData.JOIN_STATE_WAITING]:
+            stored = self.cache.put('attacker', state, (auth.REJECT, {}),
+                                    self.cache.generation, 'any')
+
+            self.assertEqual(stored, (auth.REJECT, {}))
+            self.assertIsNone(self.cache.get('attacker', state, 'any'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_put_without_attributes(self):
+        result = (auth.REJECT, None)
+        stored = self.cache.put('foo', UserData.JOIN_STATE_BLOCKED, result,
+                                self.cache.generation)
+        self.assertEqual(stored, result)
+
+    def test_outdated_put(self):
+        generation = self.cache.generation
+        self.cache.on_user_change(UserManager.EVENT_UPDATE,
+                                  UserIdentifier('foo', 'bar'))
+
+        stored = self.cache.put('foo', UserData.JOIN_STATE_ALLOWED,
+                                self.result, generation)
+
+        # the result can be used, but isn't stored
+        self.assertEqual(stored, self.result)
+        self.assertIsNone(self.cache.get('foo', UserData.JOIN_STATE_ALLOWED))
+
+    def test_invalidation_with_usermanager(self):
+        mgr = UserManager()
+        mgr.add_listener(self.cache.on_user_change)
+        allowed = UserData.JOIN_STATE_ALLOWED
+        testuser = UserIdentifier('foo', 'bar')
+        otheruser = UserIdentifier('other', 'baz')
+
+        def fill():
+            for name in ['foo', 'other']:
+                self.cache.put(name, allowed, self.result,
+                               self.cache.generation)
+
+        fill()
+        mgr.add_request(testuser)
+        self.assertIsNone(self.cache.get('foo', allowed))
+        self.assertIsNotNone(self.cache.get('other', allowed))
+
+        testuser.user_data = UserData()
+        for change in [lambda: mgr.update(testuser), mgr.finish_request,
+                       lambda: mgr.remove(testuser)]:
+            fill()
+            change()
+            self.assertIsNone(self.cache.get('foo', allowed))
+            self.assertIsNotNone(self.cache.get('other', allowed))
+
+        # a new password affects all users
+        fill()
+        mgr.generate_password()
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.get('other', allowed))
+        mgr.remove(otheruser)
@@ -0,0 +1,311 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import io
+import json
+import radguestauth.auth as auth
+
+from unittest import TestCase
+from unittest.mock import Mock
+from radguestauth.core import GuestAuthCore
+from radguestauth.replycache import CachedReply
+from radguestauth.users.bulk import ImportResult
+from radguestauth.rest import (json_rest_unpack, extract_attributes,
+                               unpack_request, reply_body, RestHandler,
+                               NoOpShortcut)
+
+
+TEST_BODY = json.dumps({
+    'User-Name': {'type': 'string', 'value': ['someone']},
+    'NAS-IP-Address': {'type': 'ipaddr', 'value': ['127.0.0.1']},
+    'Framed-MTU': {'type': 'integer', 'value': [1400]},
+    # the name of another attribute inside a value must not be found
+    'Connect-Info': {'type': 'string',
+                     'value': ['"Calling-Station-Id": {"value": ["x"]}']},
+    'Calling-Station-Id': {'type': 'string',
+                           'value': ['02-00-00-00-00-01']},
+    'EAP-Message': {'type': 'octets', 'value': ['0x0200000c0173']},
+})
+
+
+class RestTest(TestCase):
+    def test_extract_attributes(self):
+        res = extract_attributes(
+            TEST_BODY.encode(),
+            ['User-Name', 'Calling-Station-Id', 'Framed-MTU', 'Not-There']
+        )
+
+        self.assertDictEqual(res, {
+            'User-Name': 'someone',
+            'Calling-Station-Id': '02-00-00-00-00-01',
+            'Framed-MTU': '1400'
+        })
+
+    def test_extract_attributes_matches_full_parser(self):
+        full = json_rest_unpack(json.loads(TEST_BODY))
+        fast = extract_attributes(TEST_BODY, full.keys())
+
+        self.assertDictEqual(full, fast)
+
+    def test_extract_attributes_duplicate(self):
+        body = ('{"User-Name": {"value": ["a"]}, '
+                '"User-Name": {"value": ["b"]}}')
+
+        # the last value wins, like in json.loads
+        self.assertDictEqual(extract_attributes(body, ['User-Name']),
+                             json_rest_unpack(json.loads(body)))
+
+    def test_extract_attributes_whitespace(self):
+        body = '{ "User-Name" :\n {"type": "string", "value": ["a"]} }'
+        res = extract_attributes(body, ['User-Name'])
+        self.assertDictEqual(res, {'User-Name': 'a'})
+
+    def test_extract_attributes_malformed(self):
+        invalid_bodies = [
+            '{"User-Name": {"type": "string"}}',
+            '{"User-Name": {"value": []}}',
+            '{"User-Name": "foo"}',
+            '{"User-Name": {"value": ["a"]',
+        ]
+        for body in invalid_bodies:
+            with self.assertRaises(ValueError):
+                extract_attributes(body, ['User-Name'])
+
+    def test_unpack_request_full(self):
+        res = unpack_request(TEST_BODY.encode())
+        self.assertDictEqual(res, json_rest_unpack(json.loads(TEST_BODY)))
+
+    def test_unpack_request_fast(self):
+        res = unpack_request(TEST_BODY.encode(), ['User-Name'])
+        self.assertDictEqual(res, {'User-Name': 'someone'})
+
+    def test_unpack_request_invalid(self):
+        for body in [b'', b'foobar', b'{"User-Name": 3}', b'[1, 2]']:
+            self.assertEqual(unpack_request(body, ['User-Name']), {})
+            self.assertEqual(unpack_request(body), {})
+
+    def test_reply_body(self):
+        attrs = {'reply:Session-Timeout': 60}
+        self.assertEqual(json.loads(reply_body(attrs).decode()), attrs)
+
+        cached = CachedReply(attrs)
+        self.assertIs(reply_body(cached), cached.body)
+
+
+class RestHandlerTest(TestCase):
+    def setUp(self):
+        self.core = Mock()
+        self.core.required_attributes.return_value = {'User-Name'}
+        self.handler = RestHandler(self.core, {'rest_parser': 'fast'})
+
+    def test_default_parser(self):
+        self.handler = RestHandler(self.core, {})
+        self.core.authorize.return_value = (auth.NO_OP, None)
+        self.handler.authorize(TEST_BODY.encode())
+        self.core.authorize.assert_called_once_with(
+            json_rest_unpack(json.loads(TEST_BODY))
+        )
+
+    def test_fast_parser(self):
+        self.core.authorize.return_value = (auth.NO_OP, None)
+        self.handler.authorize(TEST_BODY.encode())
+        self.core.authorize.assert_called_once_with({'User-Name': 'someone'})
+
+    def test_full_parser(self):
+        self.handler = RestHandler(self.core, {'rest_parser': 'full'})
+        self.core.post_auth.return_value = None
+        self.handler.post_auth(TEST_BODY.encode())
+        self.core.post_auth.assert_called_once_with(
+            json_rest_unpack(json.loads(TEST_BODY))
+        )
+
+    def test_authorize_results(self):
+        attrs = {'control:Cleartext-Password': 'pw'}
+        expected = [
+            ((auth.REJECT, None), 401),
+            ((auth.NO_OP, None), 204),
+            ((auth.ALLOW, attrs), 200),
+        ]
+        for result, status in expected:
+            self.core.authorize.return_value = result
+            res_status, body = self.handler.authorize(TEST_BODY.encode())
+            self.assertEqual(res_status, status)
+            self.assertIsInstance(body, bytes)
+
+        self.assertEqual(json.loads(body.decode()), attrs)
+
+    def test_authorize_batch(self):
+        attrs = {'control:Cleartext-Password': 'pw'}
+        self.core.authorize_many.side_effect = lambda items: [
+            (auth.ALLOW, attrs), (auth.NO_OP, None), (auth.REJECT, None)
+        ][:len(list(items))]
+        body = '[%s, {}, "invalid"]' % TEST_BODY
+
+        status, res = self.handler.authorize_batch(body.encode())
+
+        self.assertEqual(status, 200)
+        self.assertListEqual(json.loads(res.decode()), [
+            {'status': 200, 'reply': attrs},
+            {'status': 204, 'reply': None},
+            {'status': 401, 'reply': {}},
+        ])
+
+    def test_authorize_batch_matches_single_calls(self):
+        bodies = [
+            # EAP-PWD outer and inner request of a new guest, followed by
+            # another guest who is rejected due to the pending request
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb',
+             'EAP-Message': '0x0200000c34736f6d656f6e65'},
+            {'User-Name': 'user', 'FreeRADIUS-Proxied-To': '127.0.0.1'},
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb',
+             'EAP-Message': '0x0200000c19736f6d656f6e65'},
+            {'User-Name': 'other', 'Calling-Station-Id': 'ccdd'},
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb'},
+        ]
+        bodies = [dict((k, {'type': 'string', 'value': [v]})
+                       for k, v in b.items()) for b in bodies]
+
+        def new_handler():
+            core = GuestAuthCore()
+            core.startup({'chat': 'udp'})
+            self.addCleanup(core.shutdown)
+            return RestHandler(core, {})
+
+        single = new_handler()
+        expected = []
+        for body in bodies:
+            status, reply = single.authorize(json.dumps(body).encode())
+            expected.append({'status': status,
+                             'reply': json.loads(reply.decode())
+                             if reply else None})
+
+        status, res = new_handler().authorize_batch(
+            json.dumps(bodies).encode()
+        )
+
+        self.assertEqual(status, 200)
+        self.assertListEqual(json.loads(res.decode()), expected)
+        # the default handler rejects guests until they are allowed
+        self.assertEqual([e['status'] for e in expected],
+                         [204, 401, 204, 401, 401])
+
+    def test_authorize_batch_invalid(self):
+        for body in [b'', b'{}', b'[1, 2']:
+            self.assertEqual(self.handler.authorize_batch(body),
+                             (400, b'{}'))
+        self.core.authorize_many.assert_not_called()
+
+    def test_post_auth_results(self):
+        self.core.post_auth.return_value = None
+        self.assertEqual(self.handler.post_auth(b'{}')[0], 204)
+
+        self.core.post_auth.return_value = {'reply:Session-Timeout': 10}
+        status, body = self.handler.post_auth(b'{}')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode()),
+                         {'reply:Session-Timeout': 10})
+
+    def test_drop_expired(self):
+        self.assertEqual(self.handler.drop_expired()[0], 200)
+        self.core.drop_expired_users.assert_called_once()
+
+    def test_import_export_users(self):
+        result = ImportResult()
+        result.imported = 2
+        self.core.import_users.return_value = result
+        status, body = self.handler.import_users(
+            'csv', [b'name,device\n', b'a,02-00-00-00-00-01\n']
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['imported'], 2)
+        fmt = self.core.import_users.call_args[0][1]
+        self.assertEqual(fmt, 'csv')
+
+        self.core.export_users.return_value = iter(['a\n', 'b\n'])
+        status, body = self.handler.export_users('csv')
+        self.assertEqual(status, 200)
+        self.assertEqual(b''.join(body), b'a\nb\n')
+
+
+class NoOpShortcutTest(TestCase):
+    def setUp(self):
+        self.app = Mock()
+        self.app.return_value = [b'app response']
+        self.start_response = Mock()
+        self.handler = RestHandler(GuestAuthCore(), {'rest_parser': 'full'})
+        self.shortcut = NoOpShortcut(self.app, self.handler)
+
+    def _call(self, attributes, path='/authorize'):
+        body = json.dumps(dict(
+            (k, {'type': 'string', 'value': [v]})
+            for k, v in attributes.items()
+        )).encode()
+        environ = {
+            'PATH_INFO': path,
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body)
+        }
+        return self.shortcut(environ, self.start_response), environ, body
+
+    def test_outer_message_skipped(self):
+        result, _, _ = self._call({
+            'User-Name': 'user',
+            'Calling-Station-Id': 'aabb',
+            'EAP-Message': '0x0200000c19736f6d656f6e65'
+        })
+
+        self.assertEqual(result, [b''])
+        self.start_response.assert_called_once_with('204 NO CONTENT', [])
+        self.app.assert_not_called()
+        self.assertEqual(self.handler.skipped, 1)
+        self.assertIn('\nradguestauth_authorize_skipped_total 1\n',
+                      self.handler._metrics.render())
+
+    def test_inner_message_skipped(self):
+        # identity message (type 1) inside the tunnel
+        self._call({
+            'User-Name': 'user',
+            'Calling-Station-Id': 'aabb',
+            'EAP-Message': '0x0206000c01736f6d656f6e65',
+            'FreeRADIUS-Proxied-To': '127.0.0.1'
+        })
+
+        self.app.assert_not_called()
+        self.assertEqual(self.handler.skipped, 1)
+
+    def test_processed_requests_passed_on(self):
+        test_requests = [
+            # no EAP message
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb'},
+            # PEAP inner message
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb',
+             'EAP-Message': '0x0201001619100a5cedafe5b632',
+             'FreeRADIUS-Proxied-To': '127.0.0.1'},
+            # EAP-PWD outer message, which has to be remembered
+            {'User-Name': 'user', 'Calling-Station-Id': 'aabb',
+             'EAP-Message': '0x0200000c34736f6d656f6e65'},
+        ]
+
+        for attributes in test_requests:
+            self.app.reset_mock()
+            result, environ, body = self._call(attributes)
+
+            self.assertEqual(result, [b'app response'])
+            self.app.assert_called_once()
+            # the wrapped app still gets the complete body
+            self.assertEqual(environ['wsgi.input'].read(), body)
+
+        self.assertEqual(self.handler.skipped, 0)
+
+    def test_other_paths_passed_on(self):
+        result, environ, body = self._call({
+            'User-Name': 'user',
+            'Calling-Station-Id': 'aabb',
+            'EAP-Message': '0x0200000c19736f6d656f6e65'
+        }, path='/post-auth')
+
+        self.assertEqual(result, [b'app response'])
+        self.assertEqual(environ['wsgi.input'].read(), body)
+        self.assertEqual(self.handler.skipped, 0)
@@ -3,7 +3,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 from unittest import TestCase
-from radguestauth.server import json_rest_unpack
+from radguestauth.rest import json_rest_unpack
 
 
 class ServerTest(TestCase):
@@ -0,0 +1,22 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from unittest import TestCase
+
+from radguestauth.userstorage import storage_name
+
+
+class StorageNameTest(TestCase):
+    def test_default(self):
+        self.assertEqual(storage_name({}), 'memory')
+
+    def test_user_storage(self):
+        self.assertEqual(storage_name({'user_storage': 'sqlite'}), 'sqlite')
+        self.assertEqual(storage_name({'user_storage': 'sqlite',
+                                       'state_backend': 'shared'}), 'sqlite')
+
+    def test_state_backend(self):
+        self.assertEqual(storage_name({'state_backend': 'journal'}),
+                         'journal')
+        self.assertEqual(storage_name({'state_backend': 'local'}), 'memory')
@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import io
+import csv
+import json
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+import radguestauth.users.bulk as bulk
+
+from radguestauth.users.usermanager import UserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+CSV_LIST = (
+    'name,device,state,valid_until,max_num_joins,password\n'
+    'alice,02:00:00:00:00:01,,2030-01-01T00:00:00+00:00,,\n'
+    'bob,020000000002,blocked,,3,secret\n'
+)
+
+
+class BulkTest(TestCase):
+    def setUp(self):
+        self.mgr = UserManager()
+
+    def test_import_csv(self):
+        on_added = Mock()
+        result = bulk.import_users(self.mgr, io.StringIO(CSV_LIST), 'csv',
+                                   on_added=on_added)
+
+        self.assertEqual(result.imported, 2)
+        self.assertEqual(result.rejected, 0)
+        alice = self.mgr.find('alice')
+        self.assertEqual(alice.device_id, '02-00-00-00-00-01')
+        self.assertEqual(alice.user_data.valid_until, 1893456000)
+        self.assertEqual(alice.password, self.mgr._current_password)
+        bob = self.mgr.find('bob')
+        self.assertEqual(bob.device_id, '02-00-00-00-00-02')
+        self.assertEqual(bob.user_data.join_state,
+                         UserData.JOIN_STATE_BLOCKED)
+        self.assertEqual(bob.user_data.max_num_joins, 3)
+        self.assertEqual(bob.password, 'secret')
+        on_added.assert_called_once_with(alice)
+
+    def test_import_jsonl(self):
+        lines = [
+            json.dumps({'name': 'a', 'device': '02-00-00-00-00-01',
+                        'valid_until': 1893456000}) + '\n',
+            '\n',
+            json.dumps({'name': 'b', 'device': '02-00-00-00-00-02'}) + '\n',
+        ]
+        result = bulk.import_users(self.mgr, lines, 'jsonl')
+
+        self.assertEqual(result.imported, 2)
+        self.assertEqual(self.mgr.find('a').user_data.valid_until,
+                         1893456000)
+        self.assertIsNone(self.mgr.find('b').user_data.valid_until)
+
+    def test_invalid_rows(self):
+        lines = [
+            '{"name": "a", "device": "02-00-00-00-00-01"}\n',
+            'no json\n',
+            '["a list"]\n',
+            '{"device": "02-00-00-00-00-02"}\n',
+            '{"name": "c", "device": "phone"}\n',
+            '{"name": "d", "device": "02-00-00-00-00-04", "state": "x"}\n',
+            '{"name": "e", "device": "02-00-00-00-00-05", '
+            '"max_num_joins": -1}\n',
+            '{"name": "f", "device": "02-00-00-00-00-06", '
+            '"valid_until": "tomorrow"}\n',
+        ]
+        result = bulk.import_users(self.mgr, lines, 'jsonl')
+
+        self.assertEqual(result.imported, 1)
+        self.assertEqual(result.rejected, 7)
+        self.assertEqual(result.errors[0], 'row 2: unreadable row')
+        self.assertTrue(result.errors[3].startswith('row 5: device'))
+        self.assertEqual(self.mgr.count_users(), 1)
+
+    def test_valid_until(self):
+        for value, expected in [
+                ('2030-01-01T00:00:00Z', 1893456000),
+                ('2030-01-01T01:30+01:30', 1893456000),
+                ('2029-12-31 23:00:00.5-01:00', 1893456000.5),
+                ('1893456000', 1893456000),
+                (1893456000.5, 1893456000.5)]:
+            self.assertEqual(bulk._parse_time(value), expected)
+
+        for value in ['nan', 'inf', '-inf', float('nan'), -1, 1e20, True,
+                      '2030-02-30', '2030-01-01T25:00', '01.01.2030',
+                      '2030-01-01T00:00:00+0100x']:
+            with self.assertRaises(ValueError):
+                bulk._parse_time(value)
+
+    def test_non_finite_rejected(self):
+        lines = [
+            '{"name": "a", "device": "02-00-00-00-00-01", '
+            '"valid_until": "nan"}\n',
+            '{"name": "b", "device": "02-00-00-00-00-02", '
+            '"valid_until": "inf"}\n',
+        ]
+        result = bulk.import_users(self.mgr, lines, 'jsonl')
+
+        self.assertEqual(result.imported, 0)
+        self.assertEqual(result.rejected, 2)
+        self.assertEqual(self.mgr.count_users(), 0)
+
+    def test_on_added_without_lock(self):
+        lock = Mock()
+        lock.__enter__ = Mock(side_effect=lambda: lock.held.append(True))
+        lock.__exit__ = Mock(side_effect=lambda *args: lock.held.pop())
+        lock.held = []
+        held = []
+        result = bulk.import_users(
+            self.mgr, io.StringIO(CSV_LIST), 'csv',
+            on_added=lambda user_id: held.append(bool(lock.held)), lock=lock
+        )
+
+        self.assertEqual(result.imported, 2)
+        lock.__enter__.assert_called_once_with()
+        self.assertListEqual(held, [False])
+
+    def test_errors_limited(self):
+        lines = ['x\n'] * (bulk.MAX_ERRORS + 5)
+        result = bulk.import_users(self.mgr, lines, 'jsonl')
+
+        self.assertEqual(result.rejected, bulk.MAX_ERRORS + 5)
+        self.assertEqual(len(result.errors), bulk.MAX_ERRORS)
+
+    def test_device_of_other_user(self):
+        self.mgr.add_request(UserIdentifier('host', '02-00-00-00-00-01'))
+        self.mgr.update(self.mgr.get_request())
+        self.mgr.finish_request()
+
+        result = bulk.import_users(self.mgr, io.StringIO(CSV_LIST), 'csv')
+
+        self.assertEqual(result.imported, 1)
+        self.assertEqual(result.rejected, 1)
+        self.assertIn('row 1:', result.errors[0])
+        self.assertIsNone(self.mgr.find('alice'))
+
+    def test_batches(self):
+        mgr = Mock(wraps=self.mgr)
+        lines = ['name,device\n'] + [
+            'user%d,02-00-00-00-00-%02X\n' % (i, i) for i in range(25)
+        ]
+        result = bulk.import_users(mgr, lines, 'csv', batch_size=10)
+
+        self.assertEqual(result.imported, 25)
+        self.assertListEqual([len(c[0][0]) for c in
+                              mgr.add_users.call_args_list], [10, 10, 5])
+        self.assertGreater(result.rows_per_second, 0)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            bulk.import_users(self.mgr, [], 'xml')
+        with self.assertRaises(ValueError):
+            list(bulk.export_users(self.mgr, 'xml'))
+
+    def test_export_round_trip(self):
+        bulk.import_users(self.mgr, io.StringIO(CSV_LIST), 'csv')
+
+        for fmt in bulk.FORMATS:
+            lines = list(bulk.export_users(self.mgr, fmt, page_size=1))
+            other = UserManager()
+            result = bulk.import_users(other, lines, fmt)
+
+            self.assertEqual(result.imported, 2)
+            for name in ['alice', 'bob']:
+                exported = other.find(name)
+                stored = self.mgr.find(name)
+                self.assertEqual(exported, stored)
+                self.assertEqual(exported.password, stored.password)
+                self.assertEqual(exported.user_data.valid_until,
+                                 stored.user_data.valid_until)
+                self.assertEqual(exported.user_data.join_state,
+                                 stored.user_data.join_state)
+
+    def test_export_csv(self):
+        bulk.import_users(self.mgr, io.StringIO(CSV_LIST), 'csv')
+
+        rows = list(csv.DictReader(bulk.export_users(self.mgr, 'csv')))
+
+        self.assertEqual([r['name'] for r in rows], ['alice', 'bob'])
+        self.assertEqual(rows[0]['valid_until'], '2030-01-01T00:00:00+00:00')
+        self.assertEqual(rows[1]['state'], 'blocked')
+
+    def test_other_notation(self):
+        events = []
+        self.mgr.add_listener(lambda event, u: events.append((event, u)))
+        bulk.import_users(self.mgr, io.StringIO(CSV_LIST), 'csv')
+
+        for device in ('02:00:00:00:00:01', '02-00-00-00-00-01',
+                       '020000000001'):
+            self.assertEqual(
+                self.mgr.may_join(UserIdentifier('alice', device)),
+                UserData.JOIN_STATE_ALLOWED)
+        alice = self.mgr.find_device('alice', '02:00:00:00:00:01')
+        self.assertEqual(alice.device_id, '02-00-00-00-00-01')
+
+        # listeners get the stored notation
+        del events[:]
+        self.mgr.remove(UserIdentifier('alice', '02:00:00:00:00:01'))
+        self.assertIsNone(self.mgr.find('alice'))
+        self.assertEqual(events[0][1].device_id, '02-00-00-00-00-01')
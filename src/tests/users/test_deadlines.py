@@ -0,0 +1,53 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from unittest import TestCase
+
+from radguestauth.users.deadlines import DeadlineHeap
+
+
+class DeadlineHeapTest(TestCase):
+    def setUp(self):
+        self.heap = DeadlineHeap()
+
+    def test_order(self):
+        self.assertTrue(self.heap.set('b', 20))
+        self.assertTrue(self.heap.set('a', 10))
+        self.assertFalse(self.heap.set('c', 30))
+
+        self.assertEqual(self.heap.first(), (10, 'a'))
+        self.assertEqual(self.heap.pop(), (10, 'a'))
+        self.assertEqual(self.heap.pop(), (20, 'b'))
+        self.assertEqual(self.heap.pop(), (30, 'c'))
+        self.assertIsNone(self.heap.pop())
+
+    def test_outdated_entries_skipped(self):
+        self.heap.set('a', 10)
+        self.heap.set('b', 20)
+        self.heap.set('a', 30)
+        self.heap.set('b', None)
+
+        self.assertEqual(len(self.heap), 1)
+        self.assertEqual(self.heap.get('a'), 30)
+        self.assertIsNone(self.heap.get('b'))
+        self.assertEqual(self.heap.first(), (30, 'a'))
+        self.assertListEqual(self.heap.before(100), [(30, 'a')])
+
+    def test_before(self):
+        for i in range(100):
+            self.heap.set(i, 100 - i)
+        self.heap.discard(95)
+
+        self.assertListEqual(self.heap.before(6),
+                             [(1, 99), (2, 98), (3, 97), (4, 96)])
+        # nothing is removed
+        self.assertEqual(len(self.heap), 99)
+
+    def test_compaction(self):
+        for i in range(1000):
+            self.heap.set('a', 1000 + i)
+
+        self.assertEqual(len(self.heap), 1)
+        self.assertLessEqual(len(self.heap._heap), 2 + DeadlineHeap.SLACK)
+        self.assertEqual(self.heap.first(), (1999, 'a'))
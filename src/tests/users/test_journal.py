@@ -0,0 +1,157 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from radguestauth.users.journal import JournalUserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class JournalUserManagerTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._mgrs = []
+
+    def tearDown(self):
+        for mgr in self._mgrs:
+            if mgr._thread.is_alive():
+                mgr.close()
+        self._dir.cleanup()
+
+    def _open(self, max_pending=1):
+        mgr = JournalUserManager(self._dir.name, max_pending)
+        self._mgrs.append(mgr)
+        return mgr
+
+    def _reopen(self, mgr, max_pending=1):
+        mgr.close()
+        return self._open(max_pending)
+
+    def _add_user(self, mgr, name='foo', device='00-11-22-33-44-55'):
+        user = UserIdentifier(name, device)
+        mgr.add_request(user)
+        req = mgr.find_request(name)
+        req.user_data = UserData()
+        req.user_data.valid_until = time.time() + 3600
+        req.user_data.max_num_joins = 5
+        mgr.update(req)
+        mgr.finish_request()
+        return user
+
+    def _files(self):
+        return sorted(os.listdir(self._dir.name))
+
+    def test_warm_restart(self):
+        mgr = self._open()
+        user = self._add_user(mgr)
+        self._add_user(mgr, 'bar', '00-11-22-33-44-66')
+        mgr.remove(UserIdentifier('bar', '00-11-22-33-44-66'))
+        password = mgr.generate_password()
+
+        mgr = self._reopen(mgr)
+        stored = mgr.find('foo')
+        self.assertEqual(stored, user)
+        self.assertEqual(stored.user_data.max_num_joins, 5)
+        self.assertIsNone(mgr.find('bar'))
+        self.assertEqual(mgr.may_join(user), UserData.JOIN_STATE_ALLOWED)
+        self.assertEqual(
+            mgr.may_join(UserIdentifier('other', '00:11:22:33:44:55')),
+            UserData.JOIN_STATE_BLOCKED
+        )
+        self.assertEqual(mgr._current_password, password)
+
+    def test_devices(self):
+        mgr = self._open()
+        mgr.set_device_limits(2)
+        self._add_user(mgr)
+        self._add_user(mgr, device='00-11-22-33-44-66')
+        mgr.remove(UserIdentifier('foo', '00-11-22-33-44-55'))
+
+        mgr = self._reopen(mgr)
+        self.assertListEqual(mgr.list_devices('foo'),
+                             [UserIdentifier('foo', '00-11-22-33-44-66')])
+
+    def test_pending_requests(self):
+        mgr = self._open(max_pending=3)
+        mgr.add_request(UserIdentifier('a', 'dev-a'))
+        mgr.add_request(UserIdentifier('b', 'dev-b'))
+        mgr.finish_request(1)
+
+        mgr = self._reopen(mgr, max_pending=3)
+        self.assertListEqual([(i, r.name) for i, r in mgr.list_requests()],
+                             [(2, 'b')])
+        self.assertIsNone(mgr.find_by_mac('dev-a'))
+        mgr.add_request(UserIdentifier('c', 'dev-c'))
+        self.assertEqual(mgr.list_requests()[-1][0], 3)
+
+    def test_join_count(self):
+        mgr = self._open()
+        user = self._add_user(mgr)
+        mgr.may_join(user)
+        mgr.may_join(user)
+
+        mgr = self._reopen(mgr)
+        self.assertEqual(mgr.find('foo').user_data.num_joins, 2)
+
+    @patch.object(JournalUserManager, 'COMMIT_INTERVAL', 0.01)
+    def test_group_commit(self):
+        mgr = self._open()
+        self._add_user(mgr)
+        for _ in range(500):
+            if os.path.getsize(mgr._journal_path(0)) > 0:
+                break
+            time.sleep(0.01)
+
+        # a crash keeps the committed records
+        other = self._open()
+        self.assertIsNotNone(other.find('foo'))
+
+    def test_close_writes_snapshot(self):
+        mgr = self._open()
+        self._add_user(mgr)
+        mgr.close()
+
+        self.assertListEqual(self._files(), ['journal.1', 'snapshot'])
+        self.assertEqual(os.path.getsize(mgr._journal_path(1)), 0)
+
+        mgr = self._open()
+        self.assertIsNotNone(mgr.find('foo'))
+        self.assertEqual(mgr._records, 0)
+
+    @patch.object(JournalUserManager, 'COMMIT_INTERVAL', 0.01)
+    @patch.object(JournalUserManager, 'SNAPSHOT_RECORDS', 10)
+    def test_snapshot_after_records(self):
+        mgr = self._open(max_pending=20)
+        for i in range(5):
+            self._add_user(mgr, 'user%d' % i, 'dev-%d' % i)
+        for _ in range(500):
+            if 'journal.0' not in self._files():
+                break
+            time.sleep(0.01)
+        self.assertGreater(mgr._generation, 0)
+        self.assertNotIn('journal.0', self._files())
+        self.assertIn('snapshot', self._files())
+
+        mgr = self._reopen(mgr, max_pending=20)
+        self.assertEqual(len(mgr.list_users()), 5)
+
+    def test_truncated_journal(self):
+        mgr = self._open()
+        self._add_user(mgr)
+        mgr = self._reopen(mgr)
+        mgr.generate_password()
+        mgr.close()
+        path = mgr._journal_path(mgr._generation)
+        # an incomplete record at the end
+        with open(path, 'ab') as f:
+            f.write(b'["r","fo')
+
+        mgr = self._open()
+        self.assertIsNotNone(mgr.find('foo'))
+        self.assertFalse(open(path, 'rb').read().endswith(b'fo'))
@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from radguestauth.users.shared import (LockedUserManager, ChatOwnership,
+                                       ChatRelay, NotificationRelay,
+                                       StateManager, start_state_server,
+                                       open_state)
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class LockedUserManagerTest(TestCase):
+    def test_usermanager_semantics(self):
+        mgr = LockedUserManager()
+        testuser = UserIdentifier('foo', 'bar')
+
+        self.assertEqual(mgr.may_join(testuser), UserData.JOIN_STATE_NEW)
+        self.assertTrue(mgr.add_request(testuser))
+        self.assertEqual(mgr.may_join(testuser), UserData.JOIN_STATE_WAITING)
+
+        testuser.user_data = UserData()
+        mgr.update(testuser)
+        mgr.finish_request()
+
+        self.assertEqual(mgr.may_join(testuser), UserData.JOIN_STATE_ALLOWED)
+        self.assertEqual(mgr.list_users(), [testuser])
+
+
+class StateServerTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.tmpdir.name, 'state.sock')
+        self.server = start_state_server(self.address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.tmpdir.cleanup()
+
+    def _connect(self):
+        client = StateManager(address=self.address)
+        client.connect()
+        return client
+
+    def test_state_visible_to_all_clients(self):
+        worker1 = self._connect().user_manager()
+        worker2 = self._connect().user_manager()
+        testuser = UserIdentifier('foo', '00-11-22-33-44-55')
+
+        worker1.add_request(testuser)
+
+        # the request and the MAC address are known in the other worker
+        self.assertTrue(worker2.is_request_pending())
+        self.assertEqual(worker2.get_request(), testuser)
+        self.assertEqual(
+            worker2.may_join(UserIdentifier('baz', '00:11:22:33:44:55')),
+            UserData.JOIN_STATE_BLOCKED
+        )
+
+        # modified copies are written back with update
+        req = worker2.get_request()
+        req.user_data = UserData()
+        worker2.update(req)
+        worker2.finish_request()
+
+        self.assertFalse(worker1.is_request_pending())
+        self.assertEqual(worker1.may_join(testuser),
+                         UserData.JOIN_STATE_ALLOWED)
+        # authorize asks the server once
+        state, stored, added = worker1.admit(testuser)
+        self.assertEqual(state, UserData.JOIN_STATE_ALLOWED)
+        self.assertEqual(stored, testuser)
+        self.assertFalse(added)
+
+    def test_open_state_connects(self):
+        # a second server must not be started if one is running
+        client = open_state(self.address)
+        client.user_manager().generate_password()
+        req_user = UserIdentifier('foo', 'bar')
+        client.user_manager().add_request(req_user)
+
+        other = self._connect().user_manager()
+        self.assertIsNotNone(other.get_request().password)
+
+    def test_open_state_without_server(self):
+        address = os.path.join(self.tmpdir.name, 'missing.sock')
+
+        # workers must not start a server of their own
+        with self.assertRaises(ConnectionError):
+            open_state(address, timeout=0.2)
+        self.assertFalse(os.path.exists(address))
+
+    def test_notifications_reach_owner(self):
+        outbox = self._connect().outbox()
+        controller = Mock()
+        relay = NotificationRelay(self._connect().outbox(), controller)
+        relay.POLL_TIMEOUT = 0.1
+        relay.start()
+
+        ChatRelay(outbox).notify_join(UserIdentifier('foo', 'bar'))
+        # wait up to 2 seconds for the relay thread
+        for _ in range(20):
+            if controller.notify_join.called:
+                break
+            time.sleep(0.1)
+        relay.stop()
+
+        controller.notify_join.assert_called_once_with(
+            UserIdentifier('foo', 'bar')
+        )
+
+
+class ChatOwnershipTest(TestCase):
+    def test_single_owner(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'chat.lock')
+            owner = ChatOwnership(path)
+            other = ChatOwnership(path)
+
+            self.assertTrue(owner.acquire())
+            self.assertFalse(other.acquire())
+            # acquiring again is fine for the owner
+            self.assertTrue(owner.acquire())
+
+            # after release, another instance can take over
+            owner.release()
+            self.assertTrue(other.acquire())
+            other.release()
@@ -0,0 +1,161 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import tempfile
+
+from unittest import TestCase
+
+from radguestauth.users.sqlite import SqliteUserManager
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+class SqliteUserManagerTest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'users.db')
+        self._mgrs = []
+
+    def tearDown(self):
+        for mgr in self._mgrs:
+            try:
+                mgr.close()
+            except Exception:
+                pass
+        self._dir.cleanup()
+
+    def _open(self, max_pending=1):
+        mgr = SqliteUserManager(self._path, max_pending)
+        self._mgrs.append(mgr)
+        return mgr
+
+    def _reopen(self, mgr, max_pending=1):
+        mgr.close()
+        return self._open(max_pending)
+
+    def _add_user(self, mgr, name='foo', device='00-11-22-33-44-55'):
+        user = UserIdentifier(name, device)
+        mgr.add_request(user)
+        req = mgr.get_request()
+        req.user_data = UserData()
+        req.user_data.valid_until = time.time() + 3600
+        req.user_data.max_num_joins = 5
+        req.user_data.join_state = UserData.JOIN_STATE_ALLOWED
+        mgr.update(req)
+        mgr.finish_request()
+        return user
+
+    def test_creates_directory(self):
+        self._path = os.path.join(self._dir.name, 'radguestauth', 'users.db')
+        mgr = self._open()
+        self._add_user(mgr)
+
+        mgr = self._reopen(mgr)
+        self.assertIsNotNone(mgr.find('foo'))
+
+    def test_warm_restart(self):
+        mgr = self._open()
+        user = self._add_user(mgr)
+        password = mgr.generate_password()
+
+        mgr = self._reopen(mgr)
+        stored = mgr.find('foo')
+        self.assertEqual(stored, user)
+        self.assertEqual(stored.user_data.max_num_joins, 5)
+        self.assertEqual(mgr.may_join(user), UserData.JOIN_STATE_ALLOWED)
+        # the MAC address stays reserved
+        self.assertEqual(
+            mgr.may_join(UserIdentifier('other', '00:11:22:33:44:55')),
+            UserData.JOIN_STATE_BLOCKED
+        )
+        self.assertEqual(mgr._current_password, password)
+
+    def test_devices(self):
+        mgr = self._open()
+        mgr.set_device_limits(2)
+        self._add_user(mgr)
+        self._add_user(mgr, device='00-11-22-33-44-66')
+        mgr.remove(UserIdentifier('foo', '00-11-22-33-44-55'))
+
+        mgr = self._reopen(mgr)
+        self.assertListEqual(mgr.list_devices('foo'),
+                             [UserIdentifier('foo', '00-11-22-33-44-66')])
+
+    def test_add_users(self):
+        mgr = self._open()
+        users = [UserIdentifier('user%d' % i, '02-00-00-00-00-%02X' % i)
+                 for i in range(10)]
+        for user in users:
+            user.user_data = UserData()
+            user.user_data.join_state = UserData.JOIN_STATE_ALLOWED
+        self._add_user(mgr, 'other', '02-00-00-00-00-09')
+
+        self.assertListEqual(mgr.add_users(users), users[9:])
+
+        mgr = self._reopen(mgr)
+        self.assertEqual(mgr.count_users(), 10)
+        self.assertEqual(mgr.may_join(users[3]), UserData.JOIN_STATE_ALLOWED)
+
+    def test_remove_persisted(self):
+        mgr = self._open()
+        user = self._add_user(mgr)
+        mgr.remove(user)
+
+        mgr = self._reopen(mgr)
+        self.assertListEqual(mgr.list_users(), [])
+        self.assertEqual(mgr.may_join(user), UserData.JOIN_STATE_NEW)
+
+    def test_user_without_data(self):
+        mgr = self._open()
+        user = UserIdentifier('foo', 'bar')
+        mgr.add_request(user)
+        mgr.update(user)
+        mgr.finish_request()
+
+        mgr = self._reopen(mgr)
+        self.assertEqual(mgr.find('foo'), user)
+        self.assertIsNone(mgr.find('foo').user_data)
+
+    def test_pending_requests(self):
+        mgr = self._open(max_pending=3)
+        mgr.add_request(UserIdentifier('a', 'dev-a'))
+        mgr.add_request(UserIdentifier('b', 'dev-b'))
+        mgr.finish_request(1)
+
+        mgr = self._reopen(mgr, max_pending=3)
+        self.assertListEqual([(i, r.name) for i, r in mgr.list_requests()],
+                             [(2, 'b')])
+        self.assertEqual(mgr.may_join(UserIdentifier('b', 'dev-b')),
+                         UserData.JOIN_STATE_WAITING)
+        # IDs are not reused after a restart
+        mgr.add_request(UserIdentifier('c', 'dev-c'))
+        self.assertEqual(mgr.find_request('c'),
+                         UserIdentifier('c', 'dev-c'))
+        self.assertEqual(mgr.list_requests()[-1][0], 3)
+
+    def test_join_count_flushed(self):
+        mgr = self._open()
+        user = self._add_user(mgr)
+        mgr.may_join(user)
+        mgr.may_join(user)
+        self.assertIn(('foo', user.device_id), mgr._dirty)
+
+        mgr = self._reopen(mgr)
+        self.assertEqual(mgr.find('foo').user_data.num_joins, 2)
+
+    def test_join_count_timer(self):
+        mgr = self._open()
+        mgr.FLUSH_DELAY = 0.01
+        user = self._add_user(mgr)
+        mgr.may_join(user)
+        for _ in range(500):
+            if not mgr._dirty:
+                break
+            time.sleep(0.01)
+        self.assertFalse(mgr._dirty)
+
+        other = SqliteUserManager(self._path)
+        self._mgrs.append(other)
+        self.assertEqual(other.find('foo').user_data.num_joins, 1)
@@ -3,6 +3,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import time
+import pickle
 from unittest import TestCase
 from unittest.mock import Mock
 
@@ -74,6 +75,28 @@ class UserStorageTest(TestCase):
             data.join_state = state
             self.assertIn(representation, data.state_string().lower())
 
+    def test_pickle(self):
+        """
+        The shared state backend transfers users between processes.
+        """
+        identifier = UserIdentifier('foo', 'bar', 'pass')
+        identifier.user_data = UserData()
+        identifier.user_data.valid_until = 42
+        identifier.user_data.num_joins = 3
+
+        result = pickle.loads(pickle.dumps(identifier))
+
+        self.assertEqual(result, identifier)
+        self.assertEqual(result.password, 'pass')
+        self.assertEqual(result.user_data.valid_until, 42)
+        self.assertEqual(result.user_data.num_joins, 3)
+        self.assertEqual(result.user_data.join_state,
+                         UserData.JOIN_STATE_ALLOWED)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(UserIdentifier('foo', 'bar'), '__dict__'))
+        self.assertFalse(hasattr(UserData(), '__dict__'))
+
     def test_mac_formatting(self):
         test_mac = 'aa:bb:cc:dd:e0:12'
         items_to_check = [
@@ -87,6 +110,33 @@ class UserStorageTest(TestCase):
             self.assertEqual(formatted_obj, test_mac)
             self.assertEqual(formatted_static, test_mac)
 
+    def test_parse_mac(self):
+        for addr in ['aa:bb:cc:dd:e0:12', 'AA-BB-CC-DD-E0-12',
+                     'aa-bb-cc:Dd-e0-12', 'aabbccdde012']:
+            self.assertEqual(UserIdentifier.parse_mac(addr), 0xaabbccdde012)
+
+        for device in ['phone', 'aa:bb:cc:dd:e0', 'aa:bb:cc:dd:e0:12:34',
+                       'aa:bb:cc:dd:e0:1g', '0xbbccdde012', 'aa_bbccdde012',
+                       '+abbccdde012', ' abbccdde012', 'aabbccdde012\n',
+                       # Arabic-Indic digits, which int() would accept
+                       '\u0661' * 12, '']:
+            self.assertIsNone(UserIdentifier.parse_mac(device))
+
+    def test_device_key(self):
+        user = UserIdentifier('a', 'AA-BB-CC-DD-E0-12')
+        self.assertEqual(user.device_key, 0xaabbccdde012)
+        self.assertEqual(UserIdentifier('a', 'Some-Phone').device_key,
+                         'some:phone')
+
+        # kept up to date when the device changes
+        user.device_id = '00-00-00-00-00-01'
+        self.assertEqual(user.device_key, 1)
+
+    def test_mac_to_str(self):
+        self.assertEqual(UserIdentifier.mac_to_str(0xaabbccdde012),
+                         'aa:bb:cc:dd:e0:12')
+        self.assertEqual(UserIdentifier.mac_to_str(1), '00:00:00:00:00:01')
+
     def _increment_num_join_helper(self, max_num_joins, num_joins, valid_until,
                                    expected_num_joins):
         data = UserData()
@@ -5,7 +5,7 @@
 import time
 
 from unittest import TestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, call
 
 from radguestauth.users.usermanager import UserManager
 from radguestauth.users.storage import UserIdentifier, UserData
@@ -107,6 +107,7 @@ class UserManagerTest(TestCase):
         data = Mock(UserData)
         data.check_expired.return_value = True
         data.join_state = UserData.JOIN_STATE_ALLOWED
+        data.max_num_joins = 0
         mgr, testuser = self._get_mgr_with_one_user_and_data(data)
 
         result = mgr.may_join(testuser)
@@ -120,6 +121,7 @@ class UserManagerTest(TestCase):
         data = Mock(UserData)
         data.check_expired.return_value = False
         data.join_state = UserData.JOIN_STATE_ALLOWED
+        data.max_num_joins = 0
         mgr, testuser = self._get_mgr_with_one_user_and_data(data)
 
         result = mgr.may_join(testuser)
@@ -300,6 +302,54 @@ class UserManagerTest(TestCase):
         requested = mgr.get_request()
         self.assertEqual(pw, requested.password)
 
+    def test_request_queue(self):
+        mgr = UserManager(max_pending=3)
+        users = [UserIdentifier('user%d' % i, 'device%d' % i)
+                 for i in range(4)]
+
+        self.assertTrue(mgr.add_request(users[0]))
+        # names can be requested only once
+        self.assertFalse(mgr.add_request(UserIdentifier('user0', 'other')))
+        self.assertTrue(mgr.add_request(users[1]))
+        self.assertTrue(mgr.add_request(users[2]))
+        self.assertFalse(mgr.can_add_request())
+        self.assertFalse(mgr.add_request(users[3]))
+
+        self.assertListEqual(mgr.list_requests(), [
+            (1, users[0]), (2, users[1]), (3, users[2])
+        ])
+        for user in users[:3]:
+            self.assert_state_waiting(mgr.may_join(user))
+            self.assertEqual(mgr.find_request(user.name), user)
+        self.assert_state_new(mgr.may_join(users[3]))
+        self.assertIsNone(mgr.find_request('user3'))
+
+        # without ID, the oldest request is used
+        self.assertEqual(mgr.get_request(), users[0])
+        self.assertEqual(mgr.get_request(2), users[1])
+        self.assertIsNone(mgr.get_request(7))
+
+        mgr.finish_request(2)
+        mgr.finish_request()
+        self.assertListEqual(mgr.list_requests(), [(3, users[2])])
+        self.assertTrue(mgr.add_request(users[3]))
+        # IDs are not reused
+        self.assertEqual(mgr.list_requests()[-1], (4, users[3]))
+
+    def test_update_queued_request(self):
+        mgr = UserManager(max_pending=2)
+        user1 = UserIdentifier('user1', 'device1')
+        user2 = UserIdentifier('user2', 'device2')
+        mgr.add_request(user1)
+        mgr.add_request(user2)
+
+        user2.user_data = UserData()
+        mgr.update(user2)
+        mgr.finish_request(2)
+
+        self.assertListEqual(mgr.list_users(), [user2])
+        self.assertEqual(mgr.get_request(), user1)
+
     def test_update_request(self):
         mgr = UserManager()
         testuser = UserIdentifier('foo', 'bar')
@@ -351,6 +401,49 @@ class UserManagerTest(TestCase):
         self.assertIsNone(result1)
         self.assertEqual(result2, testuser)
 
+    def test_list_users_ordered(self):
+        mgr = UserManager()
+        for name in ['carol', 'alice', 'bob', 'bobby', 'dave']:
+            mgr.add_request(UserIdentifier(name, name + '-phone'))
+            mgr.update(mgr.get_request())
+            mgr.finish_request()
+        mgr.remove(UserIdentifier('dave', 'dave-phone'))
+
+        def names(users):
+            return [u.name for u in users]
+
+        self.assertListEqual(names(mgr.list_users()),
+                             ['alice', 'bob', 'bobby', 'carol'])
+        self.assertListEqual(names(mgr.list_users('bob')), ['bob', 'bobby'])
+        self.assertListEqual(names(mgr.list_users(offset=1, limit=2)),
+                             ['bob', 'bobby'])
+        self.assertListEqual(names(mgr.list_users('bob', 1, 5)), ['bobby'])
+        self.assertListEqual(names(mgr.list_users('x')), [])
+        self.assertEqual(mgr.count_users(), 4)
+        self.assertEqual(mgr.count_users('bo'), 2)
+        self.assertEqual(mgr.count_users('bobx'), 0)
+
+    def test_find_by_mac(self):
+        mgr = UserManager(2)
+        user = UserIdentifier('foo', 'AA-BB-CC-DD-E0-12')
+        mgr.add_request(user)
+        mgr.add_request(UserIdentifier('bar', 'phone'))
+
+        # pending requests are found, in any notation
+        self.assertEqual(mgr.find_by_mac('aa:bb:cc:dd:e0:12'), user)
+        self.assertEqual(mgr.find_by_mac(0xaabbccdde012), user)
+        self.assertEqual(mgr.find_by_mac('PHONE').name, 'bar')
+
+        req = mgr.find_request('foo')
+        req.user_data = UserData()
+        mgr.update(req)
+        mgr.finish_request()
+        self.assertIs(mgr.find_by_mac(0xaabbccdde012), req)
+
+        mgr.remove(user)
+        self.assertIsNone(mgr.find_by_mac(0xaabbccdde012))
+        self.assertIsNone(mgr.find_by_mac('00-00-00-00-00-01'))
+
     def test_get_expired_users(self):
         mgr, testuser1, testuser2 = self._get_mgr_with_two_users()
         testuser2.user_data = UserData()
@@ -374,9 +467,313 @@ class UserManagerTest(TestCase):
         self.assertIn(testuser1, expired_users_updated)
         self.assertIn(testuser2, expired_users_updated)
 
+    def _add_with_data(self, mgr, name, valid_until=None, max_num_joins=0):
+        user = UserIdentifier(name, name + '-phone')
+        mgr.add_request(user)
+        user.user_data = UserData()
+        user.user_data.valid_until = valid_until
+        user.user_data.max_num_joins = max_num_joins
+        mgr.update(user)
+        mgr.finish_request()
+        return user
+
+    def test_get_expired_users_join_limit(self):
+        mgr = UserManager()
+        used = self._add_with_data(mgr, 'used', max_num_joins=1)
+        unused = self._add_with_data(mgr, 'unused', max_num_joins=2)
+        both = self._add_with_data(mgr, 'both', 123, max_num_joins=1)
+        # joins are indexed by may_join, other changes by update
+        mgr.may_join(used)
+        mgr.may_join(unused)
+        both.user_data.num_joins = 1
+        mgr.update(both)
+
+        self.assertListEqual(mgr.get_expired_users(), [both, used])
+
+        # the host allowed more joins
+        used.user_data.max_num_joins = 3
+        mgr.update(used)
+        self.assertListEqual(mgr.get_expired_users(), [both])
+
+    def test_get_expired_users_changed_deadline(self):
+        mgr = UserManager()
+        now = time.time()
+        users = [self._add_with_data(mgr, 'user%d' % i, now + 300 - i)
+                 for i in range(200)]
+        # move some deadlines to the past and others to the future, which
+        # leaves outdated heap entries
+        for user in users[:50]:
+            user.user_data.valid_until = now - 10
+            mgr.update(user)
+        for user in users[150:]:
+            user.user_data.valid_until = now + 5000
+            mgr.update(user)
+        mgr.remove(users[0])
+        users[1].user_data.valid_until = None
+        mgr.update(users[1])
+
+        expired = mgr.get_expired_users()
+
+        self.assertCountEqual(expired, users[2:50])
+        self.assertEqual(len(mgr.get_expiring_within(1000)), 100)
+
+    def test_get_expiring_within(self):
+        mgr = UserManager()
+        now = time.time()
+        self._add_with_data(mgr, 'expired', now - 1)
+        later = self._add_with_data(mgr, 'later', now + 1800)
+        soon = self._add_with_data(mgr, 'soon', now + 60)
+        self._add_with_data(mgr, 'tomorrow', now + 86400)
+        self._add_with_data(mgr, 'count', max_num_joins=3)
+
+        self.assertListEqual(mgr.get_expiring_within(3600), [soon, later])
+        self.assertListEqual(mgr.get_expiring_within(10), [])
+
+    def test_admit(self):
+        mgr = UserManager()
+        testuser = UserIdentifier('foo', '00-11-22-33-44-55')
+
+        state, req, added = mgr.admit(testuser)
+        self.assertEqual(state, UserData.JOIN_STATE_WAITING)
+        self.assertIs(req, mgr.find_request('foo'))
+        self.assertTrue(added)
+        self.assertEqual(mgr.admit(testuser),
+                         (UserData.JOIN_STATE_WAITING, req, False))
+        # the queue is full
+        self.assertEqual(mgr.admit(UserIdentifier('bar', 'baz')),
+                         (UserData.JOIN_STATE_NEW, None, False))
+
+        req.user_data = UserData()
+        mgr.update(req)
+        mgr.finish_request()
+        state, stored, added = mgr.admit(
+            UserIdentifier('foo', '00:11:22:33:44:55'))
+        self.assertEqual(state, UserData.JOIN_STATE_ALLOWED)
+        self.assertIs(stored, req)
+        self.assertFalse(added)
+
+        other = UserIdentifier('bar', '00-11-22-33-44-55')
+        self.assertEqual(mgr.admit(other),
+                         (UserData.JOIN_STATE_BLOCKED, other, False))
+
+    def test_add_users(self):
+        mgr = UserManager()
+        listener = Mock()
+        mgr.add_listener(listener)
+        pending = UserIdentifier('pending', '02-00-00-00-00-03')
+        mgr.add_request(pending)
+
+        users = [UserIdentifier('a', '02-00-00-00-00-01'),
+                 UserIdentifier('b', '02-00-00-00-00-02', 'pw'),
+                 # same MAC as a, in another notation
+                 UserIdentifier('c', '02:00:00:00:00:01'),
+                 UserIdentifier('d', '02-00-00-00-00-03')]
+        for user in users:
+            user.user_data = UserData()
+        skipped = mgr.add_users(users)
+
+        self.assertListEqual(skipped, users[2:])
+        self.assertListEqual(mgr.list_users(), users[:2])
+        self.assertEqual(users[0].password, mgr._current_password)
+        self.assertEqual(users[1].password, 'pw')
+        self.assertEqual(mgr.may_join(users[0]), UserData.JOIN_STATE_ALLOWED)
+        listener.assert_has_calls([call(UserManager.EVENT_UPDATE, users[0]),
+                                   call(UserManager.EVENT_UPDATE, users[1])])
+
+        # known devices are replaced
+        replaced = UserIdentifier('a', '02-00-00-00-00-01', 'new')
+        replaced.user_data = UserData()
+        replaced.user_data.max_num_joins = 3
+        self.assertListEqual(mgr.add_users([replaced]), [])
+        self.assertIs(mgr.find('a'), replaced)
+
     def test_generate_password(self):
         mgr = UserManager()
         pw = mgr.generate_password()
 
         self.assertIsInstance(pw, str)
         self.assertNotEqual(pw, '')
+
+    def test_listener_events(self):
+        mgr = UserManager()
+        listener = Mock()
+        mgr.add_listener(listener)
+        testuser = UserIdentifier('foo', 'bar')
+
+        mgr.add_request(testuser)
+        testuser.user_data = UserData()
+        mgr.update(testuser)
+        mgr.finish_request()
+        mgr.remove(testuser)
+        mgr.generate_password()
+        # calls without changes don't notify
+        mgr.finish_request()
+        mgr.remove(testuser)
+        mgr.update(UserIdentifier('unknown', 'user'))
+
+        listener.assert_has_calls([
+            call(UserManager.EVENT_ADD_REQUEST, testuser),
+            call(UserManager.EVENT_UPDATE, testuser),
+            call(UserManager.EVENT_FINISH_REQUEST, testuser),
+            call(UserManager.EVENT_REMOVE, testuser),
+            call(UserManager.EVENT_PASSWORD, None),
+        ])
+        self.assertEqual(listener.call_count, 5)
+
+
+class MultipleDevicesTest(TestCase):
+    def setUp(self):
+        self.mgr = UserManager(2)
+        self.mgr.set_device_limits(2)
+        self.phone = self._allow(UserIdentifier('foo', 'phone'))
+
+    def _allow(self, device, max_num_joins=0):
+        self.assertTrue(self.mgr.add_request(device))
+        req = self.mgr.find_request(device.name)
+        req.user_data = UserData()
+        req.user_data.max_num_joins = max_num_joins
+        self.mgr.update(req)
+        self.mgr.finish_request()
+        return req
+
+    def test_one_device_by_default(self):
+        mgr = UserManager()
+        mgr.add_request(UserIdentifier('foo', 'phone'))
+        mgr.update(mgr.get_request())
+        mgr.finish_request()
+
+        laptop = UserIdentifier('foo', 'laptop')
+        self.assertEqual(mgr.may_join(laptop), UserData.JOIN_STATE_BLOCKED)
+        self.assertFalse(mgr.add_request(laptop))
+
+    def test_host_approves_device(self):
+        laptop = UserIdentifier('foo', 'laptop')
+        self.assertEqual(self.mgr.may_join(laptop), UserData.JOIN_STATE_NEW)
+        self.assertTrue(self.mgr.add_request(laptop))
+        self.assertEqual(self.mgr.may_join(laptop),
+                         UserData.JOIN_STATE_WAITING)
+        # the first device is not affected by the request
+        self.assertEqual(self.mgr.may_join(self.phone),
+                         UserData.JOIN_STATE_ALLOWED)
+
+        req = self.mgr.find_request('foo')
+        req.user_data = UserData()
+        self.mgr.update(req)
+        self.mgr.finish_request()
+
+        self.assertEqual(self.mgr.may_join(laptop),
+                         UserData.JOIN_STATE_ALLOWED)
+        self.assertIs(self.mgr.find('foo'), self.phone)
+        self.assertIs(self.mgr.find_device('foo', 'laptop'), req)
+        self.assertListEqual(self.mgr.list_devices('foo'), [self.phone, req])
+        self.assertListEqual(self.mgr.list_users(), [self.phone])
+
+    def test_device_limit(self):
+        self._allow(UserIdentifier('foo', 'laptop'))
+
+        tablet = UserIdentifier('foo', 'tablet')
+        self.assertEqual(self.mgr.may_join(tablet),
+                         UserData.JOIN_STATE_BLOCKED)
+        self.assertFalse(self.mgr.add_request(tablet))
+
+    def test_blocked_user(self):
+        self.phone.user_data.join_state = UserData.JOIN_STATE_BLOCKED
+        self.mgr.update(self.phone)
+
+        self.assertEqual(self.mgr.may_join(UserIdentifier('foo', 'laptop')),
+                         UserData.JOIN_STATE_BLOCKED)
+
+    def test_device_of_other_user(self):
+        self._allow(UserIdentifier('bar', 'laptop'))
+
+        self.assertEqual(self.mgr.may_join(UserIdentifier('foo', 'laptop')),
+                         UserData.JOIN_STATE_BLOCKED)
+
+    def test_denied_request_releases_device(self):
+        laptop = UserIdentifier('bar', 'laptop')
+        self.assertTrue(self.mgr.add_request(laptop))
+        self.mgr.finish_request()
+
+        self.assertIsNone(self.mgr.find_by_mac('laptop'))
+        self.assertEqual(self.mgr.may_join(laptop), UserData.JOIN_STATE_NEW)
+        self.assertEqual(self.mgr.may_join(UserIdentifier('foo', 'laptop')),
+                         UserData.JOIN_STATE_NEW)
+
+    def test_approved_request_keeps_device(self):
+        laptop = self._allow(UserIdentifier('foo', 'laptop'))
+
+        self.assertIs(self.mgr.find_by_mac('laptop'), laptop)
+
+    def test_separate_join_counts(self):
+        self.phone.user_data.max_num_joins = 2
+        self.mgr.update(self.phone)
+        laptop = self._allow(UserIdentifier('foo', 'laptop'), 2)
+
+        self.mgr.may_join(self.phone)
+        self.mgr.may_join(self.phone)
+        self.assertEqual(self.phone.user_data.num_joins, 2)
+        self.assertEqual(laptop.user_data.num_joins, 0)
+
+        # the phone expires and is removed, the laptop stays
+        self.assertEqual(self.mgr.may_join(self.phone),
+                         UserData.JOIN_STATE_NEW)
+        self.assertIsNone(self.mgr.find_device('foo', 'phone'))
+        self.assertIs(self.mgr.find('foo'), laptop)
+        self.assertEqual(self.mgr.may_join(laptop),
+                         UserData.JOIN_STATE_ALLOWED)
+
+        self.mgr.remove(laptop)
+        self.assertIsNone(self.mgr.find('foo'))
+        self.assertListEqual(self.mgr.list_devices('foo'), [])
+
+    def test_count_blocked(self):
+        laptop = self._allow(UserIdentifier('foo', 'laptop'))
+        self._allow(UserIdentifier('bar', 'tablet'))
+        self.assertEqual(self.mgr.count_blocked(), 0)
+
+        for device in [self.phone, laptop]:
+            device.user_data.join_state = UserData.JOIN_STATE_BLOCKED
+            self.mgr.update(device)
+        self.assertEqual(self.mgr.count_blocked(), 1)
+
+        self.mgr.remove(self.phone)
+        self.assertEqual(self.mgr.count_blocked(), 1)
+        laptop.user_data.join_state = UserData.JOIN_STATE_ALLOWED
+        self.mgr.update(laptop)
+        self.assertEqual(self.mgr.count_blocked(), 0)
+
+    def test_expired_devices(self):
+        laptop = self._allow(UserIdentifier('foo', 'laptop'))
+        laptop.user_data.valid_until = 123
+        self.mgr.update(laptop)
+
+        self.assertListEqual(self.mgr.get_expired_users(), [laptop])
+
+    def test_approve_per_user(self):
+        self.mgr.set_device_limits(2, approve_per_user=True)
+        self.phone.user_data.valid_until = time.time() + 100
+        self.phone.user_data.max_num_joins = 5
+        self.mgr.update(self.phone)
+        listener = Mock()
+        self.mgr.add_listener(listener)
+
+        laptop = UserIdentifier('foo', 'laptop')
+        self.assertEqual(self.mgr.may_join(laptop),
+                         UserData.JOIN_STATE_ALLOWED)
+
+        stored = self.mgr.find_device('foo', 'laptop')
+        self.assertEqual(stored.user_data.valid_until,
+                         self.phone.user_data.valid_until)
+        self.assertEqual(stored.user_data.max_num_joins, 5)
+        # this join is counted for the laptop only
+        self.assertEqual(stored.user_data.num_joins, 1)
+        self.assertEqual(self.phone.user_data.num_joins, 0)
+        listener.assert_called_once_with(UserManager.EVENT_UPDATE, stored)
+
+    def test_approve_per_user_expired(self):
+        self.mgr.set_device_limits(2, approve_per_user=True)
+        self.phone.user_data.valid_until = 123
+        self.mgr.update(self.phone)
+
+        self.assertEqual(self.mgr.may_join(UserIdentifier('foo', 'laptop')),
+                         UserData.JOIN_STATE_NEW)
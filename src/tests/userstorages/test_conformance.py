@@ -0,0 +1,223 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import tempfile
+
+from unittest import TestCase
+
+from radguestauth.loader import ImplLoader
+from radguestauth.userstorage import UserStorage
+from radguestauth.userstorages.memory import MemoryUserStorage
+from radguestauth.userstorages.sqlite import SqliteUserStorage
+from radguestauth.userstorages.journal import JournalUserStorage
+from radguestauth.userstorages.shared import SharedUserStorage
+from radguestauth.users.shared import start_state_server
+from radguestauth.users.storage import UserIdentifier, UserData
+
+
+# UserManager semantics every UserStorage has to provide. Not based on
+# TestCase so they are only executed in the subclasses below, which define
+# NAME (as given in the user_storage config key) and _config.
+class UserStorageConformance(object):
+    # whether the users survive close and open
+    PERSISTENT = False
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storages = []
+        self.mgr = self._open()
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        self.tmpdir.cleanup()
+
+    def _config(self):
+        return dict()
+
+    def _open(self, max_pending=2):
+        impl = ImplLoader(UserStorage, None).load(self.NAME)
+        self.assertIsNotNone(impl)
+        storage = impl()
+        self.storages.append(storage)
+        return storage.open(self._config(), max_pending)
+
+    def _request(self, name, device):
+        user = UserIdentifier(name, device)
+        self.assertEqual(self.mgr.may_join(user), UserData.JOIN_STATE_NEW)
+        self.assertTrue(self.mgr.add_request(user))
+        return user
+
+    def _answer(self, user, join_state=UserData.JOIN_STATE_ALLOWED,
+                valid_until=None, max_num_joins=0):
+        req = self.mgr.find_request(user.name)
+        req.user_data = UserData()
+        req.user_data.join_state = join_state
+        req.user_data.valid_until = valid_until
+        req.user_data.max_num_joins = max_num_joins
+        self.mgr.update(req)
+        self.mgr.finish_request(self.mgr.list_requests()[0][0])
+        return req
+
+    def test_join_states(self):
+        user = self._request('foo', '00-11-22-33-44-55')
+        self.assertEqual(self.mgr.may_join(user),
+                         UserData.JOIN_STATE_WAITING)
+
+        self._answer(user)
+
+        self.assertFalse(self.mgr.is_request_pending())
+        self.assertEqual(self.mgr.may_join(user),
+                         UserData.JOIN_STATE_ALLOWED)
+        self.assertEqual(self.mgr.find('foo'), user)
+        self.assertEqual([u.name for u in self.mgr.list_users()], ['foo'])
+
+    def test_denied(self):
+        user = self._request('foo', '00-11-22-33-44-55')
+        self._answer(user, UserData.JOIN_STATE_BLOCKED)
+
+        self.assertEqual(self.mgr.may_join(user),
+                         UserData.JOIN_STATE_BLOCKED)
+
+    def test_request_queue(self):
+        first = self._request('foo', '00-11-22-33-44-55')
+        second = self._request('bar', '00-11-22-33-44-66')
+
+        self.assertFalse(self.mgr.can_add_request())
+        self.assertEqual([r for _, r in self.mgr.list_requests()],
+                         [first, second])
+
+    def test_mac_unique(self):
+        user = self._request('foo', '00-11-22-33-44-55')
+        other = UserIdentifier('bar', '00:11:22:33:44:55')
+
+        # for pending requests and stored users
+        self.assertEqual(self.mgr.may_join(other),
+                         UserData.JOIN_STATE_BLOCKED)
+        self.assertFalse(self.mgr.add_request(other))
+        self._answer(user)
+        self.assertEqual(self.mgr.may_join(other),
+                         UserData.JOIN_STATE_BLOCKED)
+        self.assertEqual(self.mgr.find_by_mac('00:11:22:33:44:55'), user)
+
+        self.mgr.remove(user)
+        self.assertIsNone(self.mgr.find('foo'))
+        self.assertEqual(self.mgr.may_join(other), UserData.JOIN_STATE_NEW)
+
+    def test_expiry_time(self):
+        user = self._request('foo', '00-11-22-33-44-55')
+        self._answer(user, valid_until=time.time() - 1)
+        soon = self._request('bar', '00-11-22-33-44-66')
+        self._answer(soon, valid_until=time.time() + 60)
+
+        self.assertEqual(self.mgr.get_expired_users(), [user])
+        self.assertEqual(self.mgr.get_expiring_within(3600), [soon])
+        # the host is asked again
+        self.assertEqual(self.mgr.may_join(user), UserData.JOIN_STATE_NEW)
+        self.assertIsNone(self.mgr.find('foo'))
+
+    def test_expiry_join_count(self):
+        user = self._request('foo', '00-11-22-33-44-55')
+        self._answer(user, max_num_joins=2)
+
+        self.assertEqual(self.mgr.may_join(user),
+                         UserData.JOIN_STATE_ALLOWED)
+        self.assertEqual(self.mgr.may_join(user),
+                         UserData.JOIN_STATE_ALLOWED)
+        self.assertEqual(self.mgr.get_expired_users(), [user])
+        self.assertEqual(self.mgr.may_join(user), UserData.JOIN_STATE_NEW)
+
+    def test_devices(self):
+        self.mgr.set_device_limits(2)
+        phone = self._request('foo', '00-11-22-33-44-55')
+        self._answer(phone)
+        laptop = self._request('foo', '00-11-22-33-44-66')
+        self._answer(laptop)
+
+        self.assertEqual(self.mgr.list_devices('foo'), [phone, laptop])
+        self.assertEqual(self.mgr.may_join(UserIdentifier('foo', '3')),
+                         UserData.JOIN_STATE_BLOCKED)
+
+    def test_reopen(self):
+        if not self.PERSISTENT:
+            return
+
+        user = self._request('foo', '00-11-22-33-44-55')
+        self._answer(user, max_num_joins=3)
+        self.assertEqual(self.mgr.may_join(user),
+                         UserData.JOIN_STATE_ALLOWED)
+        pending = self._request('bar', '00-11-22-33-44-66')
+        password = self.mgr.generate_password()
+
+        for storage in self.storages:
+            storage.close()
+        self.storages = []
+        self.mgr = self._open()
+
+        stored = self.mgr.find('foo')
+        self.assertEqual(stored, user)
+        self.assertEqual(stored.user_data.num_joins, 1)
+        self.assertEqual(self.mgr.find_request('bar'), pending)
+        # new requests get the generated password
+        self._request('baz', '00-11-22-33-44-77')
+        self.assertEqual(self.mgr.find_request('baz').password, password)
+
+
+class MemoryUserStorageTest(UserStorageConformance, TestCase):
+    NAME = 'memory'
+
+    def test_default(self):
+        impl = ImplLoader(UserStorage, MemoryUserStorage).load('invalid')
+        self.assertIs(impl, MemoryUserStorage)
+
+
+class SqliteUserStorageTest(UserStorageConformance, TestCase):
+    NAME = 'sqlite'
+    PERSISTENT = True
+
+    def _config(self):
+        return {'state_db': os.path.join(self.tmpdir.name, 'users.db')}
+
+    def test_loaded(self):
+        self.assertIsInstance(self.storages[0], SqliteUserStorage)
+
+
+class JournalUserStorageTest(UserStorageConformance, TestCase):
+    NAME = 'journal'
+    PERSISTENT = True
+
+    def _config(self):
+        return {'state_dir': os.path.join(self.tmpdir.name, 'state')}
+
+    def test_loaded(self):
+        self.assertIsInstance(self.storages[0], JournalUserStorage)
+
+
+class SharedUserStorageTest(UserStorageConformance, TestCase):
+    NAME = 'shared'
+
+    def setUp(self):
+        self.server_dir = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.server_dir.name, 'state.sock')
+        self.server = start_state_server(self.address, 2)
+        super(SharedUserStorageTest, self).setUp()
+
+    def tearDown(self):
+        super(SharedUserStorageTest, self).tearDown()
+        self.server.shutdown()
+        self.server_dir.cleanup()
+
+    def _config(self):
+        return {'state_socket': self.address}
+
+    def test_state_shared(self):
+        self.assertIsInstance(self.storages[0], SharedUserStorage)
+        self.assertIsNotNone(self.storages[0].shared_state())
+        other = self._open()
+
+        user = self._request('foo', '00-11-22-33-44-55')
+
+        self.assertEqual(other.find_request('foo'), user)